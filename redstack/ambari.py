@@ -1,4 +1,5 @@
 import json
+import time
 
 import requests
 import simplejson
@@ -15,11 +16,12 @@ logger = logging.getLogger("root_logger")
 
 
 class Ambari:
-    def __init__(self, deploy):
-        # type: (Deploy) -> None
+    def __init__(self, deploy, installed=False):
+        # type: (Deploy, bool) -> None
         """
         Constructor for Ambari
         :param deploy: The current deploy
+        :param installed: whether the cluster is already installed and the admin password has been changed
         """
         self.deploy = deploy
 
@@ -27,10 +29,26 @@ class Ambari:
 
         self.api_root = 'https://{0}:8443/api/v1/'.format(self.ambari_ip)
 
-        self.auth = ('admin', 'admin')
+        self.auth = ('admin', deploy.ambari_password) if installed else ('admin', 'admin')
         self.headers = {'X-Requested-By': 'ambari'}
 
-        self.retries = 5
+        # One keep-alive session for every call, instead of a tcp connection and tls handshake per call. The requests
+        # are sequential, a small pool covers the odd overlap of a poll and a retry
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers.update(self.headers)
+        self.session.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Without a read timeout a stalled server hangs the deploy, a timeout is retried like a refused connection
+        self.timeout = (deploy.ambari_connect_timeout, deploy.ambari_read_timeout)
+
+        # The latencies and the error count of the calls to each endpoint
+        self.stats = {}
+
+        self.retry_policy = 'ambari'
         self.short_sleep = 5
 
         self.retry_exceptions = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, KeyError,
@@ -44,25 +62,22 @@ class Ambari:
         """
         logger.info('Starting preparation of Ambari to install Hadoop on {0}'.format(self.ambari_ip))
 
-        if self.deploy.define_custom_repos:
+        # The package mirror rewrote the definitions to point at the master
+        if self.deploy.define_custom_repos or self.deploy.package_mirror:
             self._put_stack()
             logger.info('Stack definition posted to cluster')
-            time.sleep(self.short_sleep)
 
             self._put_utils()
             logger.info('Utils definition posted to cluster')
-            time.sleep(self.short_sleep)
 
         self._post_blueprint()
         logger.info('Blueprints posted to cluster')
-        time.sleep(self.short_sleep)
 
         self._start_install()
-        time.sleep(self.short_sleep)
 
         self._change_admin_password()
         set_root_mysql_password(self.deploy.cluster.master_node, self.deploy.cluster.ssh_user,
-                                self.deploy.cluster.private_key, self.deploy.mysql_root_password)
+                                self.deploy.cluster.private_key, self.deploy.ssh_pool, self.deploy.mysql_root_password)
 
     def _put_stack(self):
         # type: () -> None
@@ -74,7 +89,7 @@ class Ambari:
             self.deploy.hdp_major_version)
         payload = json.dumps(self.deploy.stack_definition)
 
-        self._put(endpoint, payload)
+        retry(self._put, self.retry_policy, self.retry_exceptions, endpoint, payload)
 
     def _put_utils(self):
         # type: () -> None
@@ -82,11 +97,11 @@ class Ambari:
         Puts the stack utils definition to ambari server for installing an exact version from a hosted location
         :return: 
         """
-        endpoint = 'stacks/HDP/versions/{0}/operating_systems/redhat7/repositories/HDP-{0}'.format(
+        endpoint = 'stacks/HDP/versions/{0}/operating_systems/redhat7/repositories/HDP-UTILS-{1}'.format(
             self.deploy.hdp_major_version, self.deploy.hdp_utils_version)
         payload = json.dumps(self.deploy.utils_definition)
 
-        self._put(endpoint, payload)
+        retry(self._put, self.retry_policy, self.retry_exceptions, endpoint, payload)
 
     def _post_blueprint(self):
         # type: () -> None
@@ -98,7 +113,7 @@ class Ambari:
         endpoint = 'blueprints/{0}'.format(self.deploy.stack_name)
         payload = json.dumps(self.deploy.blueprint)
 
-        retry(self._post, 40, self.retry_exceptions, endpoint, payload)
+        retry(self._post, 'ambari_blueprint', self.retry_exceptions, endpoint, payload)
 
     def _start_install(self):
         # type: () -> None
@@ -111,12 +126,167 @@ class Ambari:
 
         logger.info('Hostmapping applied to cluster, starting installation of hadoop')
 
-        response_dict = retry(self._post, self.retries, self.retry_exceptions, endpoint, payload)
-        time.sleep(20)
+        response_dict = retry(self._post, self.retry_policy, self.retry_exceptions, endpoint, payload)
+
+        self._wait_for_request(response_dict['href'])
+
+    def stop_host_components(self, node):
+        # type: (Node) -> [str]
+        """
+        Stops every started component on the given host and waits for the request to finish
+        :param node: The node to stop the components of
+        :return: The names of the components that were stopped
+        """
+        endpoint = 'clusters/{0}/hosts/{1}/host_components'.format(self.deploy.stack_name, node.fqdn)
+        response_dict = retry(self._get, self.retry_policy, self.retry_exceptions,
+                              endpoint + '?HostRoles/state=STARTED&fields=HostRoles/component_name')
+        components = [item['HostRoles']['component_name'] for item in response_dict['items']]
+
+        if components:
+            logger.info('Stopping {0} on {1}'.format(', '.join(components), node.name))
+            self._set_host_components_state(node, components, 'INSTALLED')
+
+        return components
+
+    def wait_for_host(self, node, timeout=900):
+        # type: (Node, int) -> None
+        """
+        Waits for the ambari-agent of a host to heartbeat again and the host to be HEALTHY, ex. after a reboot
+        :param node: The node to wait for
+        :param timeout: Seconds to wait before giving up
+        :raises AmbariException: if the host is not healthy in time
+        """
+        endpoint = 'hosts/{0}?fields=Hosts/host_state,Hosts/last_heartbeat_time'.format(node.fqdn)
+        first_heartbeat = None
+
+        start = time.time()
+        while True:
+            response_dict = retry(self._get, self.retry_policy, self.retry_exceptions, endpoint)
+            state = response_dict['Hosts']['host_state']
+            heartbeat = response_dict['Hosts']['last_heartbeat_time']
+
+            # The state may still be the one from before the reboot, only a new heartbeat shows the agent is back
+            if first_heartbeat is None:
+                first_heartbeat = heartbeat
+            elif state == 'HEALTHY' and heartbeat > first_heartbeat:
+                logger.info('Ambari agent on {0} is heartbeating again'.format(node.name))
+                return
+
+            if time.time() - start > timeout:
+                raise AmbariException('{0} is {1} in ambari, {2}s after it was resized'.format(
+                    node.name, state, timeout))
+
+            time.sleep(self.short_sleep)
+
+    def start_host_components(self, node, components):
+        # type: (Node, [str]) -> None
+        """
+        Starts the given components on the given host and waits for the request to finish
+        :param node: The node to start the components on
+        :param components: The names of the components to start
+        """
+        if components:
+            logger.info('Starting {0} on {1}'.format(', '.join(components), node.name))
+            self._set_host_components_state(node, components, 'STARTED')
+
+    def _set_host_components_state(self, node, components, state):
+        # type: (Node, [str], str) -> None
+        """
+        Puts the desired state for a list of components on a host, and waits for the resulting request
+        :param node: The node the components are on
+        :param components: The names of the components to change
+        :param state: The desired state of the components, INSTALLED or STARTED
+        """
+        endpoint = 'clusters/{0}/hosts/{1}/host_components?HostRoles/component_name.in({2})'.format(
+            self.deploy.stack_name, node.fqdn, ','.join(components))
+        payload = json.dumps({
+            'RequestInfo': {
+                'context': 'REDstack set {0} components to {1}'.format(node.name, state)
+            },
+            'Body': {
+                'HostRoles': {
+                    'state': state
+                }
+            }
+        })
+
+        response_dict = retry(self._put, self.retry_policy, self.retry_exceptions, endpoint, payload)
+
+        # Ambari does not create a request when the components are already in the desired state
+        if response_dict:
+            self._wait_for_request(response_dict['href'])
+
+    def update_configuration(self, config_type, properties):
+        # type: (str, {}) -> None
+        """
+        Merges the given properties into the current desired configuration of the given type, and applies it
+        as a new configuration version
+        :param config_type: The configuration type, ex. yarn-site
+        :param properties: The properties to add or change
+        """
+        endpoint = 'clusters/{0}?fields=Clusters/desired_configs/{1}'.format(self.deploy.stack_name, config_type)
+        response_dict = retry(self._get, self.retry_policy, self.retry_exceptions, endpoint)
+        current_tag = response_dict['Clusters']['desired_configs'][config_type]['tag']
+
+        endpoint = 'clusters/{0}/configurations?type={1}&tag={2}'.format(self.deploy.stack_name, config_type,
+                                                                         current_tag)
+        response_dict = retry(self._get, self.retry_policy, self.retry_exceptions, endpoint)
+        current_config = response_dict['items'][0]
+
+        new_properties = current_config['properties']
+        new_properties.update(properties)
+
+        payload_dict = {
+            'Clusters': {
+                'desired_config': {
+                    'type': config_type,
+                    'tag': 'version{0}'.format(int(time.time() * 1000)),
+                    'properties': new_properties,
+                    'properties_attributes': current_config.get('properties_attributes', {})
+                }
+            }
+        }
+
+        retry(self._put, self.retry_policy, self.retry_exceptions, 'clusters/{0}'.format(self.deploy.stack_name),
+              json.dumps(payload_dict))
+        logger.info('Updated {0} with {1}'.format(config_type, properties))
+
+    def restart_components(self, service, component, nodes):
+        # type: (str, str, [Node]) -> None
+        """
+        Restarts a component of a service on the given hosts and waits for the request to finish
+        :param service: The service the component belongs to, ex. YARN
+        :param component: The component to restart, ex. NODEMANAGER
+        :param nodes: The nodes to restart the component on
+        """
+        endpoint = 'clusters/{0}/requests'.format(self.deploy.stack_name)
+        payload = json.dumps({
+            'RequestInfo': {
+                'command': 'RESTART',
+                'context': 'REDstack restart {0}'.format(component)
+            },
+            'Requests/resource_filters': [
+                {
+                    'service_name': service,
+                    'component_name': component,
+                    'hosts': ','.join([node.fqdn for node in nodes])
+                }
+            ]
+        })
+
+        logger.info('Restarting {0} on {1}'.format(component, ', '.join([node.name for node in nodes])))
+        response_dict = retry(self._post, self.retry_policy, self.retry_exceptions, endpoint, payload)
+        self._wait_for_request(response_dict['href'])
 
+    def _wait_for_request(self, request_url):
+        # type: (str) -> None
+        """
+        Blocks until the ambari request at the given URL is no longer pending
+        :param request_url: Ambari url of the request
+        """
         pending = True
         while pending:
-            pending = retry(self._monitor_request, self.retries, self.retry_exceptions, response_dict['href'])
+            pending = retry(self._monitor_request, self.retry_policy, self.retry_exceptions, request_url)
 
     def _change_admin_password(self):
         # type: () -> None
@@ -136,7 +306,9 @@ class Ambari:
         payload = json.dumps(payload_dict)
         endpoint = 'users/{0}'.format('admin')
 
-        retry(self._put, self.retries, self.retry_exceptions, endpoint, payload)
+        retry(self._put, self.retry_policy, self.retry_exceptions, endpoint, payload)
+        self.auth = ('admin', self.deploy.ambari_password)
+        self.session.auth = self.auth
         logger.info('Changed ambari password for admin')
 
     def _monitor_request(self, request_url):
@@ -151,7 +323,7 @@ class Ambari:
         time.sleep(self.short_sleep)
 
         # get the response
-        response_dict = retry(self._get, self.retries, KeyError, full_url=request_url)
+        response_dict = retry(self._get, self.retry_policy, KeyError, full_url=request_url)
 
         # extract meaningful response variables
         percent = response_dict['Requests']['progress_percent']
@@ -162,7 +334,7 @@ class Ambari:
         elif status == 'COMPLETED':
             return False
         elif status == 'PENDING' or status == 'IN_PROGRESS':
-            logger.info("Ambari install for {0} in progress... {1}%".format(
+            logger.info("Ambari request for {0} in progress... {1}%".format(
                 self.deploy.name, str(percent).split('.')[0]))
         else:
             if percent >= 95:
@@ -180,22 +352,7 @@ class Ambari:
         :param payload: The json object to send
         :return: the response dict if it exists else none
         """
-        if full_url:
-            response = requests.post(full_url, payload, auth=self.auth, headers=self.headers, verify=False)
-        else:
-            response = requests.post(self.api_root + endpoint, payload, auth=self.auth, headers=self.headers,
-                                     verify=False)
-
-        if response.status_code >= 400:
-            logger.error(self.api_root + endpoint)
-            logger.error(payload)
-            raise AmbariException('post failed to {0} with code {1} - {2}'.format(endpoint, response.status_code,
-                                                                                  response.reason))
-        try:
-            response_dict = response.json()
-            return response_dict
-        except simplejson.scanner.JSONDecodeError:
-            return
+        return self._request('post', endpoint, payload, full_url)
 
     def _put(self, endpoint=None, payload=None, full_url=None):
         # type: (str, dict) -> {}
@@ -205,22 +362,7 @@ class Ambari:
         :param payload: The json object to send
         :return: the response dict if it exists else none
         """
-        if full_url:
-            response = requests.put(full_url, payload, auth=self.auth, headers=self.headers, verify=False)
-        else:
-            response = requests.put(self.api_root + endpoint, payload, auth=self.auth, headers=self.headers,
-                                    verify=False)
-
-        if response.status_code >= 400:
-            logger.error(self.api_root + endpoint)
-            logger.error(payload)
-            raise AmbariException('post failed to {0} with code {1} - {2}'.format(endpoint, response.status_code,
-                                                                                  response.reason))
-        try:
-            response_dict = response.json()
-            return response_dict
-        except simplejson.scanner.JSONDecodeError:
-            return
+        return self._request('put', endpoint, payload, full_url)
 
     def _get(self, endpoint=None, full_url=None):
         # type: (str) -> {}
@@ -229,21 +371,117 @@ class Ambari:
         :param endpoint: The endpoint after the api root 
         :return: the response dict if it exists else none
         """
-        if full_url:
-            response = requests.get(full_url, auth=self.auth, headers=self.headers, verify=False)
-        else:
-            response = requests.get(self.api_root + endpoint, auth=self.auth, headers=self.headers, verify=False)
+        return self._request('get', endpoint, None, full_url)
+
+    def _request(self, method, endpoint=None, payload=None, full_url=None):
+        # type: (str, str, str, str) -> {}
+        """
+        Sends a request over the pooled session and records its latency
+        :param method: The http method, get, post or put
+        :param endpoint: The endpoint after the api root
+        :param payload: The json object to send, if any
+        :param full_url: The url to use instead of the endpoint
+        :raises AmbariException: if ambari answered with an error code, or a post failed after it may have been sent
+        :return: the response dict if it exists else none
+        """
+        url = full_url or self.api_root + endpoint
+        key = self._stats_key(method, url)
+
+        start = time.time()
+        try:
+            response = self.session.request(method, url, data=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self._record(key, time.time() - start, error=True)
+
+            # A post that timed out waiting for its answer, or whose connection dropped, ex. a stale keep-alive
+            # connection, may have been acted on. Replaying it would post the blueprint or start the install twice, so
+            # it is raised as an AmbariException, which is not retried
+            if method == 'post' and not self._never_connected(e):
+                raise AmbariException('post to {0} failed and may have reached ambari - {1}'.format(
+                    endpoint or full_url, e))
+            raise
+        self._record(key, time.time() - start, error=response.status_code >= 400)
 
         if response.status_code >= 400:
-            logger.error(self.api_root + endpoint)
-            raise AmbariException('get failed to {0} with code {1} - {2}'.format(endpoint, response.status_code,
-                                                                                 response.reason))
+            logger.error(url)
+            if payload:
+                logger.error(payload)
+            raise AmbariException('{0} failed to {1} with code {2} - {3}'.format(
+                method, endpoint or full_url, response.status_code, response.reason))
         try:
             response_dict = response.json()
             return response_dict
-        except simplejson.scanner.JSONDecodeError:
+        except (ValueError, simplejson.scanner.JSONDecodeError):
             return
 
+    @staticmethod
+    def _never_connected(error):
+        # type: (requests.exceptions.RequestException) -> bool
+        """
+        :param error: The error of a request
+        :return: True if the request failed to connect, so it never reached ambari
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+
+        # A refused connection is a NewConnectionError, which is a ConnectTimeoutError as well
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+    def _stats_key(self, method, url):
+        # type: (str, str) -> str
+        """
+        Groups the urls of the same endpoint, ex. every poll of a request or the components of every host
+        :param method: The http method
+        :param url: The full url of the request
+        :return: The method and the path with its query and ids left out
+        """
+        path = url.split('?')[0]
+        if path.startswith(self.api_root):
+            path = path[len(self.api_root):]
+
+        segments = path.strip('/').split('/')
+        for i, segment in enumerate(segments):
+            if segment.isdigit():
+                segments[i] = '{id}'
+            elif i > 0 and segments[i - 1] == 'hosts':
+                segments[i] = '{host}'
+
+        return '{0} {1}'.format(method.upper(), '/'.join(segments))
+
+    def _record(self, key, latency, error=False):
+        # type: (str, float, bool) -> None
+        """
+        Records the latency of a request to an endpoint
+        :param key: The endpoint, as given by _stats_key
+        :param latency: The seconds the request took
+        :param error: Whether the request failed
+        """
+        latencies, errors = self.stats.setdefault(key, ([], [0]))
+        latencies.append(latency)
+        if error:
+            errors[0] += 1
+
+    def log_stats(self):
+        # type: () -> None
+        """
+        Logs the number of calls, the errors and the latency of each endpoint called so far, slowest in total first
+        """
+        totals = sorted(self.stats.items(), key=lambda item: -sum(item[1][0]))
+        for key, (latencies, errors) in totals:
+            ordered = sorted(latencies)
+            logger.info('Ambari {0}: {1} calls, {2} errors, {3:.3f}s median, {4:.3f}s p95, {5:.3f}s max'.format(
+                key, len(ordered), errors[0], ordered[len(ordered) // 2], ordered[int(len(ordered) * 0.95)],
+                ordered[-1]))
+
+    def close(self):
+        # type: () -> None
+        """
+        Logs the endpoint stats and closes the pooled connections to ambari
+        """
+        self.log_stats()
+        self.session.close()
+
 
 if __name__ == '__main__':
     setup_logger()
@@ -260,3 +498,4 @@ if __name__ == '__main__':
 
     ambari = Ambari(deploy)
     ambari.install()
+    ambari.close()
@@ -0,0 +1,131 @@
+""" Module for caching artifacts the nodes need on the deploy host.
+
+Artifacts such as the Chef client RPM are downloaded once per version into a cache shared by all deployments, and
+checked against their sha256 every time they are used. The nodes then receive them from the deploy host over their ssh
+connections, instead of each node downloading them from the internet.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import requests
+
+import retry_policy
+from redstack.exceptions import ArtifactException
+
+logger = logging.getLogger("root_logger")
+
+# The sha256 of each cached artifact this process has verified, by path
+_verified = {}
+
+
+class ArtifactCache:
+    def __init__(self, directory):
+        # type: (str) -> None
+        """
+        Constructor for ArtifactCache
+        :param directory: The directory holding the cached artifacts
+        """
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def fetch(self, name, version, uri, sha256=None):
+        # type: (str, str, str, str) -> str
+        """
+        Returns the cached copy of an artifact, downloading it first if it is not cached yet. Concurrent callers wait
+        for a single download.
+        :param name: The name of the artifact, ex. chef
+        :param version: The version of the artifact, the cache holds one copy per version
+        :param uri: Where to download the artifact from
+        :param sha256: The expected sha256 of the artifact, the checksum of the first download is trusted if not given
+        :return: The local path of the artifact
+        :raises ArtifactException: if the artifact could not be downloaded or does not match its checksum
+        """
+        directory = os.path.join(self.directory, name, version)
+        path = os.path.join(directory, os.path.basename(uri))
+        checksum_path = path + '.sha256'
+
+        with self._lock:
+            # Hashing a large artifact for every node would serialize their installs, it is verified once per process
+            if _verified.get(path) and (not sha256 or sha256 == _verified[path]) and os.path.exists(path):
+                return path
+
+            if os.path.exists(path) and os.path.exists(checksum_path):
+                with open(checksum_path, 'r') as checksum_file:
+                    recorded = checksum_file.read().strip()
+
+                if self.checksum(path) == recorded and (not sha256 or sha256 == recorded):
+                    _verified[path] = recorded
+                    return path
+
+                logger.warning('Cached {0} {1} does not match its checksum, downloading it again'.format(
+                    name, version))
+
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            # A unique part file, other deploy processes may be downloading to the same cache at the same time
+            part_fd, part_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.part')
+            os.close(part_fd)
+
+            try:
+                try:
+                    retry_policy.get_policy('default').call(self._download,
+                                                            (requests.exceptions.RequestException, IOError),
+                                                            uri, part_path)
+                except (requests.exceptions.RequestException, IOError) as e:
+                    raise ArtifactException('Failed to download {0} from {1}: {2}'.format(name, uri, e))
+
+                actual = self.checksum(part_path)
+                if sha256 and actual != sha256:
+                    raise ArtifactException('{0} from {1} has sha256 {2}, expected {3}'.format(
+                        name, uri, actual, sha256))
+
+                # The rename makes a complete artifact appear at once, an interrupted download never looks cached
+                os.chmod(part_path, 0o644)
+                os.rename(part_path, path)
+            finally:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+
+            checksum_fd, checksum_part_path = tempfile.mkstemp(dir=directory, suffix='.part')
+            with os.fdopen(checksum_fd, 'w') as checksum_file:
+                checksum_file.write(actual + '\n')
+            os.chmod(checksum_part_path, 0o644)
+            os.rename(checksum_part_path, checksum_path)
+
+            _verified[path] = actual
+            logger.info('Cached {0} {1} at {2} (sha256 {3})'.format(name, version, path, actual[:12]))
+            return path
+
+    @staticmethod
+    def checksum(path):
+        # type: (str) -> str
+        """
+        :param path: The file to checksum
+        :return: The sha256 of the file
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as artifact_file:
+            for chunk in iter(lambda: artifact_file.read(1048576), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _download(uri, path):
+        # type: (str, str) -> None
+        """
+        Streams a file to disk
+        :param uri: The uri to download
+        :param path: The local path to write to
+        """
+        logger.info('Downloading {0}'.format(uri))
+        response = requests.get(uri, stream=True, timeout=(10, 60))
+        response.raise_for_status()
+
+        with open(path, 'wb') as artifact_file:
+            for chunk in response.iter_content(1048576):
+                artifact_file.write(chunk)
@@ -0,0 +1,169 @@
+""" Module for baking the node independent part of the Chef converge into a golden image.
+
+A single server is booted from image_name, converged with the bake_recipes only, cleaned of everything that identifies
+it and snapshotted into a glance image. The image is tagged with the bake digest of the Chef payload, so a deploy whose
+cookbooks, baked recipes, Chef version and base image are the same boots its nodes from it and only converges the
+remaining, node specific recipes. Run from the redstack directory with the main configuration file, ex.
+
+    python bake.py --config /opt/redstack/REDstack/conf/rs_conf.yml
+
+The bake builds its server as the REDstack stack of the project, so the project must not hold a cluster at the time.
+"""
+
+import json
+import logging
+import os
+
+import yaml
+
+import helper_functions
+from bundle import bake_digest
+from chef import Chef
+from domain.cluster import Cluster
+from domain.deploy import Deploy
+from domain.node import Node
+from environment import Environment
+from fanout import FanOut
+from openstack import Openstack
+from redstack.exceptions import BakeException, ConfigException
+
+logger = logging.getLogger("root_logger")
+
+# Removes the caches, the converge state and the identity of the server before it is snapshotted
+CLEANUP_COMMAND = 'sudo yum clean all && sudo rm -rf /var/chef/cache /var/redstack /tmp/chef-bundle-* ' \
+                  '/var/lib/cloud/instance /var/lib/cloud/instances /etc/ssh/ssh_host_*_key* && sudo sync'
+
+
+class ImageBaker:
+    def __init__(self, deploy):
+        # type: (Deploy) -> None
+        """
+        Constructor for ImageBaker
+        :param deploy: The deploy to bake with, its deployment directory must have been created
+        """
+        self.deploy = deploy
+
+        # The server being baked must boot from the base image, not from an earlier bake, and stays untuned since the
+        # tuning depends on the node
+        self.deploy.use_baked_image = False
+        self.deploy.tune_hosts = False
+
+    def bake(self, force=False):
+        # type: (bool) -> str
+        """
+        Bakes the image for the Chef payload of the deploy, unless one is already baked
+        :param force: Bake a new image even when one is already baked for the payload
+        :raises ConfigException: if no bake_recipes are configured
+        :raises BakeException: if the project holds a stack or the image could not be baked
+        :return: The name of the image
+        """
+        if not self.deploy.bake_recipes:
+            raise ConfigException('bake_recipes must list the recipes to bake into the image')
+
+        digest = bake_digest(self.deploy)
+        openstack = Openstack(self.deploy)
+
+        image = openstack.find_baked_image(digest)
+        if image and not force:
+            logger.info('Image {0} is already baked for this Chef payload ({1})'.format(image.name, digest[:12]))
+            return image.name
+
+        if openstack.has_stacks():
+            raise BakeException('The project already holds a stack, the image is baked on an empty project')
+
+        self.deploy.cluster = self._create_cluster()
+        image_name = 'redstack-bake-{0}'.format(digest[:12])
+
+        logger.info('Baking {0} from {1} with {2}'.format(image_name, self.deploy.bake_base_image,
+                                                          ', '.join(self.deploy.bake_recipes)))
+        try:
+            openstack.build()
+            node = self.deploy.cluster.master_node
+
+            self._converge(node)
+
+            openstack.snapshot_node(node, image_name, {
+                'redstack_bake': digest,
+                'redstack_base_image': self.deploy.bake_base_image,
+                'redstack_bake_recipes': ','.join(self.deploy.bake_recipes)
+            })
+        finally:
+            self.deploy.ssh_pool.close()
+            openstack.destroy()
+
+        logger.info('Baked image {0}'.format(image_name))
+        return image_name
+
+    def _create_cluster(self):
+        # type: () -> Cluster
+        """
+        Creates the one node cluster the image is baked on, with the flavor of the master node unless bake_flavor is set
+        :return: The cluster
+        """
+        template = {
+            'primary': 'rs-bake',
+            'nodes': {
+                'rs-bake': {'count': 1, 'volume_size': 10, 'runlist': 'bake', 'ambari_group': 'bake',
+                            'flavor': self.deploy.bake_flavor or self.deploy.cluster.master_node.flavor}
+            }
+        }
+
+        template_file = os.path.join(self.deploy.directory, 'bake-template.yml')
+        with open(template_file, 'w') as template_yaml_file:
+            yaml.dump(template, template_yaml_file, default_flow_style=False)
+
+        return Cluster(cluster_name=self.deploy.cluster.cluster_name, ssh_user=self.deploy.cluster.ssh_user,
+                       private_key=self.deploy.cluster.private_key, key_name=self.deploy.key_name,
+                       template_file=template_file, fqdn_address=self.deploy.fqdn_address)
+
+    def _converge(self, node):
+        # type: (Node) -> None
+        """
+        Installs Chef on the node, converges the baked recipes and cleans the node up for the snapshot
+        :param node: The node to bake
+        :raises ShellException: if the cleanup failed
+        """
+        cluster = self.deploy.cluster
+        helper_functions.test_node_ssh_availability(node, cluster.ssh_user, cluster.private_key, self.deploy.ssh_pool)
+
+        with open(os.path.join(self.deploy.directory, 'runlists', 'bake.json'), 'w') as runlist_file:
+            json.dump({'run_list': ['recipe[redstack::runtime]'] +
+                                   ['recipe[{0}]'.format(recipe) for recipe in self.deploy.bake_recipes]},
+                      runlist_file, indent=2)
+
+        chef = Chef(self.deploy)
+        chef.write_runtime_attributes()
+        chef.multiplexer.open(node)
+        try:
+            chef.install_chef(node)
+            chef.converge('bake.json', [node], force=True)
+        finally:
+            chef.multiplexer.close(node)
+
+        fan_out = FanOut(self.deploy.ssh_pool, cluster.ssh_user, cluster.private_key, timeout=600,
+                         stream_output=False)
+        FanOut.check(fan_out.run([node], CLEANUP_COMMAND, get_pty=True), 'Cleanup of the baked node')
+
+
+def bake(config_file, force=False):
+    """
+    Bakes the golden image for the Chef payload of the configuration
+    :param: config_file - Path to main configuration file
+    :param: force - Bake a new image even when one is already baked for the payload
+    :return: The name of the image
+    """
+    deploy = Deploy(config_file)
+
+    # Update logging handler to reflect process configuration
+    logger.setLevel(deploy.log_level)
+
+    Environment(deploy).create()
+
+    return ImageBaker(deploy).bake(force)
+
+
+if __name__ == "__main__":
+    helper_functions.setup_logger()
+    args = helper_functions.parse_args()
+
+    bake(args.config, args.force)
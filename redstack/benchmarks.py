@@ -0,0 +1,252 @@
+""" Benchmarks for the parts of REDstack whose cost grows with the size of the cluster.
+
+Each benchmark prints one line per cluster size with the wall time and the peak memory of the measured operation.
+Run from the redstack directory with the main configuration file, ex.
+
+    python benchmarks.py heat-template --config /opt/redstack/REDstack/conf/rs_conf.yml
+
+The ssh benchmark runs the remote operations against a farm of in-process ssh servers on loopback addresses, see
+ssh_stub.py, and needs one loopback address per node, which linux provides out of the box.
+"""
+
+import argparse
+import gc
+import os
+import resource
+import shutil
+import tempfile
+import time
+from threading import Event, Thread
+
+import yaml
+
+from artifacts import ArtifactCache
+from chef import Chef
+from domain.cluster import Cluster
+from domain.deploy import Deploy
+from domain.node import Node
+from fanout import FanOut
+from heat_template import HeatTemplate
+from helper_functions import unmount
+from ssh import SSHPool, SSHReadinessScanner
+from ssh_stub import StubSSHFarm
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no allocation tracing, fall back to sampling the resident size of the process
+    tracemalloc = None
+
+
+def measure(func, *args, **kwargs):
+    # type: (any, args) -> (float, int)
+    """
+    Runs a function once and measures it
+    :param func: The function to measure
+    :param args: args to pass to the function
+    :return: A tuple of the wall time in seconds and the peak memory in bytes
+    """
+    gc.collect()
+
+    if tracemalloc:
+        tracemalloc.start()
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        # ru_maxrss is the high-water mark of the whole process, so the resident size is sampled during the call
+        # instead and compared against the size before it
+        baseline = resident_memory()
+        samples = [baseline]
+        done = Event()
+
+        def sample():
+            while not done.wait(0.01):
+                samples.append(resident_memory())
+
+        sampler = Thread(target=sample)
+        sampler.start()
+        start = time.time()
+        try:
+            func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            done.set()
+            sampler.join()
+
+        peak = max(samples + [resident_memory()]) - baseline
+
+    return elapsed, peak
+
+
+def resident_memory():
+    # type: () -> int
+    """
+    :return: The current resident memory of the process in bytes
+    """
+    with open('/proc/self/statm', 'r') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def create_deploy(config_file, node_count, directory):
+    # type: (str, int, str) -> Deploy
+    """
+    Creates a deploy for a cluster of the given size, one master and node_count - 1 data nodes
+    :param config_file: Path to main configuration file
+    :param node_count: The number of nodes in the cluster
+    :param directory: The directory to use as the deployment directory
+    :return: A deploy object
+    """
+    template = {
+        'primary': 'rs-master',
+        'nodes': {
+            'rs-master': {'count': 1, 'volume_size': 30, 'flavor': 'lmem-8vcpu', 'runlist': 'hdp-master',
+                          'ambari_group': 'master'},
+            'rs-data': {'count': node_count - 1, 'volume_size': 105, 'flavor': 'lmem-8vcpu', 'runlist': 'hdp-data',
+                        'ambari_group': 'datanodes'}
+        }
+    }
+
+    template_file = os.path.join(directory, 'benchmark-template.yml')
+    with open(template_file, 'w') as template_yaml_file:
+        yaml.dump(template, template_yaml_file, default_flow_style=False)
+
+    cluster = Cluster(cluster_name='benchmark', ssh_user='centos', private_key=None, key_name='benchmark',
+                      template_file=template_file, fqdn_address='.redstack.com')
+
+    deploy = Deploy(config_file=config_file, cluster=cluster)
+    deploy.key_name = 'benchmark'
+    deploy.directory = directory
+    deploy.artifact_cache_directory = os.path.join(directory, 'cache')
+
+    return deploy
+
+
+def cache_chef_rpm(deploy, size_mb=5):
+    # type: (Deploy, int) -> None
+    """
+    Puts a stand-in for the Chef client RPM in the artifact cache of the deploy, so the benchmark never downloads it
+    :param deploy: The deploy whose cache to fill
+    :param size_mb: The size of the stand-in RPM
+    """
+    directory = os.path.join(deploy.artifact_cache_directory, 'chef', deploy.chef_version)
+    path = os.path.join(directory, os.path.basename(deploy.chef_rpm_uri))
+    if os.path.exists(path):
+        return
+
+    os.makedirs(directory)
+    with open(path, 'wb') as rpm_file:
+        rpm_file.write(os.urandom(size_mb * 1048576))
+    with open(path + '.sha256', 'w') as checksum_file:
+        checksum_file.write(ArtifactCache.checksum(path) + '\n')
+
+
+def benchmark_heat_template(config_file, sizes):
+    # type: (str, [int]) -> None
+    """
+    Measures rendering the heat template in each template format for each cluster size
+    :param config_file: Path to main configuration file
+    :param sizes: The cluster sizes to measure
+    """
+    directory = tempfile.mkdtemp()
+
+    try:
+        for size in sizes:
+            for template_format in ['json', 'yaml']:
+                deploy = create_deploy(config_file, size, directory)
+                deploy.heat_template_format = template_format
+                heat_template = HeatTemplate(deploy)
+
+                elapsed, peak = measure(heat_template.generate)
+
+                print('heat-template nodes={0:<5} format={1:<4} time={2:8.3f}s peak={3:8.1f}MB size={4:8.1f}KB'.format(
+                    size, template_format, elapsed, peak / 1048576.0, len(heat_template.rendered) / 1024.0))
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_on_all(func, nodes):
+    # type: (any, [Node]) -> None
+    """
+    Runs a function for every node at once, one thread per node, and waits for all of them
+    :param func: The function to run, called with the node
+    :param nodes: The nodes to run it for
+    """
+    threads = [Thread(target=func, args=[node]) for node in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def benchmark_ssh(config_file, sizes, latency):
+    # type: (str, [int], float) -> None
+    """
+    Measures the readiness probe, pooled and unpooled unmount, a command fan-out and chef install for each cluster size
+    :param config_file: Path to main configuration file
+    :param sizes: The cluster sizes to measure
+    :param latency: Seconds every stub command takes
+    """
+    directory = tempfile.mkdtemp()
+    private_key = StubSSHFarm.create_client_key(os.path.join(directory, 'benchmark-key'))
+    os.makedirs(os.path.join(directory, 'logs'))
+
+    try:
+        for size in sizes:
+            deploy = create_deploy(config_file, size, directory)
+            deploy.cluster.private_key = private_key
+            nodes = deploy.cluster.nodes
+
+            farm = StubSSHFarm(size, latency=latency)
+            farm.assign(nodes)
+            farm.start()
+
+            try:
+                deploy.ssh_pool = SSHPool(port=farm.port)
+                scanner = SSHReadinessScanner(deploy.ssh_pool, deploy.cluster.ssh_user, private_key)
+                results = [('readiness', measure(lambda: list(scanner.scan(nodes))))]
+
+                results.append(('unmount-pooled', measure(run_on_all, lambda node: unmount(
+                    node, deploy.cluster.ssh_user, private_key, deploy.ssh_pool), nodes)))
+
+                # A fresh pool per call pays for a new connection every time, as before pooling
+                results.append(('unmount-unpooled', measure(run_on_all, lambda node: unmount(
+                    node, deploy.cluster.ssh_user, private_key, SSHPool(port=farm.port)), nodes)))
+
+                fan_out = FanOut(deploy.ssh_pool, deploy.cluster.ssh_user, private_key, concurrency=64,
+                                 stream_output=False)
+                results.append(('fanout-command', measure(fan_out.run, nodes, 'uptime')))
+
+                cache_chef_rpm(deploy)
+                deploy.chef_rpm_sha256 = None
+                chef = Chef(deploy)
+                results.append(('install-chef', measure(run_on_all, chef.install_chef, nodes)))
+
+                for name, (elapsed, peak) in results:
+                    print('ssh nodes={0:<5} operation={1:<16} time={2:8.3f}s peak={3:8.1f}MB'.format(
+                        size, name, elapsed, peak / 1048576.0))
+            finally:
+                deploy.ssh_pool.close()
+                farm.stop()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('benchmark', choices=['heat-template', 'ssh'], help='The benchmark to run')
+    parser.add_argument('--config', help='The absolute path to your rs-conf.yml configuration file',
+                        default='/opt/redstack/REDstack/conf/rs-conf.yml')
+    parser.add_argument('--sizes', help='Comma separated cluster sizes to measure', default='10,100,1000')
+    parser.add_argument('--latency', help='Seconds every stub ssh command takes', default=0.1, type=float)
+
+    args = parser.parse_args()
+    cluster_sizes = [int(size) for size in args.sizes.split(',')]
+
+    if args.benchmark == 'heat-template':
+        benchmark_heat_template(args.config, cluster_sizes)
+    elif args.benchmark == 'ssh':
+        benchmark_ssh(args.config, cluster_sizes, args.latency)
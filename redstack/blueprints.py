@@ -229,6 +229,45 @@ class BlueprintBuilder:
     def _change_yarn_mem_allocation(self):
         self.configurations['yarn-site'].properties['yarn.nodemanager.resource.memory-mb'] = "20544"
 
+    def get_groups_with_component(self, component):
+        # type: (str) -> [str]
+        """
+        Returns the names of the host groups that contain the given component
+        :param component: The component name, ex. NODEMANAGER
+        :return: A list of host group names
+        """
+        if not self.host_groups:
+            self._build_host_groups()
+
+        return [name for name, group in self.host_groups.items()
+                if component in [group_component['name'] for group_component in group.components]]
+
+    @staticmethod
+    def yarn_memory_properties(ram):
+        # type: (int) -> {}
+        """
+        Returns the yarn-site memory settings for a NodeManager host with the given amount of ram, leaving memory
+        reserved for the operating system and the hadoop daemons
+        :param ram: The ram of the host in MB
+        :return: A dictionary of yarn-site properties
+        """
+        # (host ram in GB, reserved ram in GB)
+        reserved_table = [(4, 1), (8, 2), (16, 2), (24, 4), (48, 6), (64, 8), (72, 8), (96, 12), (128, 24),
+                          (256, 32), (512, 64)]
+
+        reserved_gb = 128
+        for host_gb, table_reserved_gb in reserved_table:
+            if ram <= host_gb * 1024:
+                reserved_gb = table_reserved_gb
+                break
+
+        yarn_memory = max(ram - reserved_gb * 1024, 1024)
+
+        return {
+            'yarn.nodemanager.resource.memory-mb': str(yarn_memory),
+            'yarn.scheduler.maximum-allocation-mb': str(yarn_memory)
+        }
+
 
 class Configuration:
     def __init__(self, attributes, properties):
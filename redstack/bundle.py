@@ -0,0 +1,361 @@
+""" Module for distributing the Chef payload of a deployment to the nodes as a single archive.
+
+The cookbooks, roles, data bags and runlists of the deployment directory are packed into one deterministic archive,
+named after its sha256. The archive is uploaded from the deploy host to a few seed nodes only. The seeds serve it over
+http on the cluster network, and every other node fetches it from them. Each node then runs chef-solo against its local
+copy, with a small json of its own attributes, so the upload from the deploy host does not grow with the size of the
+cluster. The payload holds the passwords of the runtime data bag, so the seeds only listen on the cluster network and
+serve the archive under a random path that only this deploy knows.
+"""
+
+import gzip
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import threading
+import time
+
+from domain.deploy import Deploy
+from domain.node import Node
+from fanout import FanOut
+
+from redstack.exceptions import ShellException
+
+logger = logging.getLogger("root_logger")
+
+# Directories of the deployment directory that make up the Chef payload
+PAYLOAD_DIRECTORIES = ['cookbooks', 'roles', 'data_bags', 'environments', 'runlists']
+
+# Where bundles are extracted on the nodes, one directory per bundle hash
+REMOTE_BUNDLE_DIRECTORY = '/var/redstack/chef'
+
+# Where the seeds keep the archive they serve, under the random path of the deploy
+REMOTE_SERVE_DIRECTORY = '/var/redstack/bundles'
+
+# Where the json chef-solo is run with on each node is kept
+REMOTE_NODE_DIRECTORY = '/var/redstack/nodes'
+
+# The attributes of a cluster, they are left out of the hash of the image baked for a payload
+RUNTIME_DATA_BAG = 'data_bags/redstack'
+
+SOLO_RB = """base = File.expand_path(File.dirname(__FILE__))
+
+cookbook_path       [File.join(base, 'cookbooks')]
+role_path           File.join(base, 'roles')
+data_bag_path       File.join(base, 'data_bags')
+environment_path    File.join(base, 'environments')
+file_cache_path     '/var/chef/cache'
+ssl_verify_mode     :verify_peer
+"""
+
+
+def payload_files(directory, payload_directories=None):
+    # type: (str, [str]) -> [(str, str)]
+    """
+    Lists the files and directories of the Chef payload of a deployment directory in a stable order
+    :param directory: The deployment directory
+    :param payload_directories: The directories to list, every payload directory if None
+    :return: Tuples of the local path and the path relative to the deployment directory
+    """
+    entries = []
+    for payload_directory in payload_directories or PAYLOAD_DIRECTORIES:
+        top = os.path.join(directory, payload_directory)
+        if not os.path.isdir(top):
+            continue
+
+        entries.append((top, payload_directory))
+        for root, directories, files in os.walk(top):
+            directories.sort()
+            for name in sorted(directories + files):
+                path = os.path.join(root, name)
+                # Skip version control metadata and links that point outside of the payload
+                if name == '.git' or (os.path.islink(path) and not os.path.exists(path)):
+                    continue
+                entries.append((path, os.path.relpath(path, directory)))
+            directories[:] = [name for name in directories if name != '.git']
+
+    return sorted(entries, key=lambda entry: entry[1])
+
+
+def payload_digest(directory, payload_directories=None, exclude=()):
+    # type: (str, [str], [str]) -> str
+    """
+    Hashes the paths and contents of the Chef payload, unlike the bundle archive it does not depend on how it is packed
+    :param directory: The deployment directory
+    :param payload_directories: The directories to hash, every payload directory if None
+    :param exclude: Paths relative to the deployment directory to leave out, with everything below them
+    :return: The sha256 of the payload
+    """
+    digest = hashlib.sha256()
+    for path, relative_path in payload_files(directory, payload_directories):
+        if any(relative_path == excluded or relative_path.startswith(excluded + os.sep) for excluded in exclude):
+            continue
+        digest.update(relative_path.encode('utf-8') + b'\0')
+        if os.path.isfile(path):
+            with open(path, 'rb') as payload_file:
+                for chunk in iter(lambda: payload_file.read(1048576), b''):
+                    digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def bake_digest(deploy):
+    # type: (Deploy) -> str
+    """
+    Hashes what an image baked for the deploy depends on: the cookbooks and data bags without the runtime attributes,
+    the baked recipes, the Chef version and the base image
+    :param deploy: The deploy, its deployment directory must have been created
+    :return: The sha256 the baked image is tagged with
+    """
+    digest = hashlib.sha256()
+    for part in [payload_digest(deploy.directory, ['cookbooks', 'data_bags'], [RUNTIME_DATA_BAG]),
+                 ','.join(deploy.bake_recipes), deploy.chef_version, deploy.bake_base_image]:
+        digest.update(str(part).encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+class CookbookBundle:
+    def __init__(self, deploy, ssh_config=None, seed_count=None, port=8765, seed_timeout=600):
+        # type: (Deploy, str, int, int, int) -> None
+        """
+        Constructor for CookbookBundle
+        :param deploy: The current deploy
+        :param ssh_config: The ssh_config chef-solo is run over ssh with, ex. to share master connections
+        :param seed_count: How many nodes receive the bundle from the deploy host, defaults to bundle_seed_count
+        :param port: The port the seeds serve the bundle on
+        :param seed_timeout: Seconds a node waits for a seed before falling back to an upload from the deploy host
+        """
+        self.deploy = deploy
+        self.ssh_config = ssh_config
+        self.seed_count = seed_count or deploy.bundle_seed_count
+        self.port = port
+        self.seed_timeout = seed_timeout
+
+        # The seeds serve the archive under this path, an index.html hides it from a listing of the served directory
+        self.token = hashlib.sha256(os.urandom(32)).hexdigest()[:32]
+
+        self.path = None
+        self.digest = None
+
+        # Nodes that claimed a seed slot, and the seeds that are serving the bundle
+        self.seeds_claimed = 0
+        self.seeds = []
+        self._seed_ready = threading.Event()
+        self._lock = threading.Lock()
+
+        self.fan_out = FanOut(deploy.ssh_pool, deploy.cluster.ssh_user, deploy.cluster.private_key, timeout=600,
+                              stream_output=False)
+
+    @property
+    def file_name(self):
+        # type: () -> str
+        """
+        :return: The file name of the archive, derived from its content
+        """
+        return 'chef-bundle-{0}.tar.gz'.format(self.digest)
+
+    @property
+    def remote_directory(self):
+        # type: () -> str
+        """
+        :return: The directory the bundle is extracted to on the nodes
+        """
+        return '{0}/{1}'.format(REMOTE_BUNDLE_DIRECTORY, self.digest)
+
+    def build(self):
+        # type: () -> str
+        """
+        Packs the Chef payload of the deployment directory into a deterministic archive, the same payload always gives
+        the same bytes and the same hash
+        :return: The sha256 of the archive
+        """
+        buffer = io.BytesIO()
+
+        # A fixed gzip timestamp and normalized tar headers keep the archive byte for byte reproducible
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as gzip_file:
+            with tarfile.open(fileobj=gzip_file, mode='w', format=tarfile.GNU_FORMAT) as tar:
+                for path, arcname in payload_files(self.deploy.directory):
+                    info = tar.gettarinfo(path, arcname)
+                    info.mtime = 0
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ''
+                    if info.isfile():
+                        info.mode = 0o755 if info.mode & 0o111 else 0o644
+                        with open(path, 'rb') as payload_file:
+                            tar.addfile(info, payload_file)
+                    else:
+                        info.mode = 0o755
+                        tar.addfile(info)
+
+                solo_rb = SOLO_RB.encode('utf-8')
+                info = tarfile.TarInfo('solo.rb')
+                info.size = len(solo_rb)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(solo_rb))
+
+        data = buffer.getvalue()
+        self.digest = hashlib.sha256(data).hexdigest()
+
+        bundle_directory = os.path.join(self.deploy.directory, 'bundles')
+        if not os.path.exists(bundle_directory):
+            os.makedirs(bundle_directory)
+
+        self.path = os.path.join(bundle_directory, self.file_name)
+        with open(self.path, 'wb') as bundle_file:
+            bundle_file.write(data)
+
+        logger.info('Built Chef bundle {0} ({1:.1f}MB)'.format(self.digest[:12], len(data) / 1048576.0))
+        return self.digest
+
+    def ensure(self, node):
+        # type: (Node) -> None
+        """
+        Makes sure the bundle is extracted on the node. The first nodes become seeds and receive the bundle from the
+        deploy host, the others fetch it from a seed, or from the deploy host if no seed is serving in time.
+        :param node: The node that needs the bundle
+        :raises ShellException: if the bundle could not be put on the node
+        """
+        with self._lock:
+            if self.digest is None:
+                self.build()
+
+        if self._is_extracted(node):
+            return
+
+        # Waits in short steps, so that the slot of a seed whose push failed is taken over by a waiting node at once
+        deadline = time.time() + self.seed_timeout
+        while True:
+            with self._lock:
+                seed = self.seeds_claimed < self.seed_count
+                if seed:
+                    self.seeds_claimed += 1
+
+            if seed:
+                try:
+                    self._push(node, serve=True)
+                except ShellException:
+                    with self._lock:
+                        self.seeds_claimed -= 1
+                    raise
+
+                with self._lock:
+                    self.seeds.append(node)
+                self._seed_ready.set()
+                return
+
+            if self._seed_ready.is_set() or time.time() >= deadline:
+                break
+            self._seed_ready.wait(min(1, deadline - time.time()))
+
+        if self._seed_ready.is_set() and self._fetch(node):
+            return
+
+        logger.warning('No seed served the Chef bundle to {0}, uploading it from the deploy host'.format(node.name))
+        self._push(node, serve=False)
+
+    def solo_command(self, node):
+        # type: (Node) -> str
+        """
+        Returns the local command that runs chef-solo with the bundle and the json pushed to the node over ssh
+        :param node: The node to converge
+        :return: A shell command to run from the deployment directory
+        """
+        return 'ssh {0}-t -t -i {1} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null ' \
+               '-o ServerAliveInterval=30 {2}@{3} "sudo chef-solo -c {4}/solo.rb -j {5}/{6}.json"'.format(
+                   '-F {0} '.format(self.ssh_config) if self.ssh_config else '', self.deploy.cluster.private_key,
+                   self.deploy.cluster.ssh_user, node.floating_ip, self.remote_directory, REMOTE_NODE_DIRECTORY,
+                   node.name)
+
+    def push_node_file(self, node, path):
+        # type: (Node, str) -> None
+        """
+        Uploads the json chef-solo is run with to the node, it is not part of the bundle so that every node only
+        receives its own
+        :param node: The node to upload to
+        :param path: The local json of the node
+        :raises ShellException: if the upload failed
+        """
+        remote_file = '/tmp/{0}.json'.format(node.name)
+        FanOut.check(self.fan_out.upload([node], path, remote_file), 'Upload of the node json')
+        FanOut.check(self.fan_out.run([node], 'sudo mkdir -p {0} && sudo mv {1} {0}/'.format(
+            REMOTE_NODE_DIRECTORY, remote_file), get_pty=True), 'Upload of the node json')
+
+    def stop(self):
+        # type: () -> None
+        """
+        Stops the http servers on the seeds, the next nodes to ensure the bundle become the new seeds
+        """
+        with self._lock:
+            seeds = self.seeds
+            self.seeds = []
+            self.seeds_claimed = 0
+            self._seed_ready.clear()
+
+        if seeds:
+            self.fan_out.run(seeds, 'sudo pkill -f "(SimpleHTTPRequestHandler|http.server --bind).* {0}$"; '
+                                    'sudo rm -rf {1}; true'.format(self.port, REMOTE_SERVE_DIRECTORY), get_pty=True)
+
+    def _is_extracted(self, node):
+        # type: (Node) -> bool
+        """
+        :param node: The node to check
+        :return: True if this bundle is already extracted on the node
+        """
+        result = self.fan_out.run([node], 'test -f {0}/solo.rb'.format(self.remote_directory))[0]
+        return result.ok
+
+    def _push(self, node, serve):
+        # type: (Node, bool) -> None
+        """
+        Uploads the bundle from the deploy host to the node and extracts it
+        :param node: The node to upload to
+        :param serve: Whether the node serves the bundle to the other nodes
+        :raises ShellException: if the upload or the extraction failed
+        """
+        remote_file = '/tmp/{0}'.format(self.file_name)
+        FanOut.check(self.fan_out.upload([node], self.path, remote_file), 'Upload of the Chef bundle')
+
+        command = self._extract_command(remote_file)
+        if serve:
+            # Bundles of earlier deploys are removed rather than served along, and the server is bound to the
+            # internal ip of the seed
+            command += ' && sudo rm -rf {0} && sudo mkdir -p {0}/{1} && sudo touch {0}/index.html {0}/{1}/index.html ' \
+                       '&& sudo cp {2} {0}/{1}/ && cd {0} && (setsid nohup sh -c \'command -v python2 > /dev/null && ' \
+                       'exec python2 -c "import sys, BaseHTTPServer, SimpleHTTPServer; BaseHTTPServer.HTTPServer(' \
+                       '(sys.argv[1], int(sys.argv[2])), SimpleHTTPServer.SimpleHTTPRequestHandler).serve_forever()" ' \
+                       '{3} {4} || exec python3 -m http.server --bind {3} {4}\' > /dev/null 2>&1 < /dev/null &)'.format(
+                           REMOTE_SERVE_DIRECTORY, self.token, remote_file, node.internal_ip, self.port)
+
+        FanOut.check(self.fan_out.run([node], command, get_pty=True), 'Extraction of the Chef bundle')
+        logger.info('Uploaded Chef bundle to {0}{1}'.format(node.name, ' as a seed' if serve else ''))
+
+    def _fetch(self, node):
+        # type: (Node) -> bool
+        """
+        Fetches the bundle from the first seed that serves it on the cluster network, and extracts it
+        :param node: The node to fetch to
+        :return: True if the bundle was fetched and extracted
+        """
+        with self._lock:
+            seed_ips = ' '.join([seed.internal_ip for seed in self.seeds])
+
+        remote_file = '/tmp/{0}'.format(self.file_name)
+        command = 'for seed in {0}; do curl -sf --connect-timeout 5 -o {1} http://$seed:{2}/{3}/{4} && ' \
+                  'echo "{5}  {1}" | sha256sum -c - && fetched=1 && break; done; [ -n "$fetched" ] && {6}'.format(
+                      seed_ips, remote_file, self.port, self.token, self.file_name, self.digest,
+                      self._extract_command(remote_file))
+
+        result = self.fan_out.run([node], command, get_pty=True)[0]
+        if result.ok:
+            logger.info('Fetched Chef bundle from a seed to {0}'.format(node.name))
+        return result.ok
+
+    def _extract_command(self, remote_file):
+        # type: (str) -> str
+        """
+        :param remote_file: The archive on the node
+        :return: The command extracting the archive to the bundle directory of the node
+        """
+        return 'sudo mkdir -p {0} && sudo tar xzf {1} -C {0}'.format(self.remote_directory, remote_file)
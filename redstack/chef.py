@@ -1,16 +1,31 @@
+import hashlib
+import json
 import os
 import subprocess
-from threading import Thread
+import threading
 
+from artifacts import ArtifactCache
+from bundle import CookbookBundle, payload_digest
+from chef_profile import ChefProfiler
+from diagnostics import Diagnostics
 from domain.cluster import Cluster
 from domain.deploy import Deploy
 from environment import Environment
+from fanout import FanOut
 from helper_functions import *
+from host_resources import ProcessThrottle
 from openstack import Openstack
+from output_pump import OutputPump
+from scheduler import ConvergeScheduler, ConvergeState, MilestoneTracker
+from ssh import SSHMultiplexer
+from tuning import HostTuning
 from redstack.exceptions import ChefException, ShellException
 
 logger = logging.getLogger("root_logger")
 
+# Where nodes keep the fingerprint of the last successful converge of each runlist
+FINGERPRINT_DIRECTORY = '/var/redstack/fingerprints'
+
 
 class Chef:
 
@@ -27,38 +42,75 @@ class Chef:
         self.sleep_time = 5
 
         # knife command used to run chef on the nodes
-        self.knife_command = "knife solo cook -i {0} {1}@{2} runlists/{3} --no-berkshelf --ssh-keepalive-interval 30"
+        self.knife_command = "knife solo cook -i {0} {1}@{2} {3} --no-berkshelf --ssh-keepalive-interval 30 " \
+                             "--ssh-config-file {4}"
+
+        # captures the output of every running knife process from a single thread
+        self.output_pump = OutputPump()
+
+        # sizes and paces the knife processes to the cores, memory and open file limit of the deploy host
+        self.throttle = ProcessThrottle(deploy.chef_max_concurrency, deploy.chef_process_memory_mb,
+                                        deploy.chef_memory_reserve_mb, deploy.chef_max_load_per_cpu,
+                                        deploy.chef_start_interval)
+
+        # shares one ssh connection per node between the OpenSSH processes of a converge: the rsync of knife solo and
+        # chef-solo from the bundle. knife solo runs its own sessions over net-ssh, which ignores ControlMaster
+        self.multiplexer = SSHMultiplexer(deploy.directory, deploy.cluster.ssh_user, deploy.cluster.private_key,
+                                          deploy.ssh_control_persist)
 
         # user to track thread exceptions
         self.thread_exception = False
 
-    def converge(self, runlist=None, nodes=None):
-        # type: (str, []) -> None
+        # the Chef client RPM and other artifacts, downloaded once and pushed to the nodes from the deploy host
+        self.artifacts = ArtifactCache(deploy.artifact_cache_directory)
+
+        # the cookbook bundle that nodes run chef-solo against, None when knife uploads the cookbooks to every node
+        self.bundle = CookbookBundle(deploy, self.multiplexer.config_file) \
+            if deploy.cookbook_distribution == 'bundle' else None
+
+        # runs the fingerprint checks, nodes whose fingerprint is unchanged are not converged again unless forced
+        self.fan_out = FanOut(deploy.ssh_pool, deploy.cluster.ssh_user, deploy.cluster.private_key, timeout=60,
+                              stream_output=False)
+        self.force = deploy.force_converge
+        self.payload_digest = None
+
+        # computes the operating system tuning of each node, delivered with its attributes, None when not tuning
+        self.tuning = HostTuning(deploy) if deploy.tune_hosts else None
+
+        # the status of each node in the default converge, checkpointed so that an aborted converge can be resumed
+        self.state = ConvergeState(os.path.join(deploy.directory, 'converge-state.json'))
+        self._fingerprint_lock = threading.Lock()
+
+    def converge(self, runlist=None, nodes=None, force=False):
+        # type: (str, [], bool) -> None
         """
         The main function for converging chef on a cluster or set of nodes
         :param runlist: A string that can be found in the template 
         :param nodes: The nodes to run chef upon
+        :param force: Converge every node, even the ones whose last converge had the same fingerprint
         :return: 
         """
+        self.force = force or self.deploy.force_converge
+        self.payload_digest = None
 
         if not runlist:
             # We have not recieved a custom specified runlist, run the default roles
-            self._create_runtime_recipe()
+            self.write_runtime_attributes()
+            self._remove_baked_recipes()
             self._converge_default()
         else:
             self._converge_custom(runlist, nodes)
 
-    def _create_runtime_recipe(self):
+    def write_runtime_attributes(self):
         # type: () -> None
         """
-        Creates a file to be used to inject attributes at runtime for a knife solo cook run
+        Writes the runtime attributes shared by every node to the redstack data bag, the hosts of the cluster to
+        hosts.json and the other attributes to attributes.json. The runtime recipe applies them as force overrides, the
+        values are strings as they have always been.
         """
-
-        recipe_location = '{0}/cookbooks/redstack/recipes/runtime.rb'.format(self.deploy.directory)
-        attribute_hash = {
+        attributes = {
             'redstack': {
-                'version': self.deploy.redstack_version,
-                'cluster': self.deploy.cluster.get_hosts_list()
+                'version': self.deploy.redstack_version
             },
             'ambari': {
                 'repo_version': self.deploy.ambari_version,
@@ -72,91 +124,215 @@ class Chef:
             'master_node': self.deploy.cluster.master_node.fqdn,
             'volume_device': self.deploy.volume_device,
             'mount_location': self.deploy.mount_location,
+            'preserve_data_volume': self.deploy.preserve_data_volumes,
             'ambari_mysql_password': self.deploy.ambari_db_password
         }
-        flat_hash = []
-        self._flatten_dict(attribute_hash, rv=flat_hash)
 
-        with open(recipe_location, 'w') as runtime_file:
-            runtime_file.writelines(['node.force_override' + line + '\n' for line in flat_hash])
+        data_bag_directory = os.path.join(self.deploy.directory, 'data_bags', 'redstack')
+        if not os.path.exists(data_bag_directory):
+            os.makedirs(data_bag_directory)
 
-        logger.info('Created dynamic recipe at {0}'.format(recipe_location))
+        self._write_json(os.path.join(data_bag_directory, 'attributes.json'),
+                         {'id': 'attributes', 'attributes': self._stringify(attributes)})
+        self._write_json(os.path.join(data_bag_directory, 'hosts.json'),
+                         {'id': 'hosts', 'cluster': self._stringify(self.deploy.cluster.get_hosts_list())})
 
-    def _flatten_dict(self, v, prefix='', rv=list()):
-        # type: ({} or object, str, []) -> None
+        logger.info('Created the runtime attributes at {0}'.format(data_bag_directory))
+
+        if self.tuning:
+            self.tuning.write(self.deploy.cluster.nodes)
+
+    def _remove_baked_recipes(self):
+        # type: () -> None
         """
-        Recursive function that takes a dictionary and flattens it into a list for chef attributes
-        :param v: The value to check if it's another dict
-        :param prefix: The prefix for the values when appending
-        :param rv: The return value for the end of the recursize function call
+        Removes the recipes baked into the image the nodes booted from from the roles of the deployment directory
         """
-        if isinstance(v, dict):
-            for k, v2 in v.items():
-                p2 = "{}['{}']".format(prefix, k)
-                self._flatten_dict(v2, p2, rv)
-        else:
-            rv.append('{} = {}'.format(prefix, repr(str(v))))
+        if not self.deploy.baked_recipes:
+            return
 
-    def _converge_default(self):
-        # type: () -> None
+        baked = ['recipe[{0}]'.format(recipe) for recipe in self.deploy.baked_recipes]
+        role_directory = os.path.join(self.deploy.directory, 'roles')
+
+        for role_file_name in sorted(os.listdir(role_directory)):
+            role_path = os.path.join(role_directory, role_file_name)
+            with open(role_path, 'r') as role_file:
+                role = json.load(role_file)
+
+            run_list = [entry for entry in role.get('run_list', []) if entry not in baked]
+            if run_list != role.get('run_list', []):
+                role['run_list'] = run_list
+                with open(role_path, 'w') as role_file:
+                    json.dump(role, role_file, indent=2, sort_keys=True)
+
+        logger.info('Removed the baked recipes {0} from the roles'.format(', '.join(self.deploy.baked_recipes)))
+
+    def _write_node_attributes(self, node, runlist):
+        # type: (Node, str) -> str
         """
-        Opens a thread on each server in the cluster, and calls converge_node on each one, blocks until the threads
-        are finished
+        Writes the json chef is run with on a node: the run list of the runlist file and the attributes of the node
+        :param node: The node to converge
+        :param runlist: The runlist file from runlists/ to run
+        :return: The path of the json relative to the deployment directory
         """
+        with open(os.path.join(self.deploy.directory, 'runlists', runlist), 'r') as runlist_file:
+            node_json = json.load(runlist_file)
 
-        nodes = self.deploy.cluster.nodes
-        threads = []
+        node_json['redstack_runtime'] = self._stringify(self._node_attributes(node))
 
-        for node in nodes:
-            t = Thread(target=self._converge_node, args=[node.role + '.json', node, True, True])
-            threads.append(t)
+        path = os.path.join('nodes', '{0}.json'.format(node.name))
+        self._write_json(os.path.join(self.deploy.directory, path), node_json)
+        return path
 
-        for thread in threads:
-            thread.start()
+    def _node_attributes(self, node):
+        # type: (Node) -> {}
+        """
+        :param node: The node to converge
+        :return: The runtime attributes that only apply to the node
+        """
+        attributes = {
+            'redstack': {
+                'node': {
+                    'name': node.name,
+                    'fqdn': node.fqdn,
+                    'type': node.node_type
+                }
+            }
+        }
 
-        threads_alive = len(threads)
-        while threads_alive > 0:
-            time.sleep(10)
-            threads_alive = 0
-            for thread in threads:
-                if thread.isAlive():
-                    threads_alive += 1
-            logger.info('Still executing Chef: {0} nodes remaining...'.format(threads_alive))
-            if self.thread_exception:
-                time.sleep(1)
-                os._exit(1)
+        if self.tuning:
+            attributes['redstack']['tuning'] = self.tuning.profile(node)
+
+        return attributes
+
+    @staticmethod
+    def _stringify(value):
+        # type: ({} or object) -> {} or str
+        """
+        :param value: A dictionary of attributes, or a single value
+        :return: A copy of the dictionary with every value turned into a string, or the value as a string
+        """
+        if isinstance(value, dict):
+            return dict((str(key), Chef._stringify(child)) for key, child in value.items())
+        return str(value)
+
+    @staticmethod
+    def _write_json(path, content):
+        # type: (str, {}) -> None
+        """
+        Writes json with sorted keys, the same content always gives the same bytes
+        :param path: The file to write
+        :param content: The content to write
+        """
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(path, 'w') as json_file:
+            json.dump(content, json_file, sort_keys=True, separators=(',', ':'))
+
+    def _converge_default(self, nodes=None):
+        # type: ([Node]) -> None
+        """
+        Queues each server in the cluster for converge_node as soon as it is reachable over ssh and the milestones it
+        requires are reached, and converges at most chef_max_concurrency of them at the same time, blocks until the
+        converges are finished
+        :param nodes: The nodes to converge, every node of the cluster if None. The other nodes count as converged.
+        """
+
+        if nodes is None:
+            nodes = self.deploy.cluster.nodes
+
+        scanner = SSHReadinessScanner(self.deploy.ssh_pool, self.deploy.cluster.ssh_user,
+                                      self.deploy.cluster.private_key)
+
+        milestones = MilestoneTracker(self.deploy.cluster.nodes, self.deploy.cluster.milestones, FanOut(
+            self.deploy.ssh_pool, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key, timeout=30,
+            stream_output=False))
+
+        # Nodes converged by an earlier run have reached the milestones they provide
+        for node in self.deploy.cluster.nodes:
+            if node not in nodes:
+                milestones.node_converged(node)
+
+        self.state.reset(nodes)
+        self._schedule(self._open_masters(scanner.scan(nodes)),
+                       lambda node: self._converge_node(node.role + '.json', node, True, True), len(nodes), milestones,
+                       self.state)
+
+    def resume(self):
+        # type: () -> None
+        """
+        Converges the nodes of the cluster that did not succeed in the last converge of the deployment directory, ex.
+        after it failed or was aborted
+        """
+        nodes = [node for node in self.deploy.cluster.nodes if self.state.status(node) != 'succeeded']
+        if not nodes:
+            logger.info('Every node of {0} is already converged'.format(self.deploy.name))
+            return
+
+        logger.info('Resuming the converge of {0} on {1}'.format(
+            self.deploy.name, ', '.join(node.name for node in nodes)))
+
+        self.payload_digest = None
+        self.write_runtime_attributes()
+        self._converge_default(nodes)
+
+    def _open_masters(self, ready_nodes):
+        # type: (iter) -> generator
+        """
+        Opens the ssh master connection to each node as it becomes reachable, so that its converge does not pay for
+        the key exchange
+        :param ready_nodes: An iterable of the nodes in the order they become ready
+        :return: A generator of the same nodes
+        """
+        for node in ready_nodes:
+            self.multiplexer.open(node)
+            yield node
 
-        logger.info('Nodes successfully converged')
-        
     def _converge_custom(self, runlist, nodes):
         # type: (str, []) -> None
         """
-        Opens a thread on each server in the cluster, and calls converge_node on each one, blocks until the threads
-        are finished
+        Converges the given runlist on each of the given nodes, at most chef_max_concurrency of them at the same time,
+        blocks until the converges are finished
         :param runlist: The cheflist string that maps to an item in the redstack template
         :param nodes: The nodes to run the runlist
         """
 
-        threads = []
+        self._schedule(nodes, lambda node: self._converge_node(runlist, node, False, False), len(nodes))
 
-        for node in nodes:
-            t = Thread(target=self._converge_node, args=[runlist, node, False, False])
-            threads.append(t)
+    def _schedule(self, ready_nodes, converge, node_count, milestones=None, state=None):
+        # type: (iter, any, int, MilestoneTracker, ConvergeState) -> None
+        """
+        Runs the converges through the scheduler, collecting diagnostics if any of them fails
+        :param ready_nodes: An iterable of the nodes in the order they become ready to converge
+        :param converge: The function converging a single node
+        :param node_count: How many nodes ready_nodes will produce
+        :param milestones: Tracks the milestones nodes wait for, no node waits if None
+        :param state: Checkpoints the status of each node, nothing is recorded if None
+        :raises ChefException: if a converge failed
+        """
+        scheduler = ConvergeScheduler(self.deploy.chef_max_concurrency, milestones, state=state,
+                                      throttle=self.throttle)
+        try:
+            failed = scheduler.run(ready_nodes, converge, node_count)
+        finally:
+            if self.bundle:
+                self.bundle.stop()
 
-        for thread in threads:
-            thread.start()
+        self.throttle.log_summary()
 
-        threads_alive = len(threads)
-        while threads_alive > 0:
-            time.sleep(10)
-            threads_alive = 0
-            for thread in threads:
-                if thread.isAlive():
-                    threads_alive += 1
-            logger.info('Still executing Chef: {0} nodes remaining...'.format(threads_alive))
-            if self.thread_exception:
-                time.sleep(1)
-                os._exit(1)
+        try:
+            ChefProfiler(self.deploy.directory).write()
+        except Exception:
+            logger.exception('Failed to profile the Chef converge')
+
+        if failed:
+            Diagnostics(self.deploy).collect('Chef converge failed')
+            message = 'Chef converge failed on {0}'.format(', '.join(node.name for node in failed))
+            if state:
+                message += ', resume with: python resume.py --config <rs_conf.yml> --directory {0}'.format(
+                    self.deploy.directory)
+            raise ChefException(message)
 
         logger.info('Nodes successfully converged')
 
@@ -170,18 +346,35 @@ class Chef:
         :param reformat_on_failure: if the node fails, reformat the drive and rebuild the node
         """
         try:
-            test_node_ssh_availability(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key)
+            test_node_ssh_availability(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key,
+                                       self.deploy.ssh_pool)
+
+            node_file = self._write_node_attributes(node, runlist)
+
+            fingerprint = self._fingerprint(node, runlist)
+            if not self.force and self._stored_fingerprint(node, runlist) == fingerprint:
+                logger.info("Runlist {0} is unchanged on {1} since its last converge, skipping it".format(
+                    runlist, node.name))
+                return
+            self._store_fingerprint(node, runlist, None)
 
-            knife_command = self.knife_command.format(self.deploy.cluster.private_key,
-                                                      self.deploy.cluster.ssh_user,
-                                                      node.floating_ip, runlist)
+            if self.bundle:
+                knife_command = self.bundle.solo_command(node)
+            else:
+                knife_command = self.knife_command.format(self.deploy.cluster.private_key,
+                                                          self.deploy.cluster.ssh_user,
+                                                          node.floating_ip, node_file, self.multiplexer.config_file)
 
             tries_left = self.deploy.chef_tries
             while True:
                 tries_left -= 1
 
                 if install_chef:
-                    self._install_chef(node)
+                    self.install_chef(node)
+
+                if self.bundle:
+                    self.bundle.ensure(node)
+                    self.bundle.push_node_file(node, os.path.join(self.deploy.directory, node_file))
 
                 logger.info("Executing runlist {0} on {1} for deployment {2}".format(runlist, node.name, self.deploy.name))
                 logger.info(knife_command)
@@ -189,42 +382,37 @@ class Chef:
                 process = subprocess.Popen(knife_command, cwd=self.deploy.directory, shell=True,
                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-                with open('{0}/logs/{1}-converge'.format(self.deploy.directory, node.name), 'w') as log_file:
-                    log_file.write('\n <<<<< Converging {0} - {1} >>>>> \n'.format(node.name, runlist))
-
-                    while True:
-                        nextline = process.stdout.readline()
-                        if nextline == '' and process.poll() is not None:
-                            break
-                        log_file.write(nextline)
-                        if node.primary and self.deploy.log_chef_to_stdout:
-                            logger.warning('CHEF: {0}'.format(nextline.strip('\n')))
-                        process.stdout.flush()
-
-                    if process.returncode == 0:
-                        logger.info("Runlist {0} succeeded on {1} for {2} - {3}".format(runlist, node.name,
-                                                                                        self.deploy.name,
-                                                                                        node.floating_ip))
-                        return
-                    else:
-                        logger.warning("Runlist {0} failed on {1} for {2} - {3}".format(runlist, node.name,
-                                                                                        self.deploy.name,
-                                                                                        node.floating_ip))
-                        while True:
-                            nextline = process.stderr.readline()
-                            if nextline == '' and process.poll() is not None:
-                                break
-                            log_file.write(nextline)
-
-                            logger.error('CHEF-ERROR: {0}'.format(nextline.strip('\n')))
-                            process.stderr.flush()
-
-                    if tries_left == 0:
-                        raise ChefException("Runlist {0} failed on {1} for {2} - {3}".format(
-                            runlist, node.name, self.deploy.name, node.floating_ip))
-                    elif reformat_on_failure:
-                        logger.warning("Reformatting and rebuilding {0}".format(node.name))
-                        self._rebuild_and_reformat(node)
+                echo = None
+                if node.primary and self.deploy.log_chef_to_stdout:
+                    echo = self._echo_chef_output
+
+                pumped = self.output_pump.add(node.name, process,
+                                              '{0}/logs/{1}-converge'.format(self.deploy.directory, node.name),
+                                              self.deploy.compress_chef_logs,
+                                              ' <<<<< Converging {0} - {1} >>>>> '.format(node.name, runlist), echo)
+
+                return_code = pumped.wait()
+                self.throttle.record(node.name, pumped.usage)
+
+                if return_code == 0:
+                    logger.info("Runlist {0} succeeded on {1} for {2} - {3}".format(runlist, node.name,
+                                                                                    self.deploy.name,
+                                                                                    node.floating_ip))
+                    self._store_fingerprint(node, runlist, fingerprint)
+                    return
+
+                logger.warning("Runlist {0} failed on {1} for {2} - {3}".format(runlist, node.name,
+                                                                                self.deploy.name,
+                                                                                node.floating_ip))
+                for line in pumped.tail_lines():
+                    logger.error(u'CHEF-ERROR: {0}'.format(line))
+
+                if tries_left == 0:
+                    raise ChefException("Runlist {0} failed on {1} for {2} - {3}".format(
+                        runlist, node.name, self.deploy.name, node.floating_ip))
+                elif reformat_on_failure:
+                    logger.warning("Reformatting and rebuilding {0}".format(node.name))
+                    self._rebuild_and_reformat(node)
 
                 logger.warning("Chef failed on {0}, retrying {1} more times".format(node.name, tries_left))
 
@@ -232,46 +420,127 @@ class Chef:
             self.thread_exception = True
             raise
 
-    def _install_chef(self, node):
-        # type: (Node) -> None
+    @staticmethod
+    def _echo_chef_output(stream, line):
+        # type: (str, str) -> None
         """
-        Installs chef 12.12 on the node
-        :param node: the Node we want to install chef on
+        Logs a line of Chef output, the line is decoded so the format string is unicode as well
+        :param stream: stdout or stderr
+        :param line: The line of output
+        """
+        logger.warning(u'CHEF: {0}'.format(line))
+
+    def _fingerprint(self, node, runlist):
+        # type: (Node, str) -> str
+        """
+        Computes what a converge of the runlist on the node depends on: its role, the runlist, its json with the node
+        attributes, the cookbooks, roles and data bags of the payload, which hold the shared attributes, and the Chef
+        version
+        :param node: The node to converge
+        :param runlist: The runlist to converge
+        :return: The sha256 fingerprint of the converge
+        """
+        with self._fingerprint_lock:
+            if self.payload_digest is None:
+                self.payload_digest = payload_digest(self.deploy.directory)
+
+        with open(os.path.join(self.deploy.directory, 'nodes', '{0}.json'.format(node.name)), 'rb') as node_file:
+            attributes = hashlib.sha256(node_file.read()).hexdigest()
+
+        inputs = {
+            'role': node.role,
+            'runlist': runlist,
+            'attributes': attributes,
+            'payload': self.payload_digest,
+            'chef_version': self.deploy.chef_version
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _stored_fingerprint(self, node, runlist):
+        # type: (Node, str) -> str
+        """
+        :param node: The node to read from
+        :param runlist: The runlist the fingerprint was stored for
+        :return: The fingerprint of the last successful converge of the runlist on the node, None if there is none
+        """
+        result = self.fan_out.run([node], 'cat {0}/{1} 2> /dev/null'.format(FINGERPRINT_DIRECTORY, runlist))[0]
+        return result.stdout_tail[-1].strip() if result.ok and result.stdout_tail else None
+
+    def _store_fingerprint(self, node, runlist, fingerprint):
+        # type: (Node, str, str) -> None
         """
+        Records the fingerprint of a successful converge on the node, or removes it before a converge starts so that a
+        failed converge is never skipped
+        :param node: The node to write to
+        :param runlist: The runlist of the converge
+        :param fingerprint: The fingerprint to store, None to remove it
+        """
+        path = '{0}/{1}'.format(FINGERPRINT_DIRECTORY, runlist)
+        if fingerprint:
+            command = 'sudo mkdir -p {0} && echo {1} | sudo tee {2} > /dev/null'.format(FINGERPRINT_DIRECTORY,
+                                                                                        fingerprint, path)
+        else:
+            command = 'sudo rm -f {0}'.format(path)
 
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        FanOut.check(self.fan_out.run([node], command, get_pty=True), 'Storing the converge fingerprint')
 
-        ssh.connect(node.floating_ip, username=self.deploy.cluster.ssh_user,
-                    key_filename=self.deploy.cluster.private_key, timeout=30)
+    def install_chef(self, node):
+        # type: (Node) -> None
+        """
+        Installs the Chef client on the node from the artifact cache, nothing is transferred if the node already has the
+        configured version
+        :param node: the Node we want to install chef on
+        """
+        fan_out = FanOut(self.deploy.ssh_pool, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key,
+                         timeout=600, stream_output=False)
 
         with open('{0}/logs/{1}-chefinstall.log'.format(self.deploy.directory, node.name), 'a') as log_file:
-            stdin, stdout, stderr = ssh.exec_command('curl {0} > /tmp/chef.rpm; rpm -qa | grep chef || sudo rpm '
-                                                     '-i /tmp/chef.rpm'.format(self.deploy.chef_rpm_uri), get_pty=True)
-            stdout_str = stdout.read()
-            stderr_str = stderr.read()
-            log_file.write(stdout_str)
-            log_file.write(stderr_str)
-
-            if stdout.channel.recv_exit_status() == 0:
+            installed = fan_out.run([node], 'rpm -q chef')[0]
+            if installed.ok and any(line.startswith('chef-{0}-'.format(self.deploy.chef_version))
+                                    for line in installed.stdout_tail):
+                log_file.write('Chef {0} already installed\n'.format(self.deploy.chef_version))
+                logger.info('Chef {0} already installed on {1}'.format(self.deploy.chef_version, node.name))
+                return
+
+            rpm = self.artifacts.fetch('chef', self.deploy.chef_version, self.deploy.chef_rpm_uri,
+                                       self.deploy.chef_rpm_sha256)
+            remote_rpm = '/tmp/{0}'.format(os.path.basename(rpm))
+
+            results = fan_out.upload([node], rpm, remote_rpm)
+            if results[0].ok:
+                results = fan_out.run([node], 'sudo rpm -Uvh --oldpackage --replacepkgs {0}'.format(remote_rpm),
+                                      get_pty=True)
+            result = results[0]
+
+            log_file.write('\n'.join(result.stdout_tail + result.stderr_tail) + '\n')
+
+            if result.ok:
                 if node.primary and self.deploy.log_chef_to_stdout:
-                    [logger.info(line) for line in stdout_str.split('\n')]
+                    [logger.info(line) for line in result.stdout_tail]
                 logger.info('Chef installed on ' + node.name)
             else:
-                [logger.error(line) for line in stdout_str.split('\n')]
-                [logger.error(line) for line in stderr_str.split('\n')]
-                raise ShellException("Chef failed to install on node: {0} : {1}".format(node.name, stderr_str))
-
-        ssh.close()
+                [logger.error(line) for line in result.stdout_tail]
+                [logger.error(line) for line in result.stderr_tail]
+                raise ShellException("Chef failed to install on node: {0} : {1}".format(
+                    node.name, result.error or '\n'.join(result.stderr_tail)))
 
     def _rebuild_and_reformat(self, node):
         # type: (Node) -> None
         """
-        Reformats the node and rebuilds it in Openstack
+        Reformats the node and rebuilds it in Openstack, the volume is remounted instead when data volumes are preserved
         :param node: The node to rebuild and reformat
         """
         Openstack.rebuild_node(self.deploy, node)
-        unmount(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key)
+
+        # Any pooled or master connection went down with the old image
+        self.deploy.ssh_pool.discard(node.floating_ip, self.deploy.cluster.ssh_user)
+        self.multiplexer.close(node)
+
+        if self.deploy.preserve_data_volumes:
+            remount(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key, self.deploy.ssh_pool,
+                    self.deploy.volume_device, self.deploy.mount_location)
+        else:
+            unmount(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key, self.deploy.ssh_pool)
 
 if __name__ == '__main__':
     setup_logger()
@@ -0,0 +1,255 @@
+""" Module for finding where the time of a Chef converge goes.
+
+The converge logs written by the output pump carry a timestamp on every line. Chef prints a line when it moves to a new
+recipe and when it starts each resource, so the time of a resource runs from its line to the next one. The durations
+of every node are aggregated into a cluster wide report of the slowest recipes and resources, with their median and
+95th percentile across nodes and the nodes that took much longer than the others.
+"""
+
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger("root_logger")
+
+# Lines as written by the output pump, ex. 2017-06-01 12:00:00.000 [stdout] Recipe: hdp-cloud::disk
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{3}) \[(?:stdout|stderr)\] (.*)$')
+
+# Terminal colors knife prints when it runs on a pseudo terminal
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+RECIPE_LINE = re.compile(r'^Recipe: (\S+)')
+RESOURCE_LINE = re.compile(r'^(\s*)\* (\S+?\[.*\]) action (\S+)')
+CONVERGE_START = re.compile(r'Converging \d+ resources')
+CONVERGE_END = re.compile(r'Running handlers|Chef Client (finished|failed)|Chef Run complete')
+
+
+class ChefProfiler:
+    def __init__(self, directory, top=25, outlier_factor=2.0, outlier_min_seconds=10):
+        # type: (str, int, float, float) -> None
+        """
+        Constructor for ChefProfiler
+        :param directory: The deployment directory, its converge logs are read and the report is written to it
+        :param top: How many resources to list in the report
+        :param outlier_factor: A node is an outlier for a recipe when it took this many times the median
+        :param outlier_min_seconds: A node is only an outlier when it also took this many seconds more than the median
+        """
+        self.directory = directory
+        self.top = top
+        self.outlier_factor = outlier_factor
+        self.outlier_min_seconds = outlier_min_seconds
+
+    def write(self):
+        # type: () -> {}
+        """
+        Profiles the converge logs of every node and writes chef-profile.json and chef-profile.txt to the deployment
+        directory
+        :return: The report
+        """
+        profiles = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, 'logs', '*-converge')) +
+                           glob.glob(os.path.join(self.directory, 'logs', '*-converge.gz'))):
+            node_name = re.sub(r'-converge(\.gz)?$', '', os.path.basename(path))
+            profile = self.parse(path)
+            if profile['resources']:
+                profiles[node_name] = profile
+
+        report = self.aggregate(profiles)
+
+        with open(os.path.join(self.directory, 'chef-profile.json'), 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+
+        with open(os.path.join(self.directory, 'chef-profile.txt'), 'w') as text_file:
+            text_file.write(self.format(report))
+
+        logger.info('Wrote the Chef profile of {0} nodes to {1}'.format(
+            len(profiles), os.path.join(self.directory, 'chef-profile.txt')))
+        return report
+
+    @staticmethod
+    def parse(path):
+        # type: (str) -> {}
+        """
+        Extracts the duration of each resource from a converge log
+        :param path: The converge log, gzip compressed if it ends in .gz
+        :return: The total, compile and converge seconds and the resources as (recipe, resource, action, seconds)
+        """
+        profile = {'total': 0, 'compile': 0, 'converge': 0, 'resources': []}
+
+        first = last = converge_start = None
+        recipe = None
+        # The resource being timed, as [recipe, resource, action, start, indent]
+        current = None
+
+        with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as log_file:
+            for raw in log_file:
+                match = LOG_LINE.match(raw.decode('utf-8', 'replace').rstrip('\n'))
+                if not match:
+                    continue
+
+                timestamp = datetime.datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S.%f')
+                text = ANSI_ESCAPE.sub('', match.group(2)).rstrip()
+                first = first or timestamp
+                last = timestamp
+
+                recipe_match = RECIPE_LINE.match(text.strip())
+                resource_match = RESOURCE_LINE.match(text)
+
+                # Resources notified or run from inside another resource are part of its time
+                if resource_match and current and len(resource_match.group(1)) > current[4]:
+                    continue
+
+                if recipe_match or resource_match or CONVERGE_END.search(text):
+                    if current:
+                        profile['resources'].append((current[0], current[1], current[2],
+                                                     (timestamp - current[3]).total_seconds()))
+                        current = None
+
+                if CONVERGE_START.search(text) and converge_start is None:
+                    converge_start = timestamp
+                elif recipe_match:
+                    recipe = recipe_match.group(1)
+                elif resource_match:
+                    current = [recipe or 'unknown', resource_match.group(2), resource_match.group(3), timestamp,
+                               len(resource_match.group(1))]
+
+        if current:
+            profile['resources'].append((current[0], current[1], current[2], (last - current[3]).total_seconds()))
+
+        if first:
+            profile['total'] = (last - first).total_seconds()
+            if converge_start:
+                profile['compile'] = (converge_start - first).total_seconds()
+                profile['converge'] = (last - converge_start).total_seconds()
+
+        return profile
+
+    def aggregate(self, profiles):
+        # type: ({}) -> {}
+        """
+        Aggregates the profiles of the nodes into the cluster wide report
+        :param profiles: The parsed profile of each node, by node name
+        :return: The report with the nodes, recipes and resources
+        """
+        nodes = {}
+        recipe_times = {}
+        resource_times = {}
+
+        for node_name, profile in profiles.items():
+            recipes = {}
+            for recipe, resource, action, seconds in profile['resources']:
+                recipes[recipe] = recipes.get(recipe, 0) + seconds
+                resource_times.setdefault((recipe, resource, action), {})
+                resource_times[(recipe, resource, action)][node_name] = \
+                    resource_times[(recipe, resource, action)].get(node_name, 0) + seconds
+
+            for recipe, seconds in recipes.items():
+                recipe_times.setdefault(recipe, {})[node_name] = seconds
+
+            slowest = sorted(profile['resources'], key=lambda entry: -entry[3])[:10]
+            nodes[node_name] = {
+                'total': round(profile['total'], 3),
+                'compile': round(profile['compile'], 3),
+                'converge': round(profile['converge'], 3),
+                'recipes': dict((recipe, round(seconds, 3)) for recipe, seconds in recipes.items()),
+                'slowest_resources': [{'recipe': recipe, 'resource': resource, 'action': action,
+                                       'seconds': round(seconds, 3)}
+                                      for recipe, resource, action, seconds in slowest]
+            }
+
+        recipes = []
+        for recipe, by_node in recipe_times.items():
+            entry = self._statistics(by_node)
+            entry['recipe'] = recipe
+            entry['outliers'] = [{'node': node_name, 'seconds': round(seconds, 3)}
+                                 for node_name, seconds in sorted(by_node.items(), key=lambda item: -item[1])
+                                 if seconds > entry['p50'] * self.outlier_factor
+                                 and seconds - entry['p50'] > self.outlier_min_seconds]
+            recipes.append(entry)
+
+        resources = []
+        for (recipe, resource, action), by_node in resource_times.items():
+            entry = self._statistics(by_node)
+            entry.update({'recipe': recipe, 'resource': resource, 'action': action})
+            resources.append(entry)
+
+        return {
+            'nodes': nodes,
+            'recipes': sorted(recipes, key=lambda entry: (-entry['total'], entry['recipe'])),
+            'resources': sorted(resources, key=lambda entry: (-entry['p95'], entry['resource']))[:self.top]
+        }
+
+    @staticmethod
+    def _statistics(by_node):
+        # type: ({}) -> {}
+        """
+        :param by_node: Seconds by node name
+        :return: The node count, total, median, 95th percentile and maximum, with the slowest node
+        """
+        values = sorted(by_node.values())
+        slowest_node = max(by_node, key=lambda node_name: by_node[node_name])
+
+        return {
+            'nodes': len(values),
+            'total': round(sum(values), 3),
+            'p50': round(ChefProfiler._percentile(values, 50), 3),
+            'p95': round(ChefProfiler._percentile(values, 95), 3),
+            'max': round(values[-1], 3),
+            'slowest_node': slowest_node
+        }
+
+    @staticmethod
+    def _percentile(values, percent):
+        # type: ([float], int) -> float
+        """
+        :param values: Sorted values
+        :param percent: The percentile to take
+        :return: The nearest rank percentile of the values
+        """
+        rank = max(int(round(percent / 100.0 * len(values) + 0.5)) - 1, 0)
+        return values[min(rank, len(values) - 1)]
+
+    @staticmethod
+    def format(report):
+        # type: ({}) -> str
+        """
+        :param report: The report to format
+        :return: The report as a readable text
+        """
+        lines = ['Chef converge profile of {0} nodes'.format(len(report['nodes'])), '']
+
+        if report['nodes']:
+            totals = sorted(report['nodes'].items(), key=lambda item: -item[1]['total'])
+            lines.append('Slowest nodes: ' + ', '.join('{0} {1:.0f}s'.format(node_name, node['total'])
+                                                       for node_name, node in totals[:5]))
+            lines.append('')
+
+        lines.append('{0:<50} {1:>6} {2:>10} {3:>10} {4:>10}  {5}'.format('Recipe', 'Nodes', 'p50', 'p95', 'Max',
+                                                                          'Slowest node'))
+        for recipe in report['recipes']:
+            lines.append('{0:<50} {1:>6} {2:>9.1f}s {3:>9.1f}s {4:>9.1f}s  {5}'.format(
+                recipe['recipe'], recipe['nodes'], recipe['p50'], recipe['p95'], recipe['max'],
+                recipe['slowest_node']))
+            for outlier in recipe['outliers'][:5]:
+                lines.append('    outlier {0} {1:.1f}s'.format(outlier['node'], outlier['seconds']))
+
+        lines.extend(['', '{0:<70} {1:>10} {2:>10}  {3}'.format('Resource', 'p50', 'p95', 'Recipe')])
+        for resource in report['resources']:
+            lines.append('{0:<70} {1:>9.1f}s {2:>9.1f}s  {3}'.format(
+                '{0} {1}'.format(resource['resource'], resource['action'])[:70], resource['p50'], resource['p95'],
+                resource['recipe']))
+
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    from helper_functions import parse_args, setup_logger
+
+    setup_logger()
+    args = parse_args()
+
+    print(ChefProfiler.format(ChefProfiler(args.directory).write()))
@@ -0,0 +1,191 @@
+""" Module for collecting logs from the nodes of a deployment.
+
+Collection runs on every node in parallel. Each node copies the newest part of its Chef, Ambari and Hadoop logs, along
+with a snapshot of the system state, into a compressed archive. The archives are then downloaded to
+logs/diagnostics/<time> in the deployment directory, within a total size cap.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+from domain.deploy import Deploy
+from domain.node import Node
+from fanout import FanOut, HostResult
+
+logger = logging.getLogger("root_logger")
+
+# Log locations collected from every node, the ones that do not exist on a node are skipped
+LOG_PATHS = [
+    '/var/chef/cache',
+    '/var/log/ambari-agent',
+    '/var/log/ambari-server',
+    '/var/log/hadoop',
+    '/var/log/hadoop-yarn',
+    '/var/log/hadoop-mapreduce',
+    '/var/log/hive',
+    '/var/log/hbase',
+    '/var/log/zookeeper',
+    '/var/log/spark',
+    '/var/log/knox',
+    '/var/log/messages'
+]
+
+REMOTE_ARCHIVE = '/tmp/redstack-diagnostics.tar.gz'
+REMOTE_STAGING = '/tmp/redstack-diagnostics'
+
+# Logs compress well, so each node may stage several times its share of the compressed size cap
+COMPRESSION_RATIO = 5
+
+
+class Diagnostics:
+    def __init__(self, deploy, max_size_mb=None, max_file_size_mb=10, concurrency=32, timeout=300):
+        # type: (Deploy, int, int, int, int) -> None
+        """
+        Constructor for Diagnostics
+        :param deploy: The current deploy
+        :param max_size_mb: Cap on the total size of the downloaded archives, defaults to diagnostics_max_size_mb
+        :param max_file_size_mb: Only the last part of a larger log file is collected
+        :param concurrency: How many nodes to collect from at the same time
+        :param timeout: Seconds the archive and download may take on a single node
+        """
+        self.deploy = deploy
+        self.max_size = (max_size_mb or deploy.diagnostics_max_size_mb) * 1048576
+        self.max_file_size = max_file_size_mb * 1048576
+
+        self.fan_out = FanOut(deploy.ssh_pool, deploy.cluster.ssh_user, deploy.cluster.private_key,
+                              concurrency=concurrency, timeout=timeout, stream_output=False)
+
+    def collect(self, reason, nodes=None):
+        # type: (str, [Node]) -> str
+        """
+        Collects the logs of the given nodes. Failures are logged and never raised, so collecting after a failed
+        deploy does not hide the original error.
+        :param reason: Why the logs are collected, written to the summary
+        :param nodes: The nodes to collect from, defaults to every node of the cluster
+        :return: The directory the archives were downloaded to
+        """
+        nodes = nodes or self.deploy.cluster.nodes
+        directory = os.path.join(self.deploy.directory, 'logs', 'diagnostics', time.strftime('%Y%m%d-%H%M%S'))
+
+        logger.info('Collecting diagnostics from {0} nodes to {1} - {2}'.format(len(nodes), directory, reason))
+
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            archive_results = self.fan_out.run(nodes, self._archive_command(len(nodes)), get_pty=True)
+            selected = self._select_within_cap(archive_results)
+            download_results = self.fan_out.download([result.node for result in selected], REMOTE_ARCHIVE, directory)
+
+            self._write_summary(directory, reason, archive_results, download_results)
+        except Exception:
+            logger.exception('Collecting diagnostics failed')
+
+        return directory
+
+    def _archive_command(self, node_count):
+        # type: (int) -> str
+        """
+        Returns the shell command that archives the logs on a node. The newest files are staged first, each cut to its
+        last max_file_size bytes, until the staged size reaches the share of the node.
+        :param node_count: The number of nodes collected from, each gets an equal share of the cap
+        :return: The command to run on every node
+        """
+        budget = self.max_size * COMPRESSION_RATIO // node_count
+
+        return ' '.join([
+            'sudo rm -rf {staging} {archive}; mkdir -p {staging};',
+            '{{ date; uptime; df -h; free -m; sudo ambari-agent status; ps aux --sort=-%mem | head -50; }}',
+            '> {staging}/system.txt 2>&1;',
+            'used=0;',
+            'sudo find {paths} -type f -printf "%T@ %s %p\\n" 2>/dev/null | sort -rn |',
+            'while read mtime size path; do',
+            'take=$(( size < {file_size} ? size : {file_size} ));',
+            'if [ $(( used + take )) -gt {budget} ]; then break; fi;',
+            'mkdir -p "{staging}$(dirname "$path")";',
+            'sudo tail -c {file_size} "$path" > "{staging}$path";',
+            'used=$(( used + take ));',
+            'done;',
+            'tar czf {archive} -C {staging} . && rm -rf {staging} && stat -c %s {archive}'
+        ]).format(staging=REMOTE_STAGING, archive=REMOTE_ARCHIVE, paths=' '.join(LOG_PATHS),
+                  file_size=self.max_file_size, budget=budget)
+
+    def _select_within_cap(self, archive_results):
+        # type: ([HostResult]) -> [HostResult]
+        """
+        Picks the archives to download, smallest first, until the total size cap is reached
+        :param archive_results: The results of the archive command, with the archive size as the last line of output
+        :return: The results of the nodes whose archive fits
+        """
+        sized = []
+        for result in archive_results:
+            if not result.ok:
+                logger.warning('Could not archive logs on {0} - {1}'.format(
+                    result.node.name, result.error or 'exit status {0}'.format(result.exit_status)))
+                continue
+            try:
+                sized.append((int(result.stdout_tail[-1].strip()), result))
+            except (IndexError, ValueError):
+                logger.warning('Could not read the archive size on {0}'.format(result.node.name))
+
+        selected = []
+        total = 0
+        for size, result in sorted(sized, key=lambda item: item[0]):
+            if total + size > self.max_size:
+                logger.warning('Skipping logs of {0}, {1}MB would exceed the cap of {2}MB'.format(
+                    result.node.name, size // 1048576, self.max_size // 1048576))
+                continue
+            total += size
+            selected.append(result)
+
+        return selected
+
+    def _write_summary(self, directory, reason, archive_results, download_results):
+        # type: (str, str, [HostResult], [HostResult]) -> None
+        """
+        Writes what was collected from each node to summary.json in the diagnostics directory
+        :param directory: The diagnostics directory
+        :param reason: Why the logs were collected
+        :param archive_results: The results of the archive command
+        :param download_results: The results of the downloads
+        """
+        downloads = dict((result.node.name, result) for result in download_results)
+
+        summary = {
+            'deploy': self.deploy.name,
+            'reason': reason,
+            'nodes': [
+                {
+                    'archive': result.to_dict(),
+                    'download': downloads[result.node.name].to_dict() if result.node.name in downloads else None
+                } for result in archive_results
+            ]
+        }
+
+        with open(os.path.join(directory, 'summary.json'), 'w') as summary_file:
+            summary_file.write(json.dumps(summary, indent=2))
+
+        logger.info('Collected diagnostics from {0} of {1} nodes to {2}'.format(
+            len([result for result in download_results if result.ok]), len(archive_results), directory))
+
+
+if __name__ == '__main__':
+    from domain.cluster import Cluster
+    from helper_functions import parse_args, setup_logger
+
+    setup_logger()
+    args = parse_args()
+
+    # The diagnostics go to the logs of the existing deployment
+    if not args.directory:
+        sys.exit('usage: diagnostics.py --config CONFIG --cluster CLUSTER --directory DEPLOYMENT_DIRECTORY '
+                 '[--node-types TYPE[,TYPE...]]')
+
+    cluster = Cluster(json_file=args.cluster)
+    deploy = Deploy(config_file=args.config, cluster=cluster, directory=args.directory)
+    nodes = cluster.select_nodes(node_types=args.node_types.split(',') if args.node_types else None)
+
+    Diagnostics(deploy, concurrency=args.concurrency).collect('on demand', nodes)
@@ -30,22 +30,13 @@ class Cluster:
                 self.private_key = cluster_dict['private_key']
                 self.key_name = cluster_dict['key_name']
                 self.cluster_name = cluster_dict['cluster_name']
-                self.master_node = Node(
-                    name=cluster_dict['master_node']['name'], fqdn=cluster_dict['master_node']['fqdn'],
-                    internal_ip=cluster_dict['master_node']['internal_ip'],
-                    floating_ip=cluster_dict['master_node']['floating_ip'], ram=cluster_dict['master_node']['ram'],
-                    role=cluster_dict['master_node']['role'], volume_size=cluster_dict['master_node']['volume_size'],
-                    flavor=cluster_dict['master_node']['flavor'],
-                    ambari_group=cluster_dict['master_node']['ambari_group'],
-                    primary=cluster_dict['master_node']['primary']
-                )
+                self.milestones = cluster_dict.get('milestones', {})
 
                 self.nodes = []
                 for node_dict in cluster_dict['nodes']:
-                    node = Node(name=node_dict['name'], fqdn=node_dict['fqdn'], internal_ip=node_dict['internal_ip'],
-                                floating_ip=node_dict['floating_ip'], ram=node_dict['ram'], role=node_dict['role'],
-                                volume_size=node_dict['volume_size'], flavor=node_dict['flavor'],
-                                ambari_group=node_dict['ambari_group'], primary=node_dict['primary'])
+                    node = self._node_from_dict(node_dict)
+                    if node.primary:
+                        self.master_node = node
                     self.nodes.append(node)
 
         # If we are passed kwargs instead, initialize with those
@@ -59,6 +50,7 @@ class Cluster:
 
             with open(template_file, 'r') as template_yaml_file:
                 template_dictionary = yaml.load(template_yaml_file)
+                self.milestones = template_dictionary.get('milestones', {})
 
                 # Build initial nodes
                 for node_spec, node_properties in template_dictionary['nodes'].iteritems():
@@ -78,15 +70,36 @@ class Cluster:
                         node_flavor = node_properties['flavor']
                         ambari_group = node_properties['ambari_group']
                         node_primary = True if node_name == template_dictionary['primary'] else False
+                        node_priority = node_properties.get('priority', 1)
+                        node_requires = node_properties.get('requires', [])
+                        node_provides = node_properties.get('provides', [])
 
                         node = Node(name=node_name, ambari_group=ambari_group, fqdn=node_fqdn, role=node_role,
-                                    volume_size=node_volume_size, flavor=node_flavor, primary=node_primary)
+                                    volume_size=node_volume_size, flavor=node_flavor, primary=node_primary,
+                                    node_type=node_spec, priority=node_priority, requires=node_requires,
+                                    provides=node_provides)
 
                         if node_primary:
                             self.master_node = node
 
                         self.nodes.append(node)
 
+    @staticmethod
+    def _node_from_dict(node_dict):
+        # type: ({}) -> Node
+        """
+        Create a node from its json representation
+        :param node_dict: A dictionary of node attributes as written by to_json
+        :return: A node object
+        """
+        return Node(name=node_dict['name'], fqdn=node_dict['fqdn'], internal_ip=node_dict['internal_ip'],
+                    server_id=node_dict.get('server_id'), floating_ip=node_dict['floating_ip'],
+                    ram=node_dict['ram'], role=node_dict['role'], volume_size=node_dict['volume_size'],
+                    flavor=node_dict['flavor'], ambari_group=node_dict['ambari_group'],
+                    primary=node_dict['primary'], node_type=node_dict.get('node_type'),
+                    priority=node_dict.get('priority', 1), requires=node_dict.get('requires'),
+                    provides=node_dict.get('provides'), vcpus=node_dict.get('vcpus'))
+
     def to_json(self):
         # type: () -> str
         """
@@ -101,6 +114,7 @@ class Cluster:
                 node.__dict__ for node in self.nodes
             ],
             'cluster_name': self.cluster_name,
+            'milestones': self.milestones,
             'master_node': self.master_node.__dict__
         })
 
@@ -134,3 +148,25 @@ class Cluster:
                 return node
 
         raise NodeNotFoundException('Node not found in cluster node list')
+
+    def select_nodes(self, names=None, node_types=None, roles=None, ambari_groups=None):
+        # type: ([str], [str], [str], [str]) -> [Node]
+        """
+        Returns the nodes matching every given filter, a filter that is not given matches all nodes
+        :param names: Node names, ex. rs-data1
+        :param node_types: Node type names from the template file, ex. rs-data
+        :param roles: Chef roles, ex. hdp-data
+        :param ambari_groups: Ambari host groups, ex. datanodes
+        :return: A list of node objects
+        """
+        nodes = [node for node in self.nodes
+                 if (names is None or node.name in names)
+                 and (node_types is None or node.node_type in node_types)
+                 and (roles is None or node.role in roles)
+                 and (ambari_groups is None or node.ambari_group in ambari_groups)]
+
+        if not nodes:
+            raise NodeNotFoundException('No nodes matching names {0}, types {1}, roles {2} and groups {3} found in '
+                                        'cluster node list'.format(names, node_types, roles, ambari_groups))
+
+        return nodes
@@ -4,19 +4,22 @@ import time
 
 import yaml
 
+import retry_policy
 from cluster import Cluster
+from ssh import SSHPool
 
 logger = logging.getLogger('root_logger')
 
 
 class Deploy:
 
-    def __init__(self, config_file=None, cluster=None):
-        # type: (str, Cluster) -> None
+    def __init__(self, config_file=None, cluster=None, directory=None):
+        # type: (str, Cluster, str) -> None
         """
         Constructor for Deploy
         :param config_file: location of the rs-conf.yml file
         :param cluster: A cluster object to initialize with
+        :param directory: An existing deployment directory to continue, ex. to resume a converge
         """
 
         # Read main configuration file
@@ -27,6 +30,8 @@ class Deploy:
         self.directory_base = config_dict['deployment_directory_base']
         self.installation_directory = config_dict['installation_directory']
         self.cookbook_directory = config_dict['cookbook_directory']
+        self.artifact_cache_directory = config_dict.get('artifact_cache_directory',
+                                                        os.path.join(self.directory_base, 'cache'))
 
         self.log_path = config_dict['log_path']
         self.log_level = config_dict['log_level']
@@ -35,6 +40,15 @@ class Deploy:
 
         self.auth_version = config_dict['auth_version']
         self.image_name = config_dict['image_name']
+
+        # Recipes baked into an image by bake.py, deploys boot from the image baked for their payload when there is one
+        self.bake_recipes = config_dict.get('bake_recipes', [])
+        self.bake_flavor = config_dict.get('bake_flavor')
+        self.use_baked_image = config_dict.get('use_baked_image', True)
+        self.bake_base_image = self.image_name
+
+        # To be set to bake_recipes when the nodes boot from a baked image
+        self.baked_recipes = []
         self.availability_zone = config_dict['availability_zone']
         self.region = config_dict['region']
 
@@ -55,20 +69,27 @@ class Deploy:
         self.ost_domain = config_dict['ost_domain']
 
         self.use_existing_openstack = config_dict['use_existing_openstack']
+        self.reuse_existing_stack = config_dict.get('reuse_existing_stack', False)
+        self.preserve_data_volumes = config_dict.get('preserve_data_volumes', False)
 
         self.key_name = config_dict['key_name']
 
         self.stack_type = config_dict['stack_type']
 
         self.template_name = config_dict['template_file']
+        self.heat_template_format = config_dict.get('heat_template_format', 'json')
 
         self.hdp_major_version = config_dict['hdp_major_version']
         self.hdp_version = config_dict['hdp_version']
         self.hdp_utils_version = config_dict['hdp_utils']
         self.define_custom_repos = config_dict['define_custom_repos']
+        self.package_mirror = config_dict.get('package_mirror')
+        self.package_mirror_port = config_dict.get('package_mirror_port', 8090)
 
         self.ambari_version = config_dict['ambari_version']
         self.ambari_password = config_dict['ambari_password']
+        self.ambari_connect_timeout = config_dict.get('ambari_connect_timeout', 10)
+        self.ambari_read_timeout = config_dict.get('ambari_read_timeout', 120)
 
         self.fqdn_address = config_dict['fqdn_address']
         self.kerberos_realm = config_dict['kerberos_realm']
@@ -76,24 +97,51 @@ class Deploy:
 
         self.volume_device = config_dict['volume_device']
         self.mount_location = config_dict['mount_location']
+        self.tune_hosts = config_dict.get('tune_hosts', True)
 
         self.chef_rpm_uri = config_dict['chef_rpm_uri']
         self.chef_version = config_dict['chef_version']
+        self.chef_rpm_sha256 = config_dict.get('chef_rpm_sha256')
         self.chef_tries = config_dict['chef_tries']
+        self.chef_max_concurrency = config_dict.get('chef_max_concurrency', 32)
+        self.chef_process_memory_mb = config_dict.get('chef_process_memory_mb', 200)
+        self.chef_memory_reserve_mb = config_dict.get('chef_memory_reserve_mb', 512)
+        self.chef_max_load_per_cpu = config_dict.get('chef_max_load_per_cpu', 2.0)
+        self.chef_start_interval = config_dict.get('chef_start_interval', 0.25)
+        self.force_converge = config_dict.get('force_converge', False)
+        self.cookbook_distribution = config_dict.get('cookbook_distribution', 'knife')
+        self.bundle_seed_count = config_dict.get('bundle_seed_count', 3)
+        self.ssh_control_persist = config_dict.get('ssh_control_persist', '15m')
         self.log_chef_to_stdout = config_dict['log_chef_to_stdout']
+        self.compress_chef_logs = config_dict.get('compress_chef_logs', False)
+
+        self.diagnostics_max_size_mb = config_dict.get('diagnostics_max_size_mb', 512)
 
         self.ambari_db_password = config_dict['ambari_db_password']
         self.mysql_root_password = config_dict['mysql_root_password']
 
+        self.retry_policies = config_dict.get('retry_policies', {})
+        retry_policy.configure(self.retry_policies)
+
         # To be set when the blueprints are created
         self.blueprint = None
         self.host_mapping = None
         self.stack_definition = None
         self.utils_definition = None
 
-        # Set the deploy name and directory based on the current time
-        self.name = "{0}-{1}".format(config_dict["cluster_name"], str(int(time.time())))
-        self.directory = os.path.join(config_dict['deployment_directory_base'], self.name)
+        # To be set when the heat template is generated
+        self.template_fingerprint = None
+
+        # Shared by every remote operation of the deploy
+        self.ssh_pool = SSHPool()
+
+        # Set the deploy name and directory based on the current time, or on the existing deployment directory
+        if directory:
+            self.name = os.path.basename(os.path.normpath(directory))
+            self.directory = directory
+        else:
+            self.name = "{0}-{1}".format(config_dict["cluster_name"], str(int(time.time())))
+            self.directory = os.path.join(config_dict['deployment_directory_base'], self.name)
 
         # Initialize the cluster object based on whether or not a cluster json file was passed
         if not cluster:
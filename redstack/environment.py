@@ -10,9 +10,28 @@ import os
 import shutil
 
 from domain.deploy import Deploy
+from ssh import SSHMultiplexer
+from tuning import TUNING_RECIPE
 
 logger = logging.getLogger("root_logger")
 
+# Applies the runtime attributes Chef writes to the redstack data bag and to the json of each node as force overrides.
+# It is the same for every deployment, only the attributes it reads change.
+RUNTIME_RECIPE = """runtime = data_bag_item('redstack', 'attributes')['attributes'].to_hash
+runtime['redstack'] = (runtime['redstack'] || {}).merge('cluster' => data_bag_item('redstack', 'hosts')['cluster'])
+
+apply = lambda do |path, value|
+  if value.is_a?(Hash)
+    value.each { |key, child| apply.call(path + [key], child) }
+  else
+    path[0..-2].inject(node.force_override) { |attributes, key| attributes[key] }[path.last] = value
+  end
+end
+
+apply.call([], runtime)
+apply.call([], node['redstack_runtime'].to_hash) if node['redstack_runtime']
+"""
+
 
 class Environment:
     def __init__(self, deploy):
@@ -36,7 +55,6 @@ class Environment:
         shutil.copytree(self.deploy.cookbook_directory, os.path.join(self.deploy.directory, 'cookbooks'))
         shutil.copytree(os.path.join(self.deploy.installation_directory, 'conf', 'users'),
                         os.path.join(self.deploy.directory, 'data_bags', 'users'))
-        os.makedirs(os.path.join(self.deploy.directory, 'cookbooks', 'redstack', 'recipes'))
         os.makedirs(os.path.join(self.deploy.directory, 'logs', 'ambari'))
 
         # write blueprint
@@ -48,6 +66,8 @@ class Environment:
             file.write(json.dumps(self.deploy.host_mapping))
 
         self._create_knife_rb()
+        self._create_ssh_config()
+        self._create_runtime_recipe()
 
         # If an existing openstack key is being used, copy the key to the deployment directory and update key name
         if self.deploy.key_name:
@@ -80,3 +100,27 @@ class Environment:
 
         with open(os.path.join(self.deploy.directory, "knife.rb"), 'w') as knife_rb:
             knife_rb.write(contents)
+
+    def _create_runtime_recipe(self):
+        """
+        Writes the recipes that apply the runtime attributes and the tuning profile, the cookbook directory may already
+        have a redstack cookbook
+        :return: None
+        """
+        recipe_directory = os.path.join(self.deploy.directory, 'cookbooks', 'redstack', 'recipes')
+        if not os.path.exists(recipe_directory):
+            os.makedirs(recipe_directory)
+
+        with open(os.path.join(recipe_directory, 'runtime.rb'), 'w') as runtime_file:
+            runtime_file.write(RUNTIME_RECIPE)
+
+        with open(os.path.join(recipe_directory, 'tuning.rb'), 'w') as tuning_file:
+            tuning_file.write(TUNING_RECIPE)
+
+    def _create_ssh_config(self):
+        """
+        Writes the ssh_config that lets the rsync of knife solo and chef-solo share one ssh connection per node
+        :return: None
+        """
+        SSHMultiplexer(self.deploy.directory, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key,
+                       self.deploy.ssh_control_persist).write_config()
@@ -62,3 +62,31 @@ class ConfigException(Exception):
     Exception that indicates something was misconfigured in the config file
     """
     pass
+
+
+class ResizeException(Exception):
+    """
+    Exception indicating that a node failed to resize in Openstack, or failed to react to an API call
+    """
+    pass
+
+
+class CircuitOpenException(Exception):
+    """
+    Exception indicating that a service failed too often in a row, and calls to it are failing fast
+    """
+    pass
+
+
+class ArtifactException(Exception):
+    """
+    Exception indicating that an artifact could not be downloaded, or does not match its checksum
+    """
+    pass
+
+
+class BakeException(Exception):
+    """
+    Exception indicating that a golden image could not be baked
+    """
+    pass
@@ -0,0 +1,326 @@
+""" Module for running a command or transferring a file on many nodes at once.
+
+A FanOut runs one command or file transfer on a set of nodes over the pooled ssh connections of the deploy, with at
+most a given number of hosts in flight, a timeout per host, and the output of every host streamed to the log as it
+arrives. Each host gets a HostResult with its exit status, the last lines of its output and how long it took.
+"""
+
+import logging
+import os
+import socket
+import time
+from collections import deque
+from Queue import Queue, Empty
+from threading import Thread
+
+import retry_policy
+from domain.node import Node
+from ssh import SSHPool, SSH_EXCEPTIONS
+
+from redstack.exceptions import ShellException
+
+logger = logging.getLogger("root_logger")
+
+
+class HostResult:
+    def __init__(self, node, exit_status=None, stdout_tail=None, stderr_tail=None, duration=0, error=None):
+        # type: (Node, int, [str], [str], float, str) -> None
+        """
+        Constructor for HostResult
+        :param node: The node the operation ran on
+        :param exit_status: The exit status of the command, None if it did not finish
+        :param stdout_tail: The last lines of stdout
+        :param stderr_tail: The last lines of stderr
+        :param duration: Seconds the operation took on the host
+        :param error: Why the operation did not finish, ex. a timeout or a connection failure
+        """
+        self.node = node
+        self.exit_status = exit_status
+        self.stdout_tail = stdout_tail or []
+        self.stderr_tail = stderr_tail or []
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self):
+        # type: () -> bool
+        """
+        :return: True if the operation finished with exit status 0
+        """
+        return self.error is None and self.exit_status == 0
+
+    def to_dict(self):
+        # type: () -> {}
+        """
+        :return: A dictionary representation of the result, for logging as json
+        """
+        return {
+            'node': self.node.name,
+            'exit_status': self.exit_status,
+            'stdout_tail': self.stdout_tail,
+            'stderr_tail': self.stderr_tail,
+            'duration': round(self.duration, 3),
+            'error': self.error
+        }
+
+
+class FanOut:
+    def __init__(self, ssh_pool, ssh_user, private_key, concurrency=32, timeout=600, tail_lines=20,
+                 stream_output=True):
+        # type: (SSHPool, str, str, int, int, int, bool) -> None
+        """
+        Constructor for FanOut
+        :param ssh_pool: The ssh connection pool of the deploy
+        :param ssh_user: The user to ssh with
+        :param private_key: The key to ssh with
+        :param concurrency: The most hosts to run on at the same time
+        :param timeout: Seconds an operation may take on a single host
+        :param tail_lines: How many of the last lines of stdout and stderr to keep per host
+        :param stream_output: Whether to log every line of output as it arrives, prefixed with the node name
+        """
+        self.ssh_pool = ssh_pool
+        self.ssh_user = ssh_user
+        self.private_key = private_key
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.tail_lines = tail_lines
+        self.stream_output = stream_output
+
+        # Not helper_functions.retry, which builds on this module for its remote helpers
+        self.retry_policy = retry_policy.get_policy('ssh')
+
+    def run(self, nodes, command, get_pty=False):
+        # type: ([Node], str, bool) -> [HostResult]
+        """
+        Runs a command on every node
+        :param nodes: The nodes to run the command on
+        :param command: The command to run
+        :param get_pty: Whether to request a pseudo terminal, needed for sudo on images that require a tty
+        :return: The result of every node, in the order of the nodes
+        """
+        return self._fan_out(nodes, self._execute, command, get_pty)
+
+    def upload(self, nodes, local_path, remote_path):
+        # type: ([Node], str, str) -> [HostResult]
+        """
+        Uploads a file to every node over sftp
+        :param nodes: The nodes to upload to
+        :param local_path: The file to upload
+        :param remote_path: Where to put the file on the nodes
+        :return: The result of every node, in the order of the nodes
+        """
+        return self._fan_out(nodes, self._transfer, local_path, remote_path, True)
+
+    def download(self, nodes, remote_path, local_directory):
+        # type: ([Node], str, str) -> [HostResult]
+        """
+        Downloads a file from every node over sftp, each to <node name>-<file name> in the local directory
+        :param nodes: The nodes to download from
+        :param remote_path: The file to download from the nodes
+        :param local_directory: Where to put the downloaded files
+        :return: The result of every node, in the order of the nodes
+        """
+        return self._fan_out(nodes, lambda node: self._transfer(
+            node, os.path.join(local_directory, '{0}-{1}'.format(node.name, os.path.basename(remote_path))),
+            remote_path, False))
+
+    @staticmethod
+    def check(results, action):
+        # type: ([HostResult], str) -> None
+        """
+        Logs every failed host with the end of its output, and raises if there was any
+        :param results: The results of an operation
+        :param action: What the operation did, for the logs and the exception
+        :raises ShellException: if the operation failed on any host
+        """
+        failed = [result for result in results if not result.ok]
+
+        for result in failed:
+            reason = result.error or 'exit status {0}'.format(result.exit_status)
+            logger.error('{0} failed on {1} - {2}'.format(action, result.node.name, reason))
+            for line in result.stderr_tail or result.stdout_tail:
+                logger.error('{0}: {1}'.format(result.node.name, line))
+
+        if failed:
+            raise ShellException('{0} failed on {1} of {2} nodes: {3}'.format(
+                action, len(failed), len(results), ', '.join([result.node.name for result in failed])))
+
+    def _fan_out(self, nodes, operation, *args):
+        # type: ([Node], any, args) -> [HostResult]
+        """
+        Runs an operation on every node with at most self.concurrency workers
+        :param nodes: The nodes to run on
+        :param operation: The per host operation, called with the node and args and returning a HostResult
+        :param args: args to pass to the operation
+        :return: The result of every node, in the order of the nodes
+        """
+        start = time.time()
+        pending = Queue()
+        for node in nodes:
+            pending.put(node)
+
+        results = {}
+
+        def worker():
+            while True:
+                try:
+                    node = pending.get_nowait()
+                except Empty:
+                    return
+
+                try:
+                    results[node.name] = operation(node, *args)
+                except Exception as e:
+                    logger.exception('Unexpected failure on {0}'.format(node.name))
+                    results[node.name] = HostResult(node, error='unexpected failure: {0}'.format(e))
+
+        workers = [Thread(target=worker) for _ in range(min(self.concurrency, len(nodes)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        ordered = [results[node.name] for node in nodes]
+
+        # Single node operations, ex. the fingerprint and milestone checks of a converge, would flood the log
+        if len(nodes) > 1:
+            logger.info('Ran on {0} nodes in {1:.1f}s, {2} failed'.format(
+                len(nodes), time.time() - start, len([result for result in ordered if not result.ok])))
+
+        return ordered
+
+    def _execute(self, node, command, get_pty):
+        # type: (Node, str, bool) -> HostResult
+        """
+        Runs a command on a single node, streaming its output until it exits or the timeout passes
+        :param node: The node to run the command on
+        :param command: The command to run
+        :param get_pty: Whether to request a pseudo terminal
+        :return: The result of the node
+        """
+        start = time.time()
+        stdout_tail = deque(maxlen=self.tail_lines)
+        stderr_tail = deque(maxlen=self.tail_lines)
+
+        try:
+            stdin, stdout, stderr = self.retry_policy.call(self.ssh_pool.exec_command, SSH_EXCEPTIONS,
+                                                           node.floating_ip, self.ssh_user, self.private_key,
+                                                           command, get_pty=get_pty)
+        except SSH_EXCEPTIONS as e:
+            return HostResult(node, duration=time.time() - start, error='connection failed: {0}'.format(e))
+
+        channel = stdout.channel
+        streams = [(channel.recv_ready, channel.recv, stdout_tail, ['']),
+                   (channel.recv_stderr_ready, channel.recv_stderr, stderr_tail, [''])]
+
+        try:
+            while True:
+                # Checked before reading, a command that never stops printing must time out as well
+                if time.time() - start > self.timeout:
+                    channel.close()
+                    return HostResult(node, stdout_tail=list(stdout_tail), stderr_tail=list(stderr_tail),
+                                      duration=time.time() - start, error='timed out after {0}s'.format(self.timeout))
+
+                received = False
+                for ready, receive, tail, partial in streams:
+                    if ready():
+                        received = True
+                        self._collect(node, receive(32768), tail, partial)
+
+                if not received:
+                    if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                        break
+                    time.sleep(0.05)
+        except SSH_EXCEPTIONS as e:
+            return HostResult(node, stdout_tail=list(stdout_tail), stderr_tail=list(stderr_tail),
+                              duration=time.time() - start, error='connection lost: {0}'.format(e))
+
+        # Flush the lines that did not end in a newline
+        for ready, receive, tail, partial in streams:
+            if partial[0]:
+                self._collect(node, b'\n', tail, partial)
+
+        return HostResult(node, exit_status=channel.recv_exit_status(), stdout_tail=list(stdout_tail),
+                          stderr_tail=list(stderr_tail), duration=time.time() - start)
+
+    def _collect(self, node, data, tail, partial):
+        # type: (Node, bytes, deque, [str]) -> None
+        """
+        Splits received output into lines, logging and keeping the complete ones
+        :param node: The node the output came from
+        :param data: The received output
+        :param tail: The tail to keep the lines in
+        :param partial: A one element list holding the incomplete last line of the previous call
+        """
+        lines = (partial[0] + data.decode('utf-8', 'replace')).split('\n')
+        partial[0] = lines.pop()
+
+        for line in lines:
+            line = line.rstrip('\r')
+            tail.append(line)
+            if self.stream_output:
+                logger.info('{0}: {1}'.format(node.name, line))
+
+    def _transfer(self, node, local_path, remote_path, upload):
+        # type: (Node, str, str, bool) -> HostResult
+        """
+        Uploads a file to, or downloads a file from, a single node
+        :param node: The node to transfer with
+        :param local_path: The local file
+        :param remote_path: The file on the node
+        :param upload: True to upload the local file, False to download the remote one
+        :return: The result of the node
+        """
+        start = time.time()
+
+        try:
+            sftp = self.retry_policy.call(self.ssh_pool.open_sftp, SSH_EXCEPTIONS, node.floating_ip, self.ssh_user,
+                                          self.private_key)
+        except SSH_EXCEPTIONS as e:
+            return HostResult(node, duration=time.time() - start, error='connection failed: {0}'.format(e))
+
+        try:
+            sftp.get_channel().settimeout(self.timeout)
+            if upload:
+                sftp.put(local_path, remote_path)
+            else:
+                sftp.get(remote_path, local_path)
+        except socket.timeout:
+            return HostResult(node, duration=time.time() - start, error='timed out after {0}s'.format(self.timeout))
+        except (IOError, OSError) + SSH_EXCEPTIONS as e:
+            return HostResult(node, duration=time.time() - start, error='transfer failed: {0}'.format(e))
+        finally:
+            sftp.close()
+
+        if self.stream_output:
+            if upload:
+                logger.info('{0}: uploaded {1} to {2}'.format(node.name, os.path.basename(local_path), remote_path))
+            else:
+                logger.info('{0}: downloaded {1} to {2}'.format(node.name, remote_path, local_path))
+
+        return HostResult(node, exit_status=0, duration=time.time() - start)
+
+
+if __name__ == '__main__':
+    from domain.cluster import Cluster
+    from helper_functions import parse_args, setup_logger
+
+    setup_logger()
+    args = parse_args()
+
+    cluster = Cluster(json_file=args.cluster)
+    nodes = cluster.select_nodes(node_types=args.node_types.split(',') if args.node_types else None)
+
+    fan_out = FanOut(SSHPool(), cluster.ssh_user, cluster.private_key, concurrency=args.concurrency)
+
+    if args.upload:
+        results = fan_out.upload(nodes, args.upload, args.destination)
+    else:
+        results = fan_out.run(nodes, args.command, get_pty=True)
+
+    for result in results:
+        logger.info('{0}: exit status {1} in {2:.1f}s{3}'.format(
+            result.node.name, result.exit_status, result.duration, ' - ' + result.error if result.error else ''))
+
+    FanOut.check(results, args.command or 'Upload of ' + args.upload)
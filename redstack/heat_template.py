@@ -1,4 +1,7 @@
+import hashlib
+import json
 import os
+from types import GeneratorType
 
 import yaml
 
@@ -24,6 +27,13 @@ class HeatTemplate():
         else:
             self.output_file = os.path.join(self.deploy.directory, "template.yml")
 
+        # Stack parameters passed to heat alongside the template
+        self.parameters = {}
+
+        # The rendered template, and the hash of the template and its parameters
+        self.rendered = None
+        self.fingerprint = None
+
     def generate_with_existing_network(self, subnet_id, network_id):
         # type: (str, str) -> None
         """
@@ -47,7 +57,6 @@ class HeatTemplate():
                     'type': 'string'
                 },
                 'key_name': {
-                    'default': self.deploy.key_name,
                     'type': 'string'
                 },
                 'public_network': {
@@ -62,32 +71,7 @@ class HeatTemplate():
         # Add the security group
         heat_dict['resources']['rs_security_group'] = self.create_security_group()
 
-        # Create entries for all of the nodes
-        for node in self.deploy.cluster.nodes:
-
-            # Create volume size entries in template dictionary
-            volume_size_block_title = '{0}_node_volume_size'.format(node.name)
-
-            heat_dict['parameters'][volume_size_block_title] = self.create_volume_size_entry(
-                node.name, node.volume_size)
-
-            # Create Floating IP Resource
-            heat_dict['resources']['floating_ip_' + node.name] = self.create_fip_entry(node.name)
-
-            # Create Public Port Resource
-            heat_dict['resources']['public_port_' + node.name] = self.create_public_port_entry(True)
-
-            # Create Node Resource
-            heat_dict['resources'][node.name] = self.create_node_entry(node)
-
-            # Create Volume Attachment Resource
-            heat_dict['resources']['volume_attachment_' + node.name] = self.create_volume_attachment_entry(node.name)
-
-            # Create Volume Resource
-            heat_dict['resources']['volume_' + node.name] = self.create_volume_entry(node.name, volume_size_block_title)
-
-        with open(self.output_file, "w") as yml_file:
-            yaml.dump(heat_dict, yml_file, default_flow_style=False)
+        self._render(heat_dict, True, 'floating_ip_')
 
     def generate(self):
         # type: () -> None
@@ -146,7 +130,6 @@ class HeatTemplate():
                     'type': 'string'
                 },
                 'key_name': {
-                    'default': self.deploy.key_name,
                     'type': 'string'
                 },
                 'public_network': {
@@ -161,32 +144,146 @@ class HeatTemplate():
         # Add the security group
         heat_dict['resources']['rs_security_group'] = self.create_security_group()
 
-        # Create entries for all of the nodes
-        for node in self.deploy.cluster.nodes:
+        self._render(heat_dict, False, 'floating_ip')
 
-            # Create volume size entries in template dictionary
-            volume_size_block_title = '{0}_node_volume_size'.format(node.name)
+    def create_node_resources(self, node, existing_network, fip_prefix):
+        # type: (Node, bool, str) -> ({}, {})
+        """
+        Create the parameters and resources for a single node
+        :param node: The node to create the entries for
+        :param existing_network: whether or not to use the existing network reference
+        :param fip_prefix: The prefix of the floating ip resource name
+        :return: A tuple of the parameter and resource dictionaries for the heat template
+        """
+        # Create volume size entries in template dictionary
+        volume_size_block_title = '{0}_node_volume_size'.format(node.name)
 
-            heat_dict['parameters'][volume_size_block_title] = self.create_volume_size_entry(
-                node.name, node.volume_size)
+        parameters = {
+            volume_size_block_title: self.create_volume_size_entry(node.name, node.volume_size)
+        }
 
+        resources = {
             # Create Floating IP Resource
-            heat_dict['resources']['floating_ip' + node.name] = self.create_fip_entry(node.name)
+            fip_prefix + node.name: self.create_fip_entry(node.name),
 
             # Create Public Port Resource
-            heat_dict['resources']['public_port_' + node.name] = self.create_public_port_entry(False)
+            'public_port_' + node.name: self.create_public_port_entry(existing_network),
 
             # Create Node Resource
-            heat_dict['resources'][node.name] = self.create_node_entry(node)
+            node.name: self.create_node_entry(node),
 
             # Create Volume Attachment Resource
-            heat_dict['resources']['volume_attachment_' + node.name] = self.create_volume_attachment_entry(node.name)
+            'volume_attachment_' + node.name: self.create_volume_attachment_entry(node.name),
 
             # Create Volume Resource
-            heat_dict['resources']['volume_' + node.name] = self.create_volume_entry(node.name, volume_size_block_title)
+            'volume_' + node.name: self.create_volume_entry(node.name, volume_size_block_title)
+        }
+
+        return parameters, resources
+
+    def _render(self, heat_dict, existing_network, fip_prefix):
+        # type: ({}, bool, str) -> None
+        """
+        Renders the template with the entries for all of the nodes, fingerprints it, and writes it to the output
+        file.
+        :param heat_dict: The heat template dictionary without any node entries
+        :param existing_network: whether or not to use the existing network reference
+        :param fip_prefix: The prefix of the floating ip resource name
+        """
+        # Sorted so that the same cluster always renders to the same bytes
+        nodes = sorted(self.deploy.cluster.nodes, key=lambda node: node.name)
 
-        with open(self.output_file, "w") as yml_file:
-            yaml.dump(heat_dict, yml_file, default_flow_style=False)
+        if self.deploy.heat_template_format == 'yaml':
+            self.rendered = self._render_yaml(heat_dict, nodes, existing_network, fip_prefix)
+        else:
+            self.rendered = ''.join(self._render_json(heat_dict, nodes, existing_network, fip_prefix))
+
+        # The keypair is passed rather than rendered, it is left out of the fingerprint
+        self.parameters['key_name'] = self.deploy.key_name
+        self.fingerprint = self.create_fingerprint(self.rendered, self.parameters)
+        self.deploy.template_fingerprint = self.fingerprint
+
+        with open(self.output_file, 'w') as template_file:
+            template_file.write(self.rendered)
+
+    def _render_yaml(self, heat_dict, nodes, existing_network, fip_prefix):
+        # type: ({}, [Node], bool, str) -> str
+        """
+        Renders the full template dictionary as yaml, with the libyaml emitter when it is available
+        :param heat_dict: The heat template dictionary without any node entries
+        :param nodes: The nodes to add to the template
+        :param existing_network: whether or not to use the existing network reference
+        :param fip_prefix: The prefix of the floating ip resource name
+        :return: The rendered template
+        """
+        for node in nodes:
+            parameters, resources = self.create_node_resources(node, existing_network, fip_prefix)
+            heat_dict['parameters'].update(parameters)
+            heat_dict['resources'].update(resources)
+
+        dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+        return yaml.dump(heat_dict, Dumper=dumper, default_flow_style=False)
+
+    def _render_json(self, heat_dict, nodes, existing_network, fip_prefix):
+        # type: ({}, [Node], bool, str) -> GeneratorType
+        """
+        Renders the template as json, which heat accepts as yaml. The entries of a placeholder node are serialized
+        once into a skeleton, and the entries of every node are rendered by substituting its values into it.
+        :param heat_dict: The heat template dictionary without any node entries
+        :param nodes: The nodes to add to the template
+        :param existing_network: whether or not to use the existing network reference
+        :param fip_prefix: The prefix of the floating ip resource name
+        :return: A generator of the rendered template chunks
+        """
+        placeholder = Node(name='RSNODENAME', flavor='RSNODEFLAVOR', volume_size='RSNODEVOLUME')
+        parameters, resources = self.create_node_resources(placeholder, existing_network, fip_prefix)
+
+        # Strip the braces so the fragments can be spliced into the parameter and resource objects
+        parameters_skeleton = self._dump_json(parameters)[1:-1]
+        resources_skeleton = self._dump_json(resources)[1:-1]
+
+        def render_node(skeleton, node):
+            return skeleton.replace('"RSNODEVOLUME"', self._dump_json(node.volume_size)) \
+                .replace('RSNODEFLAVOR', self._dump_json(node.flavor)[1:-1]) \
+                .replace('RSNODENAME', self._dump_json(node.name)[1:-1])
+
+        header = dict((key, value) for key, value in heat_dict.items() if key not in ['parameters', 'resources'])
+        yield self._dump_json(header)[:-1]
+
+        for section, skeleton in [('parameters', parameters_skeleton), ('resources', resources_skeleton)]:
+            yield ',{0}:{{'.format(self._dump_json(section))
+            yield self._dump_json(heat_dict[section])[1:-1]
+            for node in nodes:
+                yield ','
+                yield render_node(skeleton, node)
+            yield '}'
+
+        yield '}\n'
+
+    @staticmethod
+    def _dump_json(value):
+        # type: (object) -> str
+        """
+        Serializes a value to canonical, compact json
+        :param value: The value to serialize
+        :return: The json string
+        """
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    @staticmethod
+    def create_fingerprint(rendered, parameters):
+        # type: (str, {}) -> str
+        """
+        Create a content hash of a rendered heat template and its stack parameters, apart from the keypair which
+        changes with every deployment directory unless key_name is set
+        :param rendered: The rendered heat template
+        :param parameters: The stack parameters
+        :return: The hex sha256 of the template and canonical json of the parameters
+        """
+        fingerprint = hashlib.sha256(rendered.encode('utf-8'))
+        fingerprint.update(HeatTemplate._dump_json(
+            dict((key, value) for key, value in parameters.items() if key != 'key_name')).encode('utf-8'))
+        return fingerprint.hexdigest()
 
     def create_security_group(self):
         # type: () -> {}
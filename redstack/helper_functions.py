@@ -1,15 +1,11 @@
 import argparse
 import logging
-import socket
-import time
-
-import paramiko
-from paramiko.ssh_exception import NoValidConnectionsError, AuthenticationException, SSHException
 
+import retry_policy
 from domain.node import Node
 from exceptions import *
-
-from redstack.exceptions import ShellException
+from fanout import FanOut
+from ssh import SSHPool, SSHReadinessScanner
 
 logger = logging.getLogger("root_logger")
 
@@ -30,6 +26,33 @@ def parse_args():
                         default="/opt/redstack/REDstack/cluster.json",
                         required=False)
 
+    parser.add_argument("--node-types", help="Comma separated node types from the cluster template to resize",
+                        default=None, required=False)
+
+    parser.add_argument("--flavor", help="The Openstack flavor to resize nodes to",
+                        default=None, required=False)
+
+    parser.add_argument("--batch-size", help="How many nodes to resize at the same time",
+                        default=1, type=int, required=False)
+
+    parser.add_argument("--command", help="A command to run on the selected nodes",
+                        default=None, required=False)
+
+    parser.add_argument("--upload", help="A local file to upload to the selected nodes",
+                        default=None, required=False)
+
+    parser.add_argument("--destination", help="Where to put the uploaded file on the nodes",
+                        default=None, required=False)
+
+    parser.add_argument("--concurrency", help="How many nodes to run on at the same time",
+                        default=32, type=int, required=False)
+
+    parser.add_argument("--directory", help="The absolute path to an existing deployment directory",
+                        default=None, required=False)
+
+    parser.add_argument("--force", help="Bake a new image even when one is already baked for the Chef payload",
+                        action="store_true", default=False, required=False)
+
     return parser.parse_args()
 
 
@@ -52,105 +75,95 @@ def setup_logger():
     root_logger.setLevel(logging.INFO)
 
 
-def retry(func, tries, exceptions, *args, **kwargs):
-    # type: (any, int, tuple or Exception, args) -> any
+def retry(func, policy, exceptions, *args, **kwargs):
+    # type: (any, str or int or RetryPolicy, tuple or Exception, args) -> any
     """ 
     Helper function for attempting to execute more than once
     :param func: A method to execute
-    :param tries: Number of times to retry
+    :param policy: The name of a retry policy from rs_conf.yml, a RetryPolicy, or a number of tries with the default
+    backoff
     :param exceptions: Exceptions to retry when caught
     :param args: args to pass to the function
+    :raises CircuitOpenException: if the circuit of the policy is open
     """
-    for i in range(tries):
-        try:
-            return func(*args, **kwargs)
-        except exceptions as e:
-            if i == tries - 1:
-                raise
-            logger.info('{0} failed on try {1} with {2}'.format(func.__name__, i, e.message))
-            time.sleep(5)
-
-
-def unmount(node, ssh_user, private_key):
-    # type: (Node, str, str) -> None
+    return retry_policy.get_policy(policy).call(func, exceptions, *args, **kwargs)
+
+
+def unmount(node, ssh_user, private_key, ssh_pool):
+    # type: (Node, str, str, SSHPool) -> None
     """
     Reformats a drive with paramiko
     :param node: A node to reformat the drive on
     :param ssh_user: The user to ssh with
     :param private_key: The key to ssh with
+    :param ssh_pool: The ssh connection pool of the deploy
     :return: 
     """
-    test_node_ssh_availability(node, ssh_user, private_key)
+    test_node_ssh_availability(node, ssh_user, private_key, ssh_pool)
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    results = FanOut(ssh_pool, ssh_user, private_key).run(
+        [node], 'if df -h | grep /grid/0; then sudo umount -f -l /grid/0; fi;', get_pty=True)
 
-    retry(ssh.connect, 5, (socket.error, SSHException, AuthenticationException, NoValidConnectionsError),
-          node.floating_ip, username=ssh_user, key_filename=private_key, timeout=30)
-    stdin, stdout, stderr = ssh.exec_command('if df -h | grep /grid/0; then sudo umount -f -l /grid/0; fi;',
-                                             get_pty=True)
+    FanOut.check(results, 'Reformat')
+    logger.info('Reformat succeeded on ' + node.name)
 
-    if stdout.channel.recv_exit_status() == 0:
-        ssh.close()
-        logger.info('Reformat succeeded on ' + node.name)
-    else:
-        stderr_str = stderr.read()
-        logger.info(stderr_str)
-        ssh.close()
-        raise ShellException("Reformat failed on node: " + node.name)
 
+def remount(node, ssh_user, private_key, ssh_pool, volume_device, mount_location):
+    # type: (Node, str, str, SSHPool, str, str) -> None
+    """
+    Mounts an existing filesystem on the attached volume without reformatting it
+    :param node: A node to remount the drive on
+    :param ssh_user: The user to ssh with
+    :param private_key: The key to ssh with
+    :param ssh_pool: The ssh connection pool of the deploy
+    :param volume_device: The device of the attached cinder volume
+    :param mount_location: Where to mount the volume
+    :return:
+    """
+    test_node_ssh_availability(node, ssh_user, private_key, ssh_pool)
 
-def set_root_mysql_password(node, ssh_user, private_key, new_password):
-    # type: (Node, str, str) -> None
+    # A volume without a filesystem is left alone so the disk recipe formats it as usual
+    command = 'if sudo blkid {0}; then sudo mkdir -p {1}; mountpoint -q {1} || sudo mount {0} {1}; ' \
+              'grep -q " {1} " /etc/fstab || echo "{0} {1} auto defaults,noatime 0 0" | sudo tee -a /etc/fstab; ' \
+              'fi;'.format(volume_device, mount_location)
+
+    results = FanOut(ssh_pool, ssh_user, private_key).run([node], command, get_pty=True)
+
+    FanOut.check(results, 'Remount')
+    logger.info('Remounted existing data volume on ' + node.name)
+
+
+def set_root_mysql_password(node, ssh_user, private_key, ssh_pool, new_password):
+    # type: (Node, str, str, SSHPool, str) -> None
     """
     Sets the mysql root password
     :param node: A node to reformat the drive on
     :param ssh_user: The user to ssh with
     :param private_key: The key to ssh with
+    :param ssh_pool: The ssh connection pool of the deploy
     :return: 
     """
-    test_node_ssh_availability(node, ssh_user, private_key)
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    test_node_ssh_availability(node, ssh_user, private_key, ssh_pool)
 
-    retry(ssh.connect, 5, (socket.error, SSHException, AuthenticationException, NoValidConnectionsError),
-          node.floating_ip, username=ssh_user, key_filename=private_key, timeout=30)
-    stdin, stdout, stderr = ssh.exec_command('mysqladmin -u root password {0}'.format(new_password), get_pty=True)
+    results = FanOut(ssh_pool, ssh_user, private_key, stream_output=False).run(
+        [node], 'mysqladmin -u root password {0}'.format(new_password), get_pty=True)
 
-    if stdout.channel.recv_exit_status() == 0:
-        ssh.close()
-        logger.info('Set mysql password for root mysql user ' + node.name)
-    else:
-        stderr_str = stderr.read()
-        logger.info(stderr_str)
-        ssh.close()
-        raise ShellException("Failed to change mysql password for root user: " + node.name)
+    FanOut.check(results, 'Change of the mysql password for the root user')
+    logger.info('Set mysql password for root mysql user ' + node.name)
 
 
-def test_node_ssh_availability(node, ssh_user, private_key, retries=50):
-    # type: (Node, str, str) -> None
+def test_node_ssh_availability(node, ssh_user, private_key, ssh_pool, timeout=250):
+    # type: (Node, str, str, SSHPool, int) -> None
     """
-    Attempts to connect to the given ip over ssh
+    Attempts to connect to the given ip over ssh, the connection is kept in the pool for the operations that follow
     :param node: A node to reformat the drive on
     :param ssh_user: The user to ssh with
     :param private_key: The key to ssh with
-    :param retries: How many time to try and connect
+    :param ssh_pool: The ssh connection pool of the deploy
+    :param timeout: How many seconds to try and connect
     :raises paramiko.SSHException: when the node cannot be reached
     """
+    scanner = SSHReadinessScanner(ssh_pool, ssh_user, private_key, timeout=timeout)
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    for attempt in range(retries):
-        try:
-            ssh.connect(node.floating_ip, username=ssh_user, key_filename=private_key, timeout=5)
-            ssh.close()
-            logger.info("Established SSH connection with {0} -- {1}@{2}".format(node.name, ssh_user, node.floating_ip))
-            return
-        except (socket.error, SSHException, AuthenticationException, NoValidConnectionsError) as e:
-            logger.debug('Socket error while checking SSH availability on {0} - {1}'.format(node.name, e))
-            time.sleep(5)
-
-    logger.error('Timed out attempting to establish SSH connection with {0}'.format(node.name))
-    raise paramiko.SSHException("Exhausted retries connecting to node")
+    for reachable_node in scanner.scan([node]):
+        return
@@ -0,0 +1,243 @@
+""" Module for sizing the local Chef processes to the deploy host.
+
+Every converge runs knife, or ssh for chef-solo, as a local process on the deploy host. A knife process is a Ruby
+interpreter that takes a burst of CPU to start and 100-200MB of memory while it waits on the node, so the number of
+converges the deploy host can run at once depends on its memory more than on the size of the cluster. The cores, the
+available memory and the open file limit of the host, including the limits of the container it runs in, cap the
+concurrency of the converge. Each start is then also paced on the live load and free memory of the host, and the CPU
+time and peak memory of every finished process are reported and fed back into the estimate.
+"""
+
+import logging
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+logger = logging.getLogger("root_logger")
+
+# Files the deploy process holds for each converge: its output pipes and log, the pooled ssh connection and the master
+FILES_PER_CONVERGE = 8
+
+
+class HostResources:
+
+    @staticmethod
+    def cpu_count():
+        # type: () -> int
+        """
+        :return: The cores the deploy process may use, within its affinity mask and the cpu quota of its cgroup
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = multiprocessing.cpu_count()
+
+        # cgroup v2 holds "<quota> <period>", v1 splits them over two files with a quota of -1 when unlimited
+        quota = HostResources._read('/sys/fs/cgroup/cpu.max')
+        if quota:
+            quota, period = quota.split()[:2]
+        else:
+            quota = HostResources._read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+            period = HostResources._read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+
+        if quota and period and quota not in ['max', '-1']:
+            cpus = min(cpus, max(1, -(-int(quota) // int(period))))
+
+        return cpus
+
+    @staticmethod
+    def memory_available():
+        # type: () -> int
+        """
+        :return: The bytes of memory the deploy process can still allocate, the lower of the memory available on the
+        host and the room left under the memory limit of its cgroup
+        """
+        meminfo = {}
+        for line in (HostResources._read('/proc/meminfo') or '').splitlines():
+            key, value = line.split(':', 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+
+        # MemAvailable appeared in linux 3.14
+        available = meminfo.get('MemAvailable', meminfo.get('MemFree', 0) + meminfo.get('Cached', 0))
+
+        limit = HostResources._read('/sys/fs/cgroup/memory.max')
+        if limit is not None:
+            usage = HostResources._read('/sys/fs/cgroup/memory.current')
+            stat = HostResources._read('/sys/fs/cgroup/memory.stat')
+            reclaimable = 'inactive_file'
+        else:
+            limit = HostResources._read('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+            usage = HostResources._read('/sys/fs/cgroup/memory/memory.usage_in_bytes')
+            stat = HostResources._read('/sys/fs/cgroup/memory/memory.stat')
+            reclaimable = 'total_inactive_file'
+
+        # An unlimited cgroup reports max, or a limit larger than the memory of the host
+        if limit and usage and limit != 'max' and int(limit) < meminfo.get('MemTotal', 0):
+            # The kernel reclaims the inactive page cache before it kills anything under the limit
+            inactive = 0
+            for line in (stat or '').splitlines():
+                if line.startswith(reclaimable + ' '):
+                    inactive = int(line.split()[1])
+
+            available = min(available, int(limit) - int(usage) + inactive)
+
+        return max(available, 0)
+
+    @staticmethod
+    def open_file_limit():
+        # type: () -> int
+        """
+        :return: The soft limit on open files of the deploy process
+        """
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+    @staticmethod
+    def load():
+        # type: () -> float
+        """
+        :return: The one minute load average of the host
+        """
+        return os.getloadavg()[0]
+
+    @staticmethod
+    def _read(path):
+        # type: (str) -> str or None
+        """
+        :param path: A file of /proc or /sys
+        :return: The stripped content of the file, or None if it does not exist
+        """
+        try:
+            with open(path, 'r') as proc_file:
+                return proc_file.read().strip()
+        except (IOError, OSError):
+            return None
+
+
+class ProcessThrottle:
+    def __init__(self, max_concurrency, process_memory_mb=200, memory_reserve_mb=512, max_load_per_cpu=2.0,
+                 start_interval=0.25):
+        # type: (int, int, int, float, float) -> None
+        """
+        Constructor for ProcessThrottle
+        :param max_concurrency: The most converges to run at the same time, whatever the host could take
+        :param process_memory_mb: The memory a converge process is expected to take until one has been measured
+        :param memory_reserve_mb: The memory to leave free on the host for the deploy process itself
+        :param max_load_per_cpu: No converge starts while the load average per core is above this
+        :param start_interval: The fewest seconds between two starts, spreading the startup bursts of Ruby
+        """
+        self.process_memory_mb = process_memory_mb
+        self.memory_reserve_mb = memory_reserve_mb
+        self.max_load_per_cpu = max_load_per_cpu
+        self.start_interval = start_interval
+
+        # How often a throttled scheduler asks again
+        self.recheck_interval = max(start_interval, 0.1)
+
+        self.cpus = HostResources.cpu_count()
+        available_mb = HostResources.memory_available() // 1048576
+        open_files = HostResources.open_file_limit()
+
+        by_memory = (available_mb - memory_reserve_mb) // process_memory_mb
+        by_files = (open_files - 64) // FILES_PER_CONVERGE
+        self.concurrency = int(max(1, min(max_concurrency, by_memory, by_files)))
+
+        logger.info('Deploy host: {0} cores, {1}MB available, {2} open files, load {3:.1f} - converging at most {4} '
+                    'nodes at once'.format(self.cpus, available_mb, open_files, HostResources.load(),
+                                           self.concurrency))
+        if self.concurrency < max_concurrency:
+            logger.warning('chef_max_concurrency {0} lowered to {1}, limited by the {2} of the deploy host'.format(
+                max_concurrency, self.concurrency, 'memory' if by_memory <= by_files else 'open file limit'))
+
+        # The cpu seconds and peak MB of each finished converge process, by node name
+        self.usage = {}
+        self.last_start = 0
+        self.last_reason = None
+        self._lock = threading.Lock()
+
+    def admit(self, running):
+        # type: (int) -> bool
+        """
+        Decides whether another converge may start now. The first one always may, so the converge never stalls.
+        :param running: How many converges are running
+        :return: True if a converge may start
+        """
+        if running == 0:
+            reason = None
+        elif running >= self.concurrency:
+            return False
+        elif time.time() - self.last_start < self.start_interval:
+            reason = 'pacing'
+        elif HostResources.memory_available() // 1048576 < self.memory_reserve_mb + self.expected_memory_mb():
+            reason = 'low memory'
+        elif HostResources.load() / self.cpus > self.max_load_per_cpu:
+            reason = 'high load'
+        else:
+            reason = None
+
+        # Only the change of reason is logged, pacing is expected and not worth a line
+        if reason != self.last_reason and reason != 'pacing':
+            if reason:
+                logger.warning('Deploy host throttled on {0}, holding converges at {1}: {2}'.format(
+                    reason, running, self.describe()))
+            elif self.last_reason:
+                logger.info('Deploy host no longer throttled: {0}'.format(self.describe()))
+            self.last_reason = reason
+
+        if reason:
+            return False
+
+        self.last_start = time.time()
+        return True
+
+    def expected_memory_mb(self):
+        # type: () -> int
+        """
+        :return: The memory the next converge process is expected to take, the largest one measured so far
+        """
+        with self._lock:
+            return max([self.process_memory_mb] + [peak for cpu, peak in self.usage.values()])
+
+    def record(self, name, usage):
+        # type: (str, resource.struct_rusage) -> None
+        """
+        Records and logs the resources a finished converge process used
+        :param name: The node the process converged
+        :param usage: The resource usage of the process and its children
+        """
+        if usage is None:
+            return
+
+        cpu = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in KB on linux
+        peak = usage.ru_maxrss // 1024
+
+        with self._lock:
+            self.usage[name] = (cpu, peak)
+
+        logger.info('Converge process of {0} used {1:.1f}s of cpu and {2}MB of memory at its peak'.format(
+            name, cpu, peak))
+
+    def describe(self):
+        # type: () -> str
+        """
+        :return: The live memory and load of the host
+        """
+        return '{0}MB available, load {1:.1f} on {2} cores'.format(
+            HostResources.memory_available() // 1048576, HostResources.load(), self.cpus)
+
+    def log_summary(self):
+        # type: () -> None
+        """
+        Logs the total cpu time and the memory of the converge processes recorded so far
+        """
+        with self._lock:
+            usage = list(self.usage.values())
+
+        if not usage:
+            return
+
+        peaks = sorted(peak for cpu, peak in usage)
+        logger.info('{0} converge processes used {1:.0f}s of cpu, {2}MB of memory at the median and {3}MB at the '
+                    'most'.format(len(usage), sum(cpu for cpu, peak in usage), peaks[len(peaks) // 2], peaks[-1]))
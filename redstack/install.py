@@ -2,13 +2,18 @@ import logging
 import os
 
 import helper_functions
+import retry_policy
 from ambari import Ambari
 from blueprints import BlueprintBuilder
 from chef import Chef
+from diagnostics import Diagnostics
 from domain.deploy import Deploy
 from environment import Environment
+from mirror import PackageMirror
 from openstack import Openstack
 
+logger = logging.getLogger('root_logger')
+
 
 def install(config_file):
     """ 
@@ -45,17 +50,47 @@ def install(config_file):
         logger.info(deploy.cluster.to_json())
         cluster_json_file.write(deploy.cluster.to_json())
 
+    # A copy in the deployment directory lets resume.py pick the deploy up again
+    with open(os.path.join(deploy.directory, 'cluster.json'), 'w') as cluster_json_file:
+        cluster_json_file.write(deploy.cluster.to_json())
+
     # Chef phase
     chef = Chef(deploy)
-    chef.converge()
+    try:
+        chef.converge()
+    finally:
+        chef.multiplexer.close_all(deploy.cluster.nodes)
 
     # Ambari phase
-    ambari = Ambari(deploy)
-    ambari.install()
+    install_ambari(deploy)
+
+    deploy.ssh_pool.close()
+    retry_policy.log_summary()
 
     logger.info('REDstack install completed - Ambari: https://{0}:8443'.format(deploy.cluster.master_node.floating_ip))
 
 
+def install_ambari(deploy):
+    # type: (Deploy) -> None
+    """
+    Installs the cluster with Ambari on the converged nodes, from the package mirror when the deploy has one.
+    Diagnostics are collected from the nodes if the install fails.
+    :param deploy: The deploy whose nodes are converged
+    """
+    # Serve the HDP repositories from the master before Ambari installs them on every node
+    if deploy.package_mirror:
+        PackageMirror(deploy).create()
+
+    ambari = Ambari(deploy)
+    try:
+        ambari.install()
+    except Exception:
+        Diagnostics(deploy).collect('Ambari install failed')
+        raise
+    finally:
+        ambari.close()
+
+
 if __name__ == "__main__":
     helper_functions.setup_logger()
     logger = logging.getLogger('root_logger')
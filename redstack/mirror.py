@@ -0,0 +1,161 @@
+""" Module for serving the HDP repositories to the cluster from its master node.
+
+Without a mirror every node downloads the HDP and HDP-UTILS packages from the internet during the Ambari install, all at
+the same time. With package_mirror set, the repositories of the stack and utils definitions are synced once onto the
+volume of the master node and served over http on the cluster network. The definitions are then pointed at the mirror
+before they are put to Ambari, which writes them into the yum configuration of every node.
+
+With package_mirror "master" the master syncs the repositories from their upstream location. With "cache" the deploy
+host keeps a copy in the artifact cache, which is pushed to the master with rsync when present and filled from the
+master after the first sync otherwise, so later deploys do not download the packages from the internet at all.
+"""
+
+import json
+import logging
+import os
+import subprocess
+
+from domain.deploy import Deploy
+from fanout import FanOut
+
+from redstack.exceptions import ConfigException, ShellException
+
+logger = logging.getLogger("root_logger")
+
+
+class PackageMirror:
+    def __init__(self, deploy):
+        # type: (Deploy) -> None
+        """
+        Constructor for PackageMirror
+        :param deploy: The current deploy, its blueprints must have been created
+        :raises ConfigException: if package_mirror is not master or cache
+        """
+        if deploy.package_mirror not in ['master', 'cache']:
+            raise ConfigException('package_mirror must be master or cache, not {0}'.format(deploy.package_mirror))
+
+        self.deploy = deploy
+        self.master = deploy.cluster.master_node
+        self.directory = '{0}/redstack-mirror'.format(deploy.mount_location)
+        self.cache_directory = os.path.join(deploy.artifact_cache_directory, 'repos')
+
+        # Syncing gigabytes of packages takes a while
+        self.fan_out = FanOut(deploy.ssh_pool, deploy.cluster.ssh_user, deploy.cluster.private_key, timeout=7200,
+                              stream_output=False)
+
+    @property
+    def repositories(self):
+        # type: () -> [(str, {})]
+        """
+        :return: The id of each mirrored repository with the definition that points at it
+        """
+        return [('HDP-{0}'.format(self.deploy.hdp_version), self.deploy.stack_definition),
+                ('HDP-UTILS-{0}'.format(self.deploy.hdp_utils_version), self.deploy.utils_definition)]
+
+    def create(self):
+        # type: () -> None
+        """
+        Syncs the repositories onto the master, serves them, and points the stack and utils definitions at the mirror
+        :raises ShellException: if a repository could not be synced or served
+        """
+        logger.info('Creating the package mirror on {0}'.format(self.master.name))
+        self._serve()
+
+        for repo_id, definition in self.repositories:
+            if self.deploy.package_mirror == 'cache' and os.path.exists(os.path.join(self.cache_directory, repo_id,
+                                                                                     '.complete')):
+                self._rsync('{0}/{1}/'.format(self.cache_directory, repo_id), '{0}/{1}/'.format(self.directory, repo_id),
+                            push=True)
+                logger.info('Pushed {0} from the deploy host cache to the mirror'.format(repo_id))
+            else:
+                self._sync(repo_id, definition['Repositories']['base_url'])
+                if self.deploy.package_mirror == 'cache':
+                    self._fill_cache(repo_id)
+
+            definition['Repositories']['base_url'] = 'http://{0}:{1}/{2}'.format(
+                self.master.internal_ip, self.deploy.package_mirror_port, repo_id)
+
+        for file_name, definition in [('hdp-stack.json', self.deploy.stack_definition),
+                                      ('hdp-utils.json', self.deploy.utils_definition)]:
+            with open(os.path.join(self.deploy.directory, 'logs', 'ambari', file_name), 'w') as definition_file:
+                json.dump(definition, definition_file, indent=2, sort_keys=True)
+
+        logger.info('Package mirror ready at http://{0}:{1}/'.format(self.master.internal_ip,
+                                                                     self.deploy.package_mirror_port))
+
+    def _serve(self):
+        # type: () -> None
+        """
+        Installs the sync tools and an httpd that serves the mirror directory on the mirror port
+        :raises ShellException: if httpd could not be started
+        """
+        config = 'Listen {0}\\n<VirtualHost *:{0}>\\n  DocumentRoot {1}\\n  <Directory {1}>\\n' \
+                 '    Options Indexes FollowSymLinks\\n    Require all granted\\n  </Directory>\\n' \
+                 '</VirtualHost>\\n'.format(self.deploy.package_mirror_port, self.directory)
+
+        command = 'sudo yum install -y yum-utils createrepo httpd rsync && sudo mkdir -p {0} && ' \
+                  '(sudo chcon -R -t httpd_sys_content_t {0} 2> /dev/null; true) && ' \
+                  'printf "{1}" | sudo tee /etc/httpd/conf.d/redstack-mirror.conf > /dev/null && ' \
+                  'sudo systemctl enable httpd && sudo systemctl restart httpd'.format(self.directory, config)
+
+        FanOut.check(self.fan_out.run([self.master], command, get_pty=True), 'Starting the package mirror')
+
+    def _sync(self, repo_id, base_url):
+        # type: (str, str) -> None
+        """
+        Downloads the newest packages of a repository onto the master and generates its metadata
+        :param repo_id: The id of the repository
+        :param base_url: The upstream location of the repository
+        :raises ShellException: if the repository could not be synced
+        """
+        logger.info('Syncing {0} from {1} to the mirror'.format(repo_id, base_url))
+
+        command = 'printf "[{0}]\\nname={0}\\nbaseurl={1}\\ngpgcheck=0\\nenabled=0\\n" | ' \
+                  'sudo tee /etc/yum.repos.d/redstack-mirror-{0}.repo > /dev/null && ' \
+                  'sudo reposync --repoid={0} --download_path={2}/{0} --norepopath --newest-only && ' \
+                  'sudo createrepo --update {2}/{0} && ' \
+                  '(sudo chcon -R -t httpd_sys_content_t {2}/{0} 2> /dev/null; true)'.format(
+                      repo_id, base_url, self.directory)
+
+        FanOut.check(self.fan_out.run([self.master], command, get_pty=True), 'Syncing {0}'.format(repo_id))
+
+    def _fill_cache(self, repo_id):
+        # type: (str) -> None
+        """
+        Copies a repository synced on the master to the deploy host cache, for the next deploys
+        :param repo_id: The id of the repository
+        """
+        local_directory = os.path.join(self.cache_directory, repo_id)
+        if not os.path.exists(local_directory):
+            os.makedirs(local_directory)
+
+        try:
+            self._rsync('{0}/{1}/'.format(self.directory, repo_id), local_directory + '/', push=False)
+        except ShellException:
+            # The mirror itself is fine, only the next deploy will download the packages again
+            logger.exception('Failed to cache {0} on the deploy host'.format(repo_id))
+            return
+
+        open(os.path.join(local_directory, '.complete'), 'w').close()
+        logger.info('Cached {0} at {1}'.format(repo_id, local_directory))
+
+    def _rsync(self, source, destination, push):
+        # type: (str, str, bool) -> None
+        """
+        Copies a directory between the deploy host and the master over the shared ssh connection
+        :param source: The directory to copy from, ending in /
+        :param destination: The directory to copy to, ending in /
+        :param push: True to copy from the deploy host to the master, False the other way around
+        :raises ShellException: if rsync failed
+        """
+        remote = '{0}@{1}:'.format(self.deploy.cluster.ssh_user, self.master.floating_ip)
+        command = ['rsync', '-a', '--delete', '--exclude', '.complete', '--rsync-path', 'sudo rsync', '-e',
+                   'ssh -F {0} -i {1}'.format(os.path.join(self.deploy.directory, 'ssh_config'),
+                                              self.deploy.cluster.private_key),
+                   source if push else remote + source, remote + destination if push else destination]
+
+        with open(os.path.join(self.deploy.directory, 'logs', 'mirror-rsync.log'), 'a') as log_file:
+            return_code = subprocess.call(command, stdout=log_file, stderr=subprocess.STDOUT)
+
+        if return_code != 0:
+            raise ShellException('rsync of {0} failed with {1}, see logs/mirror-rsync.log'.format(source, return_code))
@@ -1,5 +1,7 @@
 import json
 import os
+import shutil
+import time
 from threading import Thread
 
 from cinderclient import client as cinderclient
@@ -12,12 +14,13 @@ from neutronclient.v2_0 import client as neutronclient
 from novaclient import client as novaclient
 from novaclient.v2.servers import Server
 
+from bundle import bake_digest
 from domain.deploy import Deploy
 from environment import Environment
 from heat_template import HeatTemplate
 from helper_functions import *
-from redstack.exceptions import ConfigException, RebuildException, BasicOpenstackNetworkingException, \
-    ExistingNonRedstackResourcesException, HeatException
+from redstack.exceptions import ConfigException, RebuildException, ResizeException, \
+    BasicOpenstackNetworkingException, ExistingNonRedstackResourcesException, HeatException, BakeException
 
 logger = logging.getLogger("root_logger")
 
@@ -42,7 +45,8 @@ class Openstack:
         glance = GlanceClient("2", session=sess, region_name=deploy.region)
         server = nova.servers.get(node.server_id)
 
-        images = retry(glance.images.list, 5, (keystoneauth1_exceptions.connection.ConnectFailure, IndexError))
+        images = retry(glance.images.list, 'openstack',
+                       (keystoneauth1_exceptions.connection.ConnectFailure, IndexError))
 
         image_id = None
         for image in images:
@@ -50,7 +54,8 @@ class Openstack:
                 image_id = image.id
 
         if image_id:
-            retry(server.rebuild, 5, (keystoneauth1_exceptions.connection.ConnectFailure, IndexError), image_id)
+            retry(server.rebuild, 'openstack', (keystoneauth1_exceptions.connection.ConnectFailure, IndexError),
+                  image_id)
         else:
             raise ConfigException("Could not find image {0} to rebuild with".format(deploy.image_name))
 
@@ -72,6 +77,61 @@ class Openstack:
         else:
             raise RebuildException("Instance fell into ERROR state after rebuild")
 
+    @staticmethod
+    def resize_node(deploy, node, flavor_name):
+        # type (redstack.domain.Deploy, redstack.domain.Node, str) -> None
+        """
+        Resize an openstack node to a new flavor with Nova API binding.
+
+        Use nova API to resize an Openstack node and confirm the resize once the instance reaches VERIFY_RESIZE. The
+        node object is updated with the new flavor and ram once the instance is ACTIVE again.
+
+        :param deploy: Deploy object with deployment details
+        :param node: Node object representing server to resize
+        :param flavor_name: The name of the flavor to resize the node to
+        :raises: ResizeException if the node fails to resize correctly
+        """
+        sess = Openstack.create_ost_auth_session(deploy)
+        nova = novaclient.Client("2", session=sess, region_name=deploy.region)
+        retry_exceptions = (keystoneauth1_exceptions.connection.ConnectFailure, IndexError)
+
+        flavor = retry(nova.flavors.find, 'openstack', retry_exceptions, name=flavor_name)
+        server = retry(nova.servers.get, 'openstack', retry_exceptions, node.server_id)
+
+        if server.flavor['id'] == flavor.id:
+            logger.info("{0} already has flavor {1}, skipping resize".format(node.name, flavor_name))
+        else:
+            retry(server.resize, 'openstack', retry_exceptions, flavor.id)
+
+            start = time.time()
+            while server.status != 'VERIFY_RESIZE':
+                time.sleep(5)
+                server = retry(nova.servers.get, 'openstack', retry_exceptions, node.server_id)
+
+                if server.status == 'ERROR':
+                    raise ResizeException("Instance fell into ERROR state during resize")
+
+                # Fail if the node never finishes the migration
+                if time.time() - start > 1800:
+                    raise ResizeException("Instance failed to reach VERIFY_RESIZE after request for resize")
+
+            retry(server.confirm_resize, 'openstack', retry_exceptions)
+
+            start = time.time()
+            while server.status != 'ACTIVE':
+                time.sleep(5)
+                server = retry(nova.servers.get, 'openstack', retry_exceptions, node.server_id)
+
+                if server.status == 'ERROR':
+                    raise ResizeException("Instance fell into ERROR state after confirming resize")
+
+                if time.time() - start > 1800:
+                    raise ResizeException("Instance failed to reach ACTIVE after confirming resize")
+
+        node.flavor = flavor_name
+        node.ram = flavor.ram
+        node.vcpus = flavor.vcpus
+
     @staticmethod
     def create_ost_auth_session(deploy):
         # type: (Deploy) -> session.Session
@@ -117,9 +177,11 @@ class Openstack:
         self.neutron = neutronclient.Client(session=self.ost_auth_session, region_name=deploy.region)
         self.nova = novaclient.Client("2", session=self.ost_auth_session, region_name=deploy.region)
         self.heat = heatclient.Client("1", session=self.ost_auth_session, region_name=deploy.region)
+        self.glance = GlanceClient("2", session=self.ost_auth_session, region_name=deploy.region)
 
         # Retries for certain features
         self.retries = 5
+        self.retry_policy = 'openstack'
 
         # Sleep backoff for certain features
         self.sleep = 30
@@ -139,21 +201,143 @@ class Openstack:
         deleted (non redstack resources on project trigger exception). Private
         key is created. And finally stack is built using Heat API.
 
+        When reuse_existing_stack is set, an existing REDstack stack is kept instead. If its template fingerprint
+        matches the generated template the build is skipped, otherwise the stack is updated in place.
+
+        The nodes boot from the image baked for the Chef payload when there is one.
+
         :return: Cluster object associated with this deployment
         """
-        # Create private key file (currently in openstack utilities) and write it to deploy directory
+        self._use_baked_image()
+
+        heat_template = HeatTemplate(self.deploy)
+        existing_stack = self._get_existing_stack() if self.deploy.reuse_existing_stack else None
+
+        # Create private key file (currently in openstack utilities) and write it to deploy directory. A kept stack
+        # keeps the keypair its servers were built with, a new one would replace every server
         if self.deploy.key_name:
             self.deploy.cluster.private_key = os.path.join(self.deploy.directory, self.deploy.key_name)
+        elif existing_stack:
+            self.deploy.cluster.private_key = self._reuse_stack_private_key(existing_stack)
         else:
             self.deploy.cluster.private_key = self._create_private_key()
 
-        logger.info("Starting Openstack build using fresh resources.")
+        if existing_stack:
+            logger.info("Found existing REDstack stack, comparing it against the generated template.")
+
+            # Generate the template against the same network the existing stack was built with
+            self._generate_template_for_stack(heat_template, existing_stack)
+
+            if self._get_stack_fingerprint(existing_stack) == heat_template.fingerprint:
+                logger.info("Stack is unchanged ({0}), skipping Openstack build.".format(heat_template.fingerprint))
+            else:
+                self._update_stack_from_template(existing_stack.id, heat_template)
+        else:
+            logger.info("Starting Openstack build using fresh resources.")
 
-        # Clean existing resources, raise error if resources remain after cleaning
+            # Clean existing resources, raise error if resources remain after cleaning
+            self._cleanup_existing_resources()
+
+            self._generate_template(heat_template)
+
+            # Attempt to create stack with heat template
+            self._build_stack_from_template(heat_template)
+
+        # Get node information and create list of Node objects
+        retry(self._populate_node_object_list, self.retry_policy, self.retry_exceptions)
+
+    def _use_baked_image(self):
+        # type: () -> None
+        """
+        Switch the deploy to the image baked for its Chef payload if one is available, the baked recipes are then left
+        out of the converge
+        """
+        if not self.deploy.use_baked_image or not self.deploy.bake_recipes:
+            return
+
+        digest = bake_digest(self.deploy)
+        image = self.find_baked_image(digest)
+
+        if image:
+            logger.info("Using image {0} baked with {1}".format(image.name, ', '.join(self.deploy.bake_recipes)))
+            self.deploy.image_name = image.name
+            self.deploy.baked_recipes = list(self.deploy.bake_recipes)
+        else:
+            logger.info("No image is baked for this Chef payload ({0}), using {1}".format(
+                digest[:12], self.deploy.image_name))
+
+    def find_baked_image(self, digest):
+        # type: (str) -> object or None
+        """
+        Return the active image baked for a payload
+        :param digest: The bake digest of the payload
+        :return: The glance image or None
+        """
+        images = retry(self.glance.images.list, self.retry_policy, self.retry_exceptions)
+
+        for image in images:
+            if image.get('redstack_bake') == digest and image.status == 'active':
+                return image
+
+        return None
+
+    def has_stacks(self):
+        # type: () -> bool
+        """
+        :return: True if the Openstack project holds any heat stack
+        """
+        return len(self._get_heat_stacks()) > 0
+
+    def snapshot_node(self, node, image_name, properties, timeout=1800):
+        # type: (Node, str, {}, int) -> str
+        """
+        Stop a node and snapshot its root disk into a glance image
+        :param node: The node to snapshot
+        :param image_name: The name of the image
+        :param properties: The properties to tag the image with
+        :param timeout: Seconds to wait for the server to stop and for the image to become active
+        :raises BakeException: if the server did not stop or the image did not become active
+        :return: The id of the image
+        """
+        server = retry(self.nova.servers.get, self.retry_policy, self.retry_exceptions, node.server_id)
+        if server.status != 'SHUTOFF':
+            retry(server.stop, self.retry_policy, self.retry_exceptions)
+
+        start = time.time()
+        while server.status != 'SHUTOFF':
+            if time.time() - start > timeout:
+                raise BakeException("{0} failed to stop, its status is {1}".format(node.name, server.status))
+            time.sleep(self.short_sleep)
+            server = retry(self.nova.servers.get, self.retry_policy, self.retry_exceptions, node.server_id)
+
+        logger.info("Creating image {0} from {1}".format(image_name, node.name))
+        image_id = retry(self.nova.servers.create_image, self.retry_policy, self.retry_exceptions, node.server_id,
+                         image_name, metadata=properties)
+
+        image = retry(self.glance.images.get, self.retry_policy, self.retry_exceptions, image_id)
+        while image.status != 'active':
+            if image.status in ['killed', 'deleted'] or time.time() - start > timeout:
+                raise BakeException("Image {0} failed to upload, its status is {1}".format(image_name, image.status))
+            time.sleep(self.sleep)
+            image = retry(self.glance.images.get, self.retry_policy, self.retry_exceptions, image_id)
+
+        logger.info("Image {0} is active".format(image_name))
+        return image_id
+
+    def destroy(self):
+        # type: () -> None
+        """
+        Delete the REDstack stack of the project and wait until its resources are gone
+        """
         self._cleanup_existing_resources()
 
+    def _generate_template(self, heat_template):
+        # type: (HeatTemplate) -> None
+        """
+        Generate the heat template, reusing the network of the project when one is already configured
+        :param heat_template: The heat template to generate
+        """
         # Exception raised if basic networking not enabled on the cluster
-        heat_template = HeatTemplate(self.deploy)
         if self._use_existing_network():
 
             # Add an external gateway if it doesn't exist
@@ -171,18 +355,61 @@ class Openstack:
             # Generate heat template
             heat_template.generate()
 
-        # Attempt to create stack with heat template
-        self._build_stack_from_template()
+    def _generate_template_for_stack(self, heat_template, stack):
+        # type: (HeatTemplate, object) -> None
+        """
+        Generate the heat template using the same network setup as an existing stack, so that the stack's own
+        network is never mistaken for an existing project network
+        :param heat_template: The heat template to generate
+        :param stack: The existing REDstack heat stack
+        """
+        existing_template = retry(self.heat.stacks.template, self.retry_policy, self.retry_exceptions, stack.id)
 
-        # Get node information and create list of Node objects
-        retry(self._populate_node_object_list, self.retries, self.retry_exceptions)
+        if 'rs_network' in existing_template['resources']:
+            heat_template.generate()
+        else:
+            heat_template.generate_with_existing_network(
+                existing_template['parameters']['private_subnet']['default'],
+                existing_template['parameters']['private_network']['default'])
+
+    def _get_existing_stack(self):
+        # type: () -> object or None
+        """
+        Return the existing REDstack heat stack of the project if there is one
+        :raises ExistingNonRedstackResourcesException: if other stacks exist on the project
+        :return: The heat stack or None
+        """
+        stack_list = self._get_heat_stacks()
+
+        if len(stack_list) > 1:
+            raise ExistingNonRedstackResourcesException("Non-Redstack resources exist on this project.")
+        elif len(stack_list) == 1 and stack_list[0].stack_name.lower() == self.deploy.stack_name:
+            return stack_list[0]
+
+        return None
+
+    def _get_stack_fingerprint(self, stack):
+        # type: (object) -> str or None
+        """
+        Return the template fingerprint a stack was tagged with when it was created or updated
+        :param stack: The heat stack
+        :return: The fingerprint, or None if the stack was not tagged with one
+        """
+        stack_dict = retry(self.heat.stacks.get, self.retry_policy, self.retry_exceptions, stack.id).to_dict()
+
+        for tag in stack_dict.get('tags') or []:
+            if tag.startswith('fingerprint-'):
+                return tag[len('fingerprint-'):]
+
+        return None
 
     def rebuild(self):
         # type: () -> None
         """ Rebuild an exisiting stack in Openstack.
 
         This method coordinates the rebuild of an existing REDstack stack in Openstack. Each server is rebuilt using
-        Nova API, and attached volumes are reformatted and attached back to Nodes.
+        Nova API, and attached volumes are reformatted and attached back to Nodes. When preserve_data_volumes is set
+        only the root disk is reimaged, and the existing filesystem on each volume is mounted back in place.
 
         :return: Cluster object associated with this deployment
         """
@@ -194,6 +421,8 @@ class Openstack:
 
         logger.info("Starting Openstack rebuild with existing resources.")
 
+        self._use_baked_image()
+
         rebuild_threads = []
         for server in servers:
             rebuild_threads.append(Thread(target=self._rebuild_server, args=[server]))
@@ -212,14 +441,15 @@ class Openstack:
                 os._exit(1)
 
         # Get node information and create list of Node objects
-        retry(self._populate_node_object_list, self.retries, self.retry_exceptions)
+        retry(self._populate_node_object_list, self.retry_policy, self.retry_exceptions)
         self.deploy.cluster.private_key = os.path.join(self.deploy.directory, self.deploy.key_name)
 
     def _rebuild_server(self, server):
         # type: (Server) -> None
         """ 
         Rebuild a single Openstack server
-        Server rebuild has two parts, a rebuild using Nova API and a volume reformat using chef.
+        Server rebuild has two parts, a rebuild using Nova API and a volume reformat using chef, or a remount of the
+        existing volume when data volumes are preserved.
         :param: server - Openstack server to rebuild
         """
         try:
@@ -230,7 +460,14 @@ class Openstack:
             Openstack.rebuild_node(self.deploy, node)
             logger.info("Successfully rebuilt {0}".format(node.name))
 
-            unmount(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key)
+            # Any pooled connection went down with the old image
+            self.deploy.ssh_pool.discard(node.floating_ip, self.deploy.cluster.ssh_user)
+
+            if self.deploy.preserve_data_volumes:
+                remount(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key, self.deploy.ssh_pool,
+                        self.deploy.volume_device, self.deploy.mount_location)
+            else:
+                unmount(node, self.deploy.cluster.ssh_user, self.deploy.cluster.private_key, self.deploy.ssh_pool)
         except:
             self.thread_exception = True
             raise
@@ -251,22 +488,23 @@ class Openstack:
         else:
             return False
 
-    def _build_stack_from_template(self):
-        # type: () -> None
+    def _build_stack_from_template(self, heat_template):
+        # type: (HeatTemplate) -> None
         """ 
         Create a stack in Openstack using Heat API and generated Heat template.
 
-        The Heat template is created using a template file and heat_template module. Once this template is created,
-        an attempt is made to build the stack using Heat API. Return true if the stack build is successful, otherwise
+        The Heat template is rendered by the heat_template module. Once this template is rendered, an attempt is made
+        to build the stack using Heat API with the rendered template. Return true if the stack build is successful, otherwise
         false is returned.
 
+        :param heat_template: The generated heat template, its fingerprint is tagged onto the stack
         :return: True if creation succeeded, False if it failed and should be retried on next Vlan
         """
-        template = open(os.path.join(self.deploy.directory, "template.yml"), "r")
-
         logger.info("Starting stack build process.")
 
-        stack = self.heat.stacks.create(stack_name=self.deploy.stack_name, template=template.read(), parameters={})
+        stack = self.heat.stacks.create(stack_name=self.deploy.stack_name, template=heat_template.rendered,
+                                        parameters=heat_template.parameters,
+                                        tags='fingerprint-{0}'.format(heat_template.fingerprint))
         uid = stack["stack"]["id"]
         stack = self.heat.stacks.get(stack_id=uid).to_dict()
 
@@ -281,11 +519,43 @@ class Openstack:
         elif stack["stack_status"] == "CREATE_FAILED":
             logger.error("Reason for stack build failure: {0}".format(stack["stack_status_reason"]))
 
-            if len(self._get_heat_stacks()) > 0:
+            if self.has_stacks():
                 self._cleanup_existing_resources()
 
             raise HeatException(stack["stack_status_reason"])
 
+    def _update_stack_from_template(self, stack_id, heat_template):
+        # type: (str, HeatTemplate) -> None
+        """
+        Update an existing stack in Openstack using Heat API and the generated Heat template.
+
+        Heat only replaces the resources that differ from the existing stack, so nodes whose definition is unchanged
+        keep running.
+
+        :param stack_id: The id of the existing stack
+        :param heat_template: The generated heat template, its fingerprint is tagged onto the stack
+        :raises HeatException: if the stack fails to update
+        """
+        logger.info("Starting stack update process.")
+
+        # The engine may not have flipped the stack status yet when the update call returns
+        previous_update = self.heat.stacks.get(stack_id=stack_id).to_dict().get("updated_time")
+
+        self.heat.stacks.update(stack_id, template=heat_template.rendered, parameters=heat_template.parameters,
+                                tags='fingerprint-{0}'.format(heat_template.fingerprint))
+        stack = self.heat.stacks.get(stack_id=stack_id).to_dict()
+
+        while stack["stack_status"] == "UPDATE_IN_PROGRESS" or stack.get("updated_time") == previous_update:
+            logger.info("Stack update in progress. {0} servers exist".format(len(self._get_servers())))
+            time.sleep(self.sleep)
+            stack = self.heat.stacks.get(stack_id=stack_id).to_dict()
+
+        if stack["stack_status"] == "UPDATE_COMPLETE":
+            logger.info("Stack update complete.")
+        else:
+            logger.error("Reason for stack update failure: {0}".format(stack["stack_status_reason"]))
+            raise HeatException(stack["stack_status_reason"])
+
     def _cleanup_existing_resources(self):
         # type: () -> None
         """ 
@@ -305,7 +575,7 @@ class Openstack:
             logger.info("Found existing REDstack resources, scheduling them for deletion")
 
             # Allow multiple stack delete attempts
-            retry(self._destroy_existing_resources, 3, HeatException, stack_list[0].id)
+            retry(self._destroy_existing_resources, 'heat_delete', HeatException, stack_list[0].id)
 
         # If any resources remain... raise error
         for i in range(self.retries):
@@ -341,7 +611,7 @@ class Openstack:
         self._delete_floating_ip_list(self._get_floating_ips())
 
         logger.info("Starting deletion of remaining stack resources.")
-        retry(self.heat.stacks.delete, self.retries, Exception, stack_id)
+        retry(self.heat.stacks.delete, self.retry_policy, Exception, stack_id)
 
         stack = self.heat.stacks.get(stack_id=stack_id).to_dict()
         while stack["stack_status"] == "DELETE_IN_PROGRESS":
@@ -395,7 +665,7 @@ class Openstack:
         :return: None
         """
         try:
-            retry(self.neutron.delete_floatingip, self.retries, self.retry_exceptions, ip['id'])
+            retry(self.neutron.delete_floatingip, self.retry_policy, self.retry_exceptions, ip['id'])
         except neutronclient.exceptions.NotFound:
             logger.warning("Neutron claims the {0} wasn't found, "
                            "probably because it's already deleted".format(ip['id']))
@@ -416,7 +686,9 @@ class Openstack:
         server_list = self._get_servers()
         for server in server_list:
             node = self.deploy.cluster.get_node(server.name)
-            node.ram = self.nova.flavors.get(server.flavor["id"]).ram
+            flavor = self.nova.flavors.get(server.flavor["id"])
+            node.ram = flavor.ram
+            node.vcpus = flavor.vcpus
             node.server_id = server.id
             node.internal_ip = server.networks.values()[0][0]
             node.floating_ip = server.networks.values()[0][1]
@@ -441,13 +713,42 @@ class Openstack:
         logger.info("Created new Private Key file for Openstack deployment")
         return key_path
 
+    def _reuse_stack_private_key(self, stack):
+        # type: (object) -> str
+        """
+        Reuse the keypair an existing stack was built with, and copy its private key from the deployment directory
+        that created it to the current one.
+
+        :param stack: The existing REDstack heat stack
+        :raises ConfigException: if the private key of the keypair is no longer on the deploy host
+        :return: absolute path to key file
+        """
+        stack_dict = retry(self.heat.stacks.get, self.retry_policy, self.retry_exceptions, stack.id).to_dict()
+        key_name = stack_dict['parameters']['key_name']
+
+        # Generated keypairs are named after the deployment that created them, see _create_private_key
+        existing_key_path = os.path.join(self.deploy.directory_base, key_name, key_name)
+        if not os.path.exists(existing_key_path):
+            raise ConfigException('The existing stack uses keypair {0} but its private key is not at {1}, set key_name '
+                                  'to reuse the stack'.format(key_name, existing_key_path))
+
+        self.deploy.key_name = key_name
+        self.deploy.cluster.key_name = key_name
+
+        key_path = os.path.join(self.deploy.directory, key_name)
+        shutil.copyfile(existing_key_path, key_path)
+        os.chmod(key_path, 0o400)
+
+        logger.info("Reusing keypair {0} of the existing stack".format(key_name))
+        return key_path
+
     def _get_servers(self):
         # type: () -> []
         """ 
         Return list of Server objects that belong the the Openstack project.
         :return: List of Server objects belonging to Openstack project.
         """
-        servers = retry(self.nova.servers.list, self.retries, self.retry_exceptions)
+        servers = retry(self.nova.servers.list, self.retry_policy, self.retry_exceptions)
         return servers
 
     def _get_networks(self):
@@ -456,7 +757,7 @@ class Openstack:
         Return list of Network objects associated with Openstack project.
         :return:
         """
-        raw_networks = retry(self.neutron.list_networks, self.retries, self.retry_exceptions)
+        raw_networks = retry(self.neutron.list_networks, self.retry_policy, self.retry_exceptions)
         return raw_networks['networks']
 
     def _get_subnets(self):
@@ -465,7 +766,7 @@ class Openstack:
         Return list of Subnets associated with Openstack project.
         :return: list of subnets
         """
-        raw_subnets = retry(self.neutron.list_subnets, self.retries, self.retry_exceptions)
+        raw_subnets = retry(self.neutron.list_subnets, self.retry_policy, self.retry_exceptions)
         return raw_subnets['subnets']
 
     def _get_floating_ips(self):
@@ -474,7 +775,7 @@ class Openstack:
         Return list of Floating IPs belonging to this Openstack project.
         :return: list of floating ips
         """
-        raw_floatingips = retry(self.neutron.list_floatingips, self.retries, self.retry_exceptions)
+        raw_floatingips = retry(self.neutron.list_floatingips, self.retry_policy, self.retry_exceptions)
         return raw_floatingips["floatingips"]
 
     def _get_routers(self):
@@ -483,7 +784,7 @@ class Openstack:
         Return list of Routers associated with this Openstack project.
         :return: list of routers
         """
-        routers = retry(self.neutron.list_routers, self.retries, self.retry_exceptions)
+        routers = retry(self.neutron.list_routers, self.retry_policy, self.retry_exceptions)
         return routers["routers"]
 
     def _get_heat_stacks(self):
@@ -492,7 +793,7 @@ class Openstack:
         Return list of heat templates existing for this Openstack project.
         :return: list of heat stacks
         """
-        raw_stacks = retry(self.heat.stacks.list, self.retries, self.retry_exceptions)
+        raw_stacks = retry(self.heat.stacks.list, self.retry_policy, self.retry_exceptions)
         return list(raw_stacks)
 
     def _get_cinder_volumes(self):
@@ -501,7 +802,7 @@ class Openstack:
         Return list of cinder volumes existing in this Openstack project.
         :return: list of cinder volumes
         """
-        volumes = retry(self.cinder.volumes.list, self.retries, self.retry_exceptions)
+        volumes = retry(self.cinder.volumes.list, self.retry_policy, self.retry_exceptions)
         return volumes
 
 
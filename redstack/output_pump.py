@@ -0,0 +1,251 @@
+""" Module for capturing the output of many subprocesses from a single thread.
+
+The stdout and stderr pipes of every registered process are read by one poll loop as soon as data arrives, so a process
+never blocks on a full pipe, whichever stream it writes to. Each line is written to the log file of its process with a
+timestamp and the stream it came from, optionally gzip compressed, and the last lines are kept in memory for error
+reports.
+"""
+
+import datetime
+import errno
+import gzip
+import io
+import logging
+import os
+import select
+import subprocess
+import threading
+from collections import deque
+from threading import Thread
+
+logger = logging.getLogger("root_logger")
+
+
+class PumpedProcess:
+    def __init__(self, name, process, log_file, tail_lines, echo):
+        # type: (str, subprocess.Popen, io.IOBase, int, any) -> None
+        """
+        Constructor for PumpedProcess
+        :param name: The name of the process, ex. the node it converges
+        :param process: The process whose output is captured
+        :param log_file: The open log file of the process
+        :param tail_lines: How many of the last lines to keep
+        :param echo: Called with the stream name and each line, or None
+        """
+        self.name = name
+        self.process = process
+        self.log_file = log_file
+        self.echo = echo
+
+        # The last lines of output, as (stream, line) tuples
+        self.tail = deque(maxlen=tail_lines)
+
+        self.open_streams = 2
+        self.finished = threading.Event()
+
+        # The cpu time and peak memory of the process and its children, once it has exited
+        self.usage = None
+
+        # What failed while capturing the output, so that each failure is logged once instead of once per line
+        self.failures = set()
+
+    def wait(self):
+        # type: () -> int
+        """
+        Blocks until the process has exited and all of its output is written to the log
+        :return: The return code of the process
+        """
+        self.finished.wait()
+
+        # Reaping the process with wait4 instead of Popen.wait also gives its resource usage
+        while self.process.returncode is None:
+            try:
+                pid, status, self.usage = os.wait4(self.process.pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # Reaped elsewhere, let Popen report what it knows
+                break
+
+            self.process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        return self.process.wait()
+
+    def tail_lines(self, stream=None):
+        # type: (str) -> [str]
+        """
+        :param stream: Only return lines from this stream, stdout or stderr, all lines if None
+        :return: The last lines of output
+        """
+        return [line for line_stream, line in self.tail if stream is None or line_stream == stream]
+
+
+class OutputPump:
+    def __init__(self, tail_lines=50, read_size=65536):
+        # type: (int, int) -> None
+        """
+        Constructor for OutputPump
+        :param tail_lines: How many of the last lines to keep in memory per process
+        :param read_size: The most bytes to read from a pipe at once
+        """
+        self.tail_lines = tail_lines
+        self.read_size = read_size
+
+        # The registered pipes, by file descriptor, as (pumped process, stream name, incomplete last line)
+        self._pipes = {}
+        self._lock = threading.Lock()
+
+        # The pipes added since the poll loop last woke up, which it has not registered yet
+        self._added = []
+
+        # Written to when a process is added, so that the poll loop picks up its pipes at once
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = None
+
+    def add(self, name, process, log_path, compress=False, header=None, echo=None):
+        # type: (str, subprocess.Popen, str, bool, str, any) -> PumpedProcess
+        """
+        Starts capturing the output of a process started with stdout and stderr pipes
+        :param name: The name of the process, ex. the node it converges
+        :param process: The process to capture
+        :param log_path: The log file to write to, .gz is appended when compressed
+        :param compress: Whether to gzip the log file
+        :param header: A line written at the top of the log file
+        :param echo: Called from the pump thread with the stream name and each line, ex. to log it, or None
+        :return: The handle to wait on the process with
+        """
+        if compress:
+            log_file = gzip.open(log_path + '.gz', 'wb')
+        else:
+            log_file = open(log_path, 'wb')
+
+        if header:
+            log_file.write('{0}\n'.format(header).encode('utf-8'))
+
+        pumped = PumpedProcess(name, process, log_file, self.tail_lines, echo)
+
+        with self._lock:
+            self._pipes[process.stdout.fileno()] = (pumped, 'stdout', [b''])
+            self._pipes[process.stderr.fileno()] = (pumped, 'stderr', [b''])
+            self._added.extend([process.stdout.fileno(), process.stderr.fileno()])
+
+            if self._thread is None:
+                self._thread = Thread(target=self._pump)
+                self._thread.daemon = True
+                self._thread.start()
+
+        os.write(self._wake_write, b'x')
+        return pumped
+
+    def _pump(self):
+        # type: () -> None
+        """
+        Reads every registered pipe as data arrives, for the lifetime of the process
+        """
+        # poll instead of select, so that hundreds of processes are not limited by FD_SETSIZE
+        poller = select.poll()
+        poller.register(self._wake_read, select.POLLIN)
+
+        while True:
+            with self._lock:
+                added, self._added = self._added, []
+            for fd in added:
+                poller.register(fd, select.POLLIN)
+
+            try:
+                events = poller.poll()
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == self._wake_read:
+                    os.read(self._wake_read, 4096)
+                    continue
+
+                with self._lock:
+                    pumped, stream, partial = self._pipes[fd]
+
+                try:
+                    data = os.read(fd, self.read_size)
+                    if data:
+                        self._write(pumped, stream, data, partial)
+                        continue
+                except Exception:
+                    # A failing pipe must not stop the other processes from being pumped
+                    logger.exception('Failed to capture the {0} of {1}'.format(stream, pumped.name))
+
+                # Unregistered before the pipe is closed, as a new pipe may be given the same file descriptor
+                poller.unregister(fd)
+                self._close(fd, pumped, stream, partial)
+
+    def _write(self, pumped, stream, data, partial):
+        # type: (PumpedProcess, str, bytes, [bytes]) -> None
+        """
+        Writes the complete lines of a chunk of output to the log with a timestamp, keeping the incomplete last line
+        :param pumped: The process the output came from
+        :param stream: stdout or stderr
+        :param data: The chunk of output
+        :param partial: A one element list holding the incomplete last line of the previous chunk
+        """
+        lines = (partial[0] + data).split(b'\n')
+        partial[0] = lines.pop()
+
+        prefix = '{0} [{1}] '.format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                                     stream).encode('utf-8')
+        for line in lines:
+            line = line.rstrip(b'\r')
+            try:
+                pumped.log_file.write(prefix + line + b'\n')
+            except Exception:
+                # A failing log file must not lose the tail of the output or stop the pipe from being drained
+                self._log_failure(pumped, 'write the log of')
+
+            text = line.decode('utf-8', 'replace')
+            pumped.tail.append((stream, text))
+            if pumped.echo:
+                try:
+                    pumped.echo(stream, text)
+                except Exception:
+                    self._log_failure(pumped, 'echo the output of')
+
+    @staticmethod
+    def _log_failure(pumped, action):
+        # type: (PumpedProcess, str) -> None
+        """
+        Logs the exception being handled, the first time the action fails for the process
+        :param pumped: The process whose output could not be handled
+        :param action: What failed, ex. 'echo the output of'
+        """
+        if action not in pumped.failures:
+            pumped.failures.add(action)
+            logger.exception('Failed to {0} {1}'.format(action, pumped.name))
+
+    def _close(self, fd, pumped, stream, partial):
+        # type: (int, PumpedProcess, str, [bytes]) -> None
+        """
+        Stops reading a pipe that reached the end of its output, and finishes the process once both pipes have
+        :param fd: The file descriptor of the pipe
+        :param pumped: The process of the pipe
+        :param stream: stdout or stderr
+        :param partial: The incomplete last line of the pipe
+        """
+        if partial[0]:
+            self._write(pumped, stream, b'\n', partial)
+
+        with self._lock:
+            del self._pipes[fd]
+
+        getattr(pumped.process, stream).close()
+
+        pumped.open_streams -= 1
+        if pumped.open_streams == 0:
+            try:
+                pumped.log_file.close()
+            except Exception:
+                self._log_failure(pumped, 'write the log of')
+            finally:
+                pumped.finished.set()
@@ -0,0 +1,102 @@
+""" Module for resizing the nodes of an existing cluster to a new flavor.
+
+Nodes are resized in batches so the rest of the cluster keeps serving while a batch is down. Ambari components on each
+node are stopped before the Nova resize and started again once the resize is confirmed.
+"""
+
+import logging
+import sys
+
+import helper_functions
+from ambari import Ambari
+from blueprints import BlueprintBuilder
+from domain.cluster import Cluster
+from domain.deploy import Deploy
+from openstack import Openstack
+
+logger = logging.getLogger('root_logger')
+
+
+def resize(config_file, cluster_file, node_types, flavor, batch_size=1):
+    # type: (str, str, [str], str, int) -> None
+    """
+    Moves all nodes of the given node types to a new flavor, one batch at a time.
+    :param config_file: Path to main configuration file
+    :param cluster_file: Path to the cluster json of the deployed cluster, updated once the resize completes
+    :param node_types: The node types from the cluster template to resize, ex. rs-data
+    :param flavor: The name of the flavor to resize the nodes to
+    :param batch_size: How many nodes to resize at the same time
+    :return: None
+    """
+    cluster = Cluster(json_file=cluster_file)
+    deploy = Deploy(config_file=config_file, cluster=cluster)
+    logger.setLevel(deploy.log_level)
+
+    ambari = Ambari(deploy, installed=True)
+    nodes = cluster.select_nodes(node_types=node_types)
+
+    logger.info('Resizing {0} nodes to {1} in batches of {2}'.format(len(nodes), flavor, batch_size))
+
+    for i in range(0, len(nodes), batch_size):
+        batch = nodes[i:i + batch_size]
+
+        stopped_components = {}
+        for node in batch:
+            stopped_components[node.name] = ambari.stop_host_components(node)
+
+        for node in batch:
+            Openstack.resize_node(deploy, node, flavor)
+            logger.info('Resized {0} to {1}'.format(node.name, flavor))
+
+        # The agent must register again before ambari can start anything on the node
+        for node in batch:
+            ambari.wait_for_host(node)
+            ambari.start_host_components(node, stopped_components[node.name])
+
+        # Persist progress after every batch so an interrupted resize leaves an accurate cluster json
+        with open(cluster_file, 'w') as cluster_json_file:
+            cluster_json_file.write(cluster.to_json())
+
+    _update_yarn_memory(deploy, ambari)
+    ambari.close()
+
+    logger.info('REDstack resize completed for {0}'.format(', '.join(node_types)))
+
+
+def _update_yarn_memory(deploy, ambari):
+    # type: (Deploy, Ambari) -> None
+    """
+    Sizes the yarn memory settings for the smallest NodeManager host, and restarts the yarn daemons to apply them
+    :param deploy: The current deploy
+    :param ambari: An ambari client for the installed cluster
+    """
+    blueprint_builder = BlueprintBuilder(deploy)
+    nodemanager_groups = blueprint_builder.get_groups_with_component('NODEMANAGER')
+    resourcemanager_groups = blueprint_builder.get_groups_with_component('RESOURCEMANAGER')
+
+    nodemanagers = [node for node in deploy.cluster.nodes if node.ambari_group in nodemanager_groups]
+    resourcemanagers = [node for node in deploy.cluster.nodes if node.ambari_group in resourcemanager_groups]
+
+    if not nodemanagers:
+        return
+
+    ram = min([node.ram for node in nodemanagers])
+    ambari.update_configuration('yarn-site', BlueprintBuilder.yarn_memory_properties(ram))
+    ambari.restart_components('YARN', 'NODEMANAGER', nodemanagers)
+
+    # The maximum allocation is enforced by the ResourceManager
+    if resourcemanagers:
+        ambari.restart_components('YARN', 'RESOURCEMANAGER', resourcemanagers)
+
+
+if __name__ == "__main__":
+    helper_functions.setup_logger()
+    logger = logging.getLogger('root_logger')
+
+    args = helper_functions.parse_args()
+
+    if not args.node_types or not args.flavor or args.batch_size < 1:
+        sys.exit('usage: resize.py --config CONFIG --cluster CLUSTER --node-types TYPE[,TYPE...] --flavor FLAVOR '
+                 '[--batch-size N]')
+
+    resize(args.config, args.cluster, args.node_types.split(','), args.flavor, args.batch_size)
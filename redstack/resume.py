@@ -0,0 +1,59 @@
+import logging
+import os
+
+import helper_functions
+import retry_policy
+from blueprints import BlueprintBuilder
+from chef import Chef
+from domain.cluster import Cluster
+from domain.deploy import Deploy
+from install import install_ambari
+
+logger = logging.getLogger('root_logger')
+
+
+def resume(config_file, directory, cluster_file=None):
+    """
+    Resumes a deployment whose Chef converge failed or was aborted. Only the nodes that did not succeed are converged
+    again, then the Ambari install runs as it would have.
+    :param: config_file - Path to main configuration file
+    :param: directory - Path to the existing deployment directory
+    :param: cluster_file - Path to the cluster json, the one in the deployment directory if None
+    :return: None
+    """
+    logger.info("Resuming the deployment in {0}".format(directory))
+
+    cluster = Cluster(json_file=cluster_file or os.path.join(directory, 'cluster.json'))
+    deploy = Deploy(config_file=config_file, cluster=cluster, directory=directory)
+
+    # Update logging handler to reflect process configuration
+    logger.setLevel(deploy.log_level)
+
+    # Build blueprints for ambari
+    blueprint_builder = BlueprintBuilder(deploy)
+    blueprint_builder.create_all()
+
+    # Chef phase, the control sockets of the ssh_config may have been cleaned up since the deploy
+    chef = Chef(deploy)
+    chef.multiplexer.write_config()
+    try:
+        chef.resume()
+    finally:
+        chef.multiplexer.close_all(deploy.cluster.nodes)
+
+    # Ambari phase
+    install_ambari(deploy)
+
+    deploy.ssh_pool.close()
+    retry_policy.log_summary()
+
+    logger.info('REDstack install completed - Ambari: https://{0}:8443'.format(deploy.cluster.master_node.floating_ip))
+
+
+if __name__ == "__main__":
+    helper_functions.setup_logger()
+    logger = logging.getLogger('root_logger')
+
+    args = helper_functions.parse_args()
+
+    resume(args.config, args.directory)
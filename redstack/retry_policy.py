@@ -0,0 +1,248 @@
+""" Module for the retry policies of calls to remote services.
+
+A policy retries with exponential backoff and jitter until it runs out of tries or reaches its deadline. Every policy
+is named after the service or endpoint it protects, has a retry budget shared by all calls made with it, and can trip a
+circuit breaker that fails calls fast while the service is down. Policies are configured under retry_policies in
+rs_conf.yml.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from redstack.exceptions import CircuitOpenException, ConfigException
+
+logger = logging.getLogger("root_logger")
+
+# Defaults for the policies used by REDstack, overridden by retry_policies in rs_conf.yml
+DEFAULT_POLICIES = {
+    'default': {'tries': 5, 'base_delay': 1, 'max_delay': 30},
+    'openstack': {'tries': 5, 'base_delay': 1, 'max_delay': 30, 'circuit_breaker_threshold': 20},
+    'heat_delete': {'tries': 3, 'base_delay': 5, 'max_delay': 60},
+    'ambari': {'tries': 5, 'base_delay': 1, 'max_delay': 30, 'circuit_breaker_threshold': 20},
+    'ambari_blueprint': {'tries': 40, 'base_delay': 2, 'max_delay': 30, 'deadline': 900},
+    'ssh': {'tries': 5, 'base_delay': 1, 'max_delay': 20}
+}
+
+
+class RetryPolicy:
+    def __init__(self, name, tries=5, base_delay=1, max_delay=30, multiplier=2, jitter=0.5, deadline=None,
+                 budget=None, circuit_breaker_threshold=None, circuit_breaker_reset=60):
+        # type: (str, int, float, float, float, float, float, int, int, float) -> None
+        """
+        Constructor for RetryPolicy
+        :param name: The name of the policy, used in logs
+        :param tries: Maximum number of attempts of a single call
+        :param base_delay: Seconds to wait after the first failure
+        :param max_delay: Longest wait between two attempts
+        :param multiplier: Growth of the wait after every failure
+        :param jitter: Fraction of the wait that is randomized, so that parallel callers do not retry in lockstep
+        :param deadline: Seconds after which a call is not retried anymore, regardless of tries left
+        :param budget: Total retries allowed across all calls made with this policy, unlimited if None
+        :param circuit_breaker_threshold: Consecutive failed calls that open the circuit, disabled if None
+        :param circuit_breaker_reset: Seconds the circuit stays open before a trial call is let through
+        """
+        self.name = name
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.budget = budget
+        self.circuit_breaker = CircuitBreaker(name, circuit_breaker_threshold, circuit_breaker_reset) \
+            if circuit_breaker_threshold else None
+
+        # Statistics across all calls made with this policy
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt):
+        # type: (int) -> float
+        """
+        Returns the wait after a failed attempt
+        :param attempt: The number of the failed attempt, starting at 0
+        :return: Seconds to wait before the next attempt
+        """
+        delay = min(self.base_delay * self.multiplier ** attempt, self.max_delay)
+        return delay * (1 - self.jitter) + delay * self.jitter * random.random()
+
+    def call(self, func, exceptions, *args, **kwargs):
+        # type: (any, tuple or Exception, args) -> any
+        """
+        Calls a function, retrying it according to the policy
+        :param func: A method to execute
+        :param exceptions: Exceptions to retry when caught
+        :param args: args to pass to the function
+        :raises CircuitOpenException: if the circuit of the policy is open
+        :return: The return value of the function
+        """
+        start = time.time()
+
+        with self._lock:
+            self.calls += 1
+
+        for attempt in range(self.tries):
+            if self.circuit_breaker and self.circuit_breaker.is_open():
+                with self._lock:
+                    self.failures += 1
+                raise CircuitOpenException('Circuit for {0} is open after {1} consecutive failures'.format(
+                    self.name, self.circuit_breaker.consecutive_failures))
+
+            try:
+                result = func(*args, **kwargs)
+            except exceptions as e:
+                if self.circuit_breaker:
+                    self.circuit_breaker.record_failure()
+
+                delay = self.delay(attempt)
+                out_of_time = self.deadline is not None and time.time() - start + delay > self.deadline
+                circuit_open = self.circuit_breaker is not None and self.circuit_breaker.is_open()
+
+                if attempt == self.tries - 1 or out_of_time or circuit_open or not self._take_from_budget():
+                    with self._lock:
+                        self.failures += 1
+                    logger.warning('{0} failed after {1} tries under retry policy {2}'.format(
+                        func.__name__, attempt + 1, self.name))
+                    raise
+
+                logger.info('{0} failed on try {1} with {2}, retrying in {3:.1f}s under retry policy {4}'.format(
+                    func.__name__, attempt, e, delay, self.name))
+                time.sleep(delay)
+            else:
+                if self.circuit_breaker:
+                    self.circuit_breaker.record_success()
+                if attempt > 0:
+                    logger.info('{0} succeeded after {1} tries under retry policy {2}'.format(
+                        func.__name__, attempt + 1, self.name))
+                return result
+
+    def _take_from_budget(self):
+        # type: () -> bool
+        """
+        Takes one retry from the budget of the policy
+        :return: False if the budget is exhausted
+        """
+        with self._lock:
+            if self.budget is not None and self.retries >= self.budget:
+                logger.warning('Retry budget of {0} exhausted for retry policy {1}'.format(self.budget, self.name))
+                return False
+            self.retries += 1
+            return True
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold, reset_timeout):
+        # type: (str, int, float) -> None
+        """
+        Constructor for CircuitBreaker
+        :param name: The name of the protected service, used in logs
+        :param threshold: Consecutive failures that open the circuit
+        :param reset_timeout: Seconds the circuit stays open before a trial call is let through
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        # type: () -> bool
+        """
+        Returns whether calls should fail fast, once the reset timeout has passed a trial call is let through again
+        :return: True if the circuit is open
+        """
+        with self._lock:
+            return self.opened_at is not None and time.time() - self.opened_at < self.reset_timeout
+
+    def record_failure(self):
+        # type: () -> None
+        """
+        Records a failed call, opening the circuit once the threshold is reached
+        """
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning('Opening circuit for {0} after {1} consecutive failures'.format(
+                        self.name, self.consecutive_failures))
+                self.opened_at = time.time()
+
+    def record_success(self):
+        # type: () -> None
+        """
+        Records a successful call, closing the circuit
+        """
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('Closing circuit for {0}'.format(self.name))
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def configure(policy_config):
+    # type: ({}) -> None
+    """
+    Creates the retry policies from the defaults, overridden by the retry_policies section of rs_conf.yml
+    :param policy_config: A dictionary of policy names to policy options
+    :raises ConfigException: if a policy has an unknown option
+    """
+    merged = dict((name, dict(options)) for name, options in DEFAULT_POLICIES.items())
+    for name, options in (policy_config or {}).items():
+        merged.setdefault(name, {}).update(options)
+
+    with _policies_lock:
+        _policies.clear()
+        for name, options in merged.items():
+            try:
+                _policies[name] = RetryPolicy(name, **options)
+            except TypeError as e:
+                raise ConfigException('Invalid retry policy {0}: {1}'.format(name, e))
+
+
+def get_policy(policy):
+    # type: (str or int or RetryPolicy) -> RetryPolicy
+    """
+    Returns a retry policy
+    :param policy: The name of a configured policy, a policy, or a number of tries with the default backoff
+    :return: A retry policy
+    """
+    if isinstance(policy, RetryPolicy):
+        return policy
+
+    if not _policies:
+        configure({})
+
+    if isinstance(policy, int):
+        default = _policies['default']
+        return RetryPolicy('{0}-tries'.format(policy), tries=policy, base_delay=default.base_delay,
+                           max_delay=default.max_delay, multiplier=default.multiplier, jitter=default.jitter)
+
+    if policy not in _policies:
+        with _policies_lock:
+            if policy not in _policies:
+                options = dict((key, value) for key, value in DEFAULT_POLICIES['default'].items())
+                _policies[policy] = RetryPolicy(policy, **options)
+
+    return _policies[policy]
+
+
+def log_summary():
+    # type: () -> None
+    """
+    Logs how many calls, retries and failures each policy saw
+    """
+    for name in sorted(_policies.keys()):
+        policy = _policies[name]
+        if policy.calls:
+            logger.info('Retry policy {0}: {1} calls, {2} retries, {3} failures'.format(
+                name, policy.calls, policy.retries, policy.failures))
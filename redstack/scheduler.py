@@ -0,0 +1,481 @@
+""" Module for scheduling Chef converges across the nodes of a cluster.
+
+Nodes are queued as they become reachable and converged by priority, the primary node first among equals, with at
+most a given number of converges running at the same time. Each converge reports back the moment it finishes, which
+frees its slot for the next node. A throttle can further hold starts back while the deploy host is short on memory or
+CPU.
+
+Node types in the cluster template can provide and require named milestones, ex. kdc-ready. A node is only queued once
+every milestone it requires is reached. A milestone is reached when every node providing it has converged, or earlier
+when the template gives it a check command that succeeds on all of them.
+
+The state of every node, pending, running, succeeded or failed, can be checkpointed to a json file as the converge goes,
+so that an aborted converge can be resumed with only the nodes that did not succeed.
+"""
+
+import datetime
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from Queue import Queue, Empty
+from threading import Thread
+
+from domain.node import Node
+from fanout import FanOut
+from host_resources import ProcessThrottle
+from redstack.exceptions import ConfigException
+
+logger = logging.getLogger("root_logger")
+
+
+class ConvergeScheduler:
+    def __init__(self, max_concurrency, milestones=None, status_interval=30, state=None, throttle=None):
+        # type: (int, MilestoneTracker, int, ConvergeState, ProcessThrottle) -> None
+        """
+        Constructor for ConvergeScheduler
+        :param max_concurrency: The most converges to run at the same time
+        :param milestones: Tracks the milestones nodes wait for, no node waits if None
+        :param status_interval: Seconds between status lines while nothing starts or finishes
+        :param state: Records when each node starts and finishes, nothing is recorded if None
+        :param throttle: Decides whether the deploy host can take another converge, only max_concurrency applies if None
+        """
+        self.max_concurrency = max_concurrency
+        self.milestones = milestones
+        self.status_interval = status_interval
+        self.state = state
+        self.throttle = throttle
+
+        # Events from the feeder, milestone and converge threads, as (kind, node, detail) tuples. The detail is the
+        # error of a failed converge, or the name of a reached milestone
+        self._events = Queue()
+
+        self.queued = []
+        self.blocked = []
+        self.running = {}
+        self.started = {}
+        self.succeeded = []
+        self.failed = []
+        self.waiting = 0
+
+    def run(self, ready_nodes, converge, node_count):
+        # type: (iter, any, int) -> [Node]
+        """
+        Converges nodes as they become ready, lowest priority value first, and blocks until every node has finished or a
+        converge has failed. No converge starts after a failure, the running ones are waited for so that their outcome
+        is known.
+        :param ready_nodes: An iterable of the nodes in the order they become ready to converge, ex. a readiness scan
+        :param converge: The function converging a single node, called with the node and raising on failure
+        :param node_count: How many nodes ready_nodes will produce
+        :return: The nodes that failed to converge, empty on success
+        """
+        self.waiting = node_count
+
+        feeder = Thread(target=self._feed, args=[ready_nodes])
+        feeder.daemon = True
+        feeder.start()
+
+        done = threading.Event()
+        poller = Thread(target=self._poll_milestones, args=[done])
+        poller.daemon = True
+        if self.milestones:
+            poller.start()
+
+        try:
+            return self._schedule(converge, node_count)
+        finally:
+            done.set()
+            if poller.is_alive():
+                poller.join()
+
+    def _schedule(self, converge, node_count):
+        # type: (any, int) -> [Node]
+        """
+        Handles events until every node has finished, or a converge has failed and the running ones have finished
+        :param converge: The function converging a single node
+        :param node_count: How many nodes the feeder will produce
+        :return: The nodes that failed to converge
+        """
+
+        last_status = time.time()
+        while len(self.succeeded) + len(self.failed) < node_count:
+            # Queued nodes held back by the throttle are offered to it again shortly
+            timeout = self.throttle.recheck_interval if self.throttle and self.queued else self.status_interval
+
+            try:
+                events = [self._events.get(timeout=timeout)]
+            except Empty:
+                if not self.failed:
+                    self._start_queued(converge)
+                if time.time() - last_status >= self.status_interval:
+                    self._log_status()
+                    last_status = time.time()
+                continue
+
+            # Take every event that is already waiting, so that nodes ready at the same time are started by priority
+            while True:
+                try:
+                    events.append(self._events.get_nowait())
+                except Empty:
+                    break
+
+            for kind, node, detail in events:
+                if kind == 'ready':
+                    self.waiting -= 1
+                    self.blocked.append(node)
+                elif kind == 'feed_error':
+                    raise detail
+                elif kind == 'milestone':
+                    logger.info('Milestone {0} reached'.format(detail))
+                else:
+                    del self.running[node.name]
+                    duration = time.time() - self.started[node.name]
+                    if detail is None:
+                        self.succeeded.append(node)
+                        logger.info('Converged {0} in {1:.0f}s'.format(node.name, duration))
+                        if self.milestones:
+                            for milestone in self.milestones.node_converged(node):
+                                logger.info('Milestone {0} reached'.format(milestone))
+                    else:
+                        self.failed.append(node)
+                        logger.error('Converge of {0} failed after {1:.0f}s - {2}'.format(node.name, duration, detail))
+
+                    if self.state:
+                        self.state.mark(node, 'failed' if detail else 'succeeded', detail)
+
+            if self.failed:
+                self._log_status()
+                if not self.running:
+                    return self.failed
+                logger.warning('Waiting for {0} running converges to finish'.format(len(self.running)))
+                continue
+
+            self._unblock()
+            self._start_queued(converge)
+
+            if any(kind == 'done' for kind, node, detail in events) \
+                    or time.time() - last_status > self.status_interval:
+                self._log_status()
+                last_status = time.time()
+
+        return self.failed
+
+    def _feed(self, ready_nodes):
+        # type: (iter) -> None
+        """
+        Moves nodes from the ready iterable onto the event queue
+        :param ready_nodes: An iterable of the nodes in the order they become ready
+        """
+        try:
+            for node in ready_nodes:
+                self._events.put(('ready', node, None))
+        except Exception as e:
+            self._events.put(('feed_error', None, e))
+
+    def _unblock(self):
+        # type: () -> None
+        """
+        Queues the ready nodes whose required milestones have all been reached
+        """
+        blocked = []
+        for node in self.blocked:
+            if self.milestones is None or self.milestones.is_satisfied(node):
+                heapq.heappush(self.queued, (node.priority, not node.primary, node.name, node))
+            else:
+                blocked.append(node)
+        self.blocked = blocked
+
+    def _poll_milestones(self, done):
+        # type: (threading.Event) -> None
+        """
+        Runs the milestone checks on the nodes being converged until the schedule is done
+        :param done: Set when the schedule is done
+        """
+        while not done.wait(self.milestones.poll_interval):
+            for milestone in self.milestones.poll(list(self.running.values())):
+                self._events.put(('milestone', None, milestone))
+
+    def _start_queued(self, converge):
+        # type: (any) -> None
+        """
+        Starts converging queued nodes until the concurrency limit is reached, or the throttle holds them back
+        :param converge: The function converging a single node
+        """
+        while self.queued and len(self.running) < self.max_concurrency:
+            if self.throttle and not self.throttle.admit(len(self.running)):
+                break
+
+            node = heapq.heappop(self.queued)[-1]
+            self.started[node.name] = time.time()
+            self.running[node.name] = node
+            if self.state:
+                self.state.mark(node, 'running')
+
+            thread = Thread(target=self._converge, args=[converge, node])
+            thread.daemon = True
+            thread.start()
+
+    def _converge(self, converge, node):
+        # type: (any, Node) -> None
+        """
+        Converges a node and reports the outcome on the event queue
+        :param converge: The function converging a single node
+        :param node: The node to converge
+        """
+        try:
+            converge(node)
+            self._events.put(('done', node, None))
+        except Exception as e:
+            logger.exception('Converge of {0} raised'.format(node.name))
+            self._events.put(('done', node, e))
+
+    def _log_status(self):
+        # type: () -> None
+        """
+        Logs the running, queued, waiting and finished nodes
+        """
+        running = sorted(self.running.keys())
+        shown = ', '.join(running[:10]) + (', ...' if len(running) > 10 else '')
+
+        logger.info('Chef: {0} running [{1}], {2} queued, {3} waiting for milestones, {4} waiting for ssh, {5} done, '
+                    '{6} failed{7}'.format(len(running), shown, len(self.queued), len(self.blocked), self.waiting,
+                                           len(self.succeeded), len(self.failed),
+                                           ' - deploy host ' + self.throttle.describe() if self.throttle else ''))
+
+
+class MilestoneTracker:
+    def __init__(self, nodes, checks=None, fan_out=None, poll_interval=10):
+        # type: ([Node], {}, FanOut, int) -> None
+        """
+        Constructor for MilestoneTracker
+        :param nodes: Every node of the converge, with the milestones it provides and requires
+        :param checks: Commands that succeed on a providing node once the milestone is reached there, by milestone
+        :param fan_out: Runs the checks, checks are not run if None
+        :param poll_interval: Seconds between two runs of the checks
+        :raises ConfigException: if a node requires a milestone that no node provides, or the milestones can never
+        all be reached
+        """
+        self.checks = checks or {}
+        self.fan_out = fan_out
+        self.poll_interval = poll_interval
+
+        # The names of the providing nodes that have not reached each milestone yet
+        self.pending = {}
+        for node in nodes:
+            for milestone in node.provides:
+                self.pending.setdefault(milestone, set()).add(node.name)
+
+        for node in nodes:
+            for milestone in node.requires:
+                if milestone not in self.pending:
+                    raise ConfigException('{0} requires milestone {1}, which no node provides'.format(
+                        node.name, milestone))
+
+        self._check_order(nodes)
+
+        self.reached = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _check_order(nodes):
+        # type: ([Node]) -> None
+        """
+        Checks that the node types can converge in some order. A milestone is reached once every node providing it has
+        converged, so a node type that requires a milestone it provides itself, or a cycle of node types that require
+        each other's milestones, would leave those nodes waiting forever.
+        :param nodes: Every node of the converge
+        :raises ConfigException: if a node type requires its own milestone or the node types require each other
+        """
+        provided_by = {}
+        required_by = {}
+        for node in nodes:
+            node_type = node.node_type or node.name
+            for milestone in node.provides:
+                provided_by.setdefault(milestone, set()).add(node_type)
+            required_by.setdefault(node_type, set()).update(node.requires)
+
+        # The node types each node type waits for, and through which milestone
+        waits_for = {}
+        for node_type, milestones in required_by.items():
+            waits_for[node_type] = {}
+            for milestone in sorted(milestones):
+                for provider in provided_by.get(milestone, []):
+                    if provider == node_type:
+                        raise ConfigException('{0} requires milestone {1}, which it provides itself'.format(
+                            node_type, milestone))
+                    waits_for[node_type].setdefault(provider, milestone)
+
+        # Depth first search for a cycle, done holds the node types known to be free of one
+        done = set()
+        for start in sorted(waits_for.keys()):
+            if start in done:
+                continue
+
+            path = [start]
+            on_path = {start}
+            stack = [(start, iter(sorted(waits_for[start].keys())))]
+
+            while stack:
+                node_type, providers = stack[-1]
+                provider = next(providers, None)
+
+                if provider is None:
+                    stack.pop()
+                    path.pop()
+                    on_path.discard(node_type)
+                    done.add(node_type)
+                elif provider in on_path:
+                    cycle = path[path.index(provider):] + [provider]
+                    raise ConfigException('Node types wait on each other\'s milestones: {0}'.format(
+                        ' -> '.join('{0} requires {1} from {2}'.format(waiting, waits_for[waiting][waited], waited)
+                                    for waiting, waited in zip(cycle, cycle[1:]))))
+                elif provider not in done:
+                    stack.append((provider, iter(sorted(waits_for.get(provider, {}).keys()))))
+                    on_path.add(provider)
+                    path.append(provider)
+
+    def is_satisfied(self, node):
+        # type: (Node) -> bool
+        """
+        :param node: A node to check the requirements of
+        :return: True if every milestone the node requires has been reached
+        """
+        with self._lock:
+            return all(milestone in self.reached for milestone in node.requires)
+
+    def node_converged(self, node):
+        # type: (Node) -> [str]
+        """
+        Marks every milestone a converged node provides as reached on that node
+        :param node: A node that converged successfully
+        :return: The milestones reached by this node
+        """
+        return self._mark(node, node.provides)
+
+    def poll(self, converging):
+        # type: ([Node]) -> [str]
+        """
+        Runs the checks of the pending milestones on the nodes providing them that are being converged
+        :param converging: The nodes being converged
+        :return: The milestones reached since the last poll
+        """
+        if not self.fan_out:
+            return []
+
+        reached = []
+        for milestone, command in self.checks.items():
+            with self._lock:
+                pending = self.pending.get(milestone, set())
+                nodes = [node for node in converging if node.name in pending]
+
+            if nodes:
+                for result in self.fan_out.run(nodes, command, get_pty=True):
+                    if result.ok:
+                        reached.extend(self._mark(result.node, [milestone]))
+
+        return reached
+
+    def _mark(self, node, milestones):
+        # type: (Node, [str]) -> [str]
+        """
+        Marks milestones as reached on a node
+        :param node: The providing node
+        :param milestones: The milestones the node has reached
+        :return: The milestones now reached on every providing node
+        """
+        reached = []
+        with self._lock:
+            for milestone in milestones:
+                pending = self.pending.get(milestone)
+                if pending is None or milestone in self.reached:
+                    continue
+                pending.discard(node.name)
+                if not pending:
+                    self.reached.add(milestone)
+                    reached.append(milestone)
+
+        return reached
+
+
+class ConvergeState:
+    def __init__(self, path):
+        # type: (str) -> None
+        """
+        Constructor for ConvergeState, loads the state file if it exists
+        :param path: The json file the state is checkpointed to
+        """
+        self.path = path
+        self.nodes = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r') as state_file:
+                self.nodes = json.load(state_file)['nodes']
+
+    def status(self, node):
+        # type: (Node) -> str
+        """
+        :param node: The node to look up
+        :return: The status of the node, pending if it has none
+        """
+        with self._lock:
+            return self.nodes.get(node.name, {}).get('status', 'pending')
+
+    def reset(self, nodes):
+        # type: ([Node]) -> None
+        """
+        Marks nodes as pending, ex. before they are converged
+        :param nodes: The nodes to reset
+        """
+        with self._lock:
+            for node in nodes:
+                self._update(node, 'pending', None)
+            self._save()
+
+    def mark(self, node, status, error=None):
+        # type: (Node, str, Exception) -> None
+        """
+        Records the status of a node and checkpoints the state to disk
+        :param node: The node whose status changed
+        :param status: pending, running, succeeded or failed
+        :param error: Why the node failed
+        """
+        with self._lock:
+            self._update(node, status, error)
+            self._save()
+
+    def _update(self, node, status, error):
+        # type: (Node, str, Exception) -> None
+        """
+        Records the status of a node in memory, with the time it changed
+        :param node: The node whose status changed
+        :param status: pending, running, succeeded or failed
+        :param error: Why the node failed
+        """
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        entry = self.nodes.setdefault(node.name, {})
+        entry['status'] = status
+        entry['updated'] = now
+        if status == 'pending':
+            for key in ('started', 'finished', 'error'):
+                entry.pop(key, None)
+        elif status == 'running':
+            entry['started'] = now
+            entry.pop('finished', None)
+            entry.pop('error', None)
+        else:
+            entry['finished'] = now
+            if error:
+                entry['error'] = str(error)
+
+    def _save(self):
+        # type: () -> None
+        """
+        Writes the state to a temporary file and renames it, so that a crash never leaves a truncated state behind
+        """
+        with open(self.path + '.tmp', 'w') as state_file:
+            json.dump({'nodes': self.nodes}, state_file, indent=2, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
@@ -0,0 +1,456 @@
+""" Module for sharing SSH connections to the nodes of a deployment.
+
+Every remote operation of a deploy goes through one pool, so a node pays for the key exchange once and later operations
+open new channels on the existing transport. The OpenSSH processes of a converge, the rsync of knife solo and chef-solo
+from the cookbook bundle, share connections the same way through master connections configured in the ssh_config of the
+deployment directory. knife solo runs its other sessions over Ruby net-ssh, which ignores the master connections.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import select
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from Queue import Queue, Empty
+from threading import Thread
+from types import GeneratorType
+
+import paramiko
+from paramiko.ssh_exception import NoValidConnectionsError, AuthenticationException, SSHException
+
+from domain.node import Node
+
+logger = logging.getLogger("root_logger")
+
+# Exceptions raised by paramiko when a node can not be reached or a transport has dropped
+SSH_EXCEPTIONS = (socket.error, SSHException, AuthenticationException, NoValidConnectionsError, EOFError)
+
+
+class SSHPool:
+    def __init__(self, keepalive_interval=30, connect_timeout=30, port=22):
+        # type: (int, int, int) -> None
+        """
+        Constructor for SSHPool
+        :param keepalive_interval: Seconds between keepalive packets on idle transports
+        :param connect_timeout: Default timeout for opening a new connection
+        :param port: The ssh port of the nodes
+        """
+        self.port = port
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+
+        # Connected clients and the locks serializing their creation, keyed by (host, user)
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, host, user, private_key, timeout=None):
+        # type: (str, str, str, int) -> paramiko.SSHClient
+        """
+        Returns a connected client for the host and user, connecting if there is no live transport to reuse
+        :param host: The host to connect to
+        :param user: The user to ssh with
+        :param private_key: The key to ssh with
+        :param timeout: Timeout for a new connection, defaults to the pool connect timeout
+        :return: A connected paramiko client
+        """
+        key = (host, user)
+
+        with self._key_lock(key):
+            client = self._clients.get(key)
+            if client and client.get_transport() and client.get_transport().is_active():
+                return client
+
+            if client:
+                logger.debug('SSH transport to {0}@{1} dropped, reconnecting'.format(user, host))
+                client.close()
+
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(host, port=self.port, username=user, key_filename=private_key,
+                           timeout=timeout or self.connect_timeout)
+            client.get_transport().set_keepalive(self.keepalive_interval)
+
+            self._clients[key] = client
+            return client
+
+    def is_connected(self, host, user):
+        # type: (str, str) -> bool
+        """
+        Returns whether the pool holds a live transport for the host and user
+        :param host: The host of the connection
+        :param user: The user of the connection
+        :return: True if a pooled transport is active
+        """
+        client = self._clients.get((host, user))
+        return bool(client and client.get_transport() and client.get_transport().is_active())
+
+    def exec_command(self, host, user, private_key, command, get_pty=False, timeout=None):
+        # type: (str, str, str, str, bool, int) -> tuple
+        """
+        Executes a command on a new channel of the pooled transport, reconnecting once if the transport has dropped
+        :param host: The host to run the command on
+        :param user: The user to ssh with
+        :param private_key: The key to ssh with
+        :param command: The command to execute
+        :param get_pty: Whether to request a pseudo terminal
+        :param timeout: Channel timeout in seconds
+        :return: The stdin, stdout and stderr of the command, as returned by paramiko
+        """
+        for attempt in range(2):
+            client = self.get_client(host, user, private_key)
+            try:
+                return client.exec_command(command, get_pty=get_pty, timeout=timeout)
+            except SSH_EXCEPTIONS:
+                self.discard(host, user)
+                if attempt == 1:
+                    raise
+
+    def open_sftp(self, host, user, private_key):
+        # type: (str, str, str) -> paramiko.SFTPClient
+        """
+        Opens an sftp session on a new channel of the pooled transport
+        :param host: The host to open the session to
+        :param user: The user to ssh with
+        :param private_key: The key to ssh with
+        :return: An sftp client, to be closed by the caller
+        """
+        for attempt in range(2):
+            client = self.get_client(host, user, private_key)
+            try:
+                return client.open_sftp()
+            except SSH_EXCEPTIONS:
+                self.discard(host, user)
+                if attempt == 1:
+                    raise
+
+    def discard(self, host, user):
+        # type: (str, str) -> None
+        """
+        Closes and forgets the connection for the host and user
+        :param host: The host of the connection
+        :param user: The user of the connection
+        """
+        with self._key_lock((host, user)):
+            client = self._clients.pop((host, user), None)
+            if client:
+                client.close()
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes every pooled connection
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+
+        for client in clients:
+            client.close()
+
+    def _key_lock(self, key):
+        # type: (tuple) -> threading.Lock
+        """
+        Returns the lock for a (host, user) key, so that one host connecting does not block the others
+        :param key: The (host, user) key
+        :return: The lock for the key
+        """
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+
+class SSHMultiplexer:
+    def __init__(self, directory, ssh_user, private_key, control_persist='15m'):
+        # type: (str, str, str, str) -> None
+        """
+        Constructor for SSHMultiplexer
+        :param directory: The deployment directory, the ssh_config is written to it
+        :param ssh_user: The user to ssh with
+        :param private_key: The key to ssh with
+        :param control_persist: How long an idle master connection stays open, in the ControlPersist format
+        """
+        self.ssh_user = ssh_user
+        self.private_key = private_key
+        self.control_persist = control_persist
+        self.config_file = os.path.join(directory, 'ssh_config')
+
+        # Unix socket paths are limited to about 100 characters, so the sockets live in a short directory of their own
+        self.control_directory = os.path.join(tempfile.gettempdir(), 'rs-{0}'.format(
+            hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:10]))
+
+        # Master processes that have not exited yet
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def write_config(self):
+        # type: () -> None
+        """
+        Writes the ssh_config, every ssh process started with it shares one master connection per node
+        """
+        if not os.path.exists(self.control_directory):
+            os.makedirs(self.control_directory, 0o700)
+
+        with open(self.config_file, 'w') as config_file:
+            config_file.write('Host *\n'
+                              '    StrictHostKeyChecking no\n'
+                              '    UserKnownHostsFile /dev/null\n'
+                              '    LogLevel ERROR\n'
+                              '    ServerAliveInterval 30\n'
+                              '    ServerAliveCountMax 3\n'
+                              '    ControlMaster auto\n'
+                              '    ControlPath {0}/%C\n'
+                              '    ControlPersist {1}\n'.format(self.control_directory, self.control_persist))
+
+    def open(self, node):
+        # type: (Node) -> None
+        """
+        Starts a master connection to the node in the background, it stays open for control_persist once idle
+        :param node: The node to connect to
+        """
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(['ssh', '-F', self.config_file, '-i', self.private_key,
+                                        '-o', 'ConnectTimeout=30', '{0}@{1}'.format(self.ssh_user, node.floating_ip),
+                                        'true'],
+                                       stdin=devnull, stdout=devnull, stderr=devnull)
+
+        with self._lock:
+            self._processes = [running for running in self._processes if running.poll() is None] + [process]
+
+    def close(self, node):
+        # type: (Node) -> None
+        """
+        Stops the master connection to the node, ex. before the node is rebuilt
+        :param node: The node to disconnect from
+        """
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['ssh', '-F', self.config_file, '-O', 'exit',
+                             '{0}@{1}'.format(self.ssh_user, node.floating_ip)], stdout=devnull, stderr=devnull)
+
+    def close_all(self, nodes):
+        # type: ([Node]) -> None
+        """
+        Stops the master connections to the nodes
+        :param nodes: The nodes to disconnect from
+        """
+        for node in nodes:
+            self.close(node)
+
+        with self._lock:
+            for process in self._processes:
+                process.wait()
+            self._processes = []
+
+
+class SSHReadinessScanner:
+    def __init__(self, ssh_pool, ssh_user, private_key, timeout=600, min_interval=0.5, max_interval=10,
+                 banner_timeout=10):
+        # type: (SSHPool, str, str, int, float, float, int) -> None
+        """
+        Constructor for SSHReadinessScanner
+        :param ssh_pool: The ssh connection pool authenticated connections are kept in, its port is probed
+        :param ssh_user: The user to ssh with
+        :param private_key: The key to ssh with
+        :param timeout: Seconds to wait for all nodes before giving up
+        :param min_interval: Shortest delay between two probes of a host
+        :param max_interval: Longest delay between two probes of a host
+        :param banner_timeout: Seconds to wait for the ssh banner once the tcp connection is open
+        """
+        self.ssh_pool = ssh_pool
+        self.ssh_user = ssh_user
+        self.private_key = private_key
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.banner_timeout = banner_timeout
+
+    def scan(self, nodes):
+        # type: ([Node]) -> GeneratorType
+        """
+        Probes all nodes at once and yields each node as soon as it accepts an authenticated ssh connection.
+
+        Each probe is a non-blocking tcp connect, followed by a read of the ssh banner. Only hosts that present a
+        banner are authenticated, on a separate thread, and the connection is kept in the pool. Hosts that refuse the
+        connection are booted and probed again soon, hosts that do not answer are probed at a growing interval.
+
+        :param nodes: The nodes to wait for
+        :raises paramiko.SSHException: when nodes are still unreachable once the timeout has passed
+        :return: A generator of the nodes as they become reachable
+        """
+        deadline = time.time() + self.timeout
+        authenticated = Queue()
+
+        # Per host probe state, keyed by node name
+        probes = {}
+        for node in nodes:
+            if self.ssh_pool.is_connected(node.floating_ip, self.ssh_user):
+                authenticated.put((node, None))
+            else:
+                probes[node.name] = _Probe(node, self.min_interval)
+
+        remaining = len(nodes)
+        while remaining > 0:
+            now = time.time()
+            if now > deadline:
+                unreachable = ', '.join(sorted(probes.keys()))
+                logger.error('Timed out attempting to establish SSH connection with {0}'.format(unreachable))
+                raise paramiko.SSHException("Exhausted retries connecting to nodes: {0}".format(unreachable))
+
+            # Emit every node that finished authenticating
+            while True:
+                try:
+                    node, error = authenticated.get_nowait()
+                except Empty:
+                    break
+
+                if error is None:
+                    remaining -= 1
+                    probes.pop(node.name, None)
+                    logger.info("Established SSH connection with {0} -- {1}@{2}".format(
+                        node.name, self.ssh_user, node.floating_ip))
+                    yield node
+                else:
+                    logger.debug('Authentication failed on {0} - {1}'.format(node.name, error))
+                    probes[node.name].retry(self.min_interval, self.max_interval, refused=False)
+
+            for probe in probes.values():
+                if probe.phase == 'waiting' and probe.next_attempt <= now:
+                    self._start_connect(probe)
+                elif probe.phase == 'banner' and now - probe.started > self.banner_timeout:
+                    probe.retry(self.min_interval, self.max_interval, refused=False)
+                elif probe.phase == 'connecting' and now - probe.started > self.banner_timeout:
+                    probe.retry(self.min_interval, self.max_interval, refused=False)
+
+            # poll instead of select, so that large clusters are not limited by FD_SETSIZE
+            poller = select.poll()
+            in_flight = {}
+            for probe in probes.values():
+                if probe.phase == 'connecting':
+                    poller.register(probe.sock.fileno(), select.POLLOUT)
+                    in_flight[probe.sock.fileno()] = probe
+                elif probe.phase == 'banner':
+                    poller.register(probe.sock.fileno(), select.POLLIN)
+                    in_flight[probe.sock.fileno()] = probe
+
+            if not in_flight:
+                # Wake up as soon as an authentication finishes
+                try:
+                    authenticated.put(authenticated.get(timeout=self.min_interval))
+                except Empty:
+                    pass
+                continue
+
+            authenticating = [probe for probe in probes.values() if probe.phase == 'authenticating']
+            poll_timeout = 0.05 if authenticating else self.min_interval
+
+            for fd, event in poller.poll(poll_timeout * 1000):
+                probe = in_flight[fd]
+
+                if probe.phase == 'connecting':
+                    error = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error == 0:
+                        probe.phase = 'banner'
+                        probe.started = time.time()
+                    else:
+                        probe.retry(self.min_interval, self.max_interval, refused=error == errno.ECONNREFUSED)
+                    continue
+
+                try:
+                    data = probe.sock.recv(256)
+                except socket.error:
+                    probe.retry(self.min_interval, self.max_interval, refused=True)
+                    continue
+
+                probe.banner += data
+                if probe.banner.startswith(b'SSH-'):
+                    probe.close()
+                    probe.phase = 'authenticating'
+                    thread = Thread(target=self._authenticate, args=[probe.node, authenticated])
+                    thread.daemon = True
+                    thread.start()
+                elif not data or len(probe.banner) >= 4:
+                    # Closed before a banner, or something other than sshd is answering
+                    probe.retry(self.min_interval, self.max_interval, refused=True)
+
+    def _start_connect(self, probe):
+        # type: (_Probe) -> None
+        """
+        Opens a non-blocking tcp connection to the ssh port of the probed host
+        :param probe: The probe to connect
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+
+        result = sock.connect_ex((probe.node.floating_ip, self.ssh_pool.port))
+        probe.sock = sock
+        probe.banner = b''
+        probe.started = time.time()
+
+        if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            probe.phase = 'connecting'
+        else:
+            probe.retry(self.min_interval, self.max_interval, refused=result == errno.ECONNREFUSED)
+
+    def _authenticate(self, node, authenticated):
+        # type: (Node, Queue) -> None
+        """
+        Opens an authenticated connection in the pool, and reports the result on the queue
+        :param node: The node to authenticate with
+        :param authenticated: The queue to put the (node, error) result on
+        """
+        try:
+            self.ssh_pool.get_client(node.floating_ip, self.ssh_user, self.private_key, timeout=self.banner_timeout)
+            authenticated.put((node, None))
+        except SSH_EXCEPTIONS as e:
+            authenticated.put((node, e))
+
+
+class _Probe:
+    def __init__(self, node, interval):
+        # type: (Node, float) -> None
+        """
+        Constructor for _Probe, the readiness state of a single host
+        :param node: The node being probed
+        :param interval: The initial delay between probes
+        """
+        self.node = node
+        self.interval = interval
+        self.next_attempt = 0
+        self.phase = 'waiting'
+        self.sock = None
+        self.banner = b''
+        self.started = 0
+
+    def retry(self, min_interval, max_interval, refused):
+        # type: (float, float, bool) -> None
+        """
+        Closes the current attempt and schedules the next one. A refused connection means the host is up and sshd
+        is about to start, so the host is probed again quickly, otherwise the interval backs off.
+        :param min_interval: Shortest delay between two probes
+        :param max_interval: Longest delay between two probes
+        :param refused: Whether the host actively refused the connection
+        """
+        self.close()
+
+        if refused:
+            self.interval = min_interval * 2
+        else:
+            self.interval = min(self.interval * 2, max_interval)
+
+        self.phase = 'waiting'
+        self.next_attempt = time.time() + self.interval
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes the probe socket
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,375 @@
+""" Module for standing in for cluster nodes with in-process ssh servers.
+
+A StubSSHFarm runs one paramiko ssh server per node on its own loopback address, and points the floating ip of each node
+at it. Commands are answered from scripted responses, with configurable latency, failures and dropped connections, so
+remote operations can be load tested without any VMs.
+"""
+
+import logging
+import os
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import paramiko
+
+from domain.node import Node
+
+logger = logging.getLogger("root_logger")
+
+
+class StubResponse:
+    def __init__(self, pattern, exit_status=0, stdout='', stderr='', latency=0, repeat_for=0):
+        # type: (str, int, str, str, float, float) -> None
+        """
+        Constructor for StubResponse
+        :param pattern: Regex matched against the executed command
+        :param exit_status: Exit status to return
+        :param stdout: Output to send on stdout
+        :param stderr: Output to send on stderr
+        :param latency: Seconds the command takes, added to the latency of the server
+        :param repeat_for: Seconds to keep sending stdout over and over before exiting, as a command that keeps printing
+        """
+        self.pattern = re.compile(pattern)
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.latency = latency
+        self.repeat_for = repeat_for
+
+
+class StubSSHServer:
+    def __init__(self, address, port, host_key, root_directory, responses=None, latency=0, handshake_latency=0,
+                 failure_rate=0, drop_rate=0):
+        # type: (str, int, paramiko.PKey, str, [StubResponse], float, float, float, float) -> None
+        """
+        Constructor for StubSSHServer
+        :param address: The address to listen on
+        :param port: The port to listen on
+        :param host_key: The host key of the server
+        :param root_directory: The directory sftp paths are resolved against
+        :param responses: Scripted responses, the first one matching a command is used
+        :param latency: Seconds every command takes
+        :param handshake_latency: Seconds to wait before sending the ssh banner of a new connection
+        :param failure_rate: Probability that a command exits with status 1 instead of its scripted response
+        :param drop_rate: Probability that the connection is dropped while a command is running
+        """
+        self.address = address
+        self.port = port
+        self.host_key = host_key
+        self.root_directory = root_directory
+        self.responses = responses or []
+        self.latency = latency
+        self.handshake_latency = handshake_latency
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+
+        # Set to refuse new connections, as a node that is down or still booting would
+        self.refuse_connections = False
+
+        # Every command executed on the server, in order
+        self.commands = []
+        self.connection_count = 0
+
+        self._socket = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        # type: () -> None
+        """
+        Starts listening and accepting connections on a background thread
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.address, self.port))
+        self._socket.listen(128)
+        self._socket.settimeout(0.5)
+        self._running = True
+
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # type: () -> None
+        """
+        Stops accepting connections, and waits for the listening socket to be released
+        """
+        self._running = False
+        if self._socket:
+            self._socket.close()
+        if self._thread:
+            self._thread.join()
+
+    def _accept_loop(self):
+        # type: () -> None
+        """
+        Accepts connections until the server is stopped
+        """
+        while self._running:
+            try:
+                client_socket, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+
+            if self.refuse_connections:
+                client_socket.close()
+                continue
+
+            with self._lock:
+                self.connection_count += 1
+
+            thread = threading.Thread(target=self._start_transport, args=[client_socket])
+            thread.daemon = True
+            thread.start()
+
+    def _start_transport(self, client_socket):
+        # type: (socket.socket) -> None
+        """
+        Runs the server side of the ssh protocol on an accepted connection
+        :param client_socket: The accepted connection
+        """
+        time.sleep(self.handshake_latency)
+
+        transport = paramiko.Transport(client_socket)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _StubSFTPInterface)
+
+        try:
+            transport.start_server(server=_StubServerInterface(self, transport))
+        except (paramiko.SSHException, EOFError, socket.error):
+            transport.close()
+
+    def execute(self, transport, channel, command):
+        # type: (paramiko.Transport, paramiko.Channel, str) -> None
+        """
+        Answers a command with the first matching scripted response, or exit status 0 and no output
+        :param transport: The transport the command came in on
+        :param channel: The channel to answer on
+        :param command: The command to answer
+        """
+        with self._lock:
+            self.commands.append(command)
+
+        response = StubResponse('')
+        for candidate in self.responses:
+            if candidate.pattern.search(command):
+                response = candidate
+                break
+
+        time.sleep(self.latency + response.latency)
+
+        try:
+            if random.random() < self.drop_rate:
+                transport.close()
+                return
+
+            if random.random() < self.failure_rate:
+                channel.sendall_stderr('injected failure\n')
+                channel.send_exit_status(1)
+            else:
+                deadline = time.time() + response.repeat_for
+                while time.time() < deadline and not channel.closed:
+                    channel.sendall(response.stdout)
+
+                channel.sendall(response.stdout)
+                channel.sendall_stderr(response.stderr)
+                channel.send_exit_status(response.exit_status)
+
+            channel.close()
+        except (paramiko.SSHException, EOFError, socket.error):
+            transport.close()
+
+
+class StubSSHFarm:
+    def __init__(self, node_count, port=2222, **server_options):
+        # type: (int, int, **any) -> None
+        """
+        Constructor for StubSSHFarm
+        :param node_count: How many servers to run
+        :param port: The port every server listens on, each server has its own loopback address
+        :param server_options: Options passed to every StubSSHServer, ex. latency or failure_rate
+        """
+        self.port = port
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.servers = []
+
+        # The sftp roots of the servers, removed when the farm stops
+        self.directory = tempfile.mkdtemp(prefix='redstack-ssh-stub-')
+
+        for i in range(node_count):
+            address = '127.0.{0}.{1}'.format(i // 250 + 1, i % 250 + 1)
+            root_directory = os.path.join(self.directory, address)
+            os.makedirs(root_directory)
+
+            self.servers.append(StubSSHServer(address, port, self.host_key, root_directory, **server_options))
+
+    def start(self):
+        # type: () -> None
+        """
+        Starts every server
+        """
+        for server in self.servers:
+            server.start()
+
+    def stop(self):
+        # type: () -> None
+        """
+        Stops every server and removes their sftp roots
+        """
+        for server in self.servers:
+            server.stop()
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def assign(self, nodes):
+        # type: ([Node]) -> None
+        """
+        Points the floating and internal ip of each node at its own server
+        :param nodes: The nodes to assign, at most one per server
+        """
+        for node, server in zip(nodes, self.servers):
+            node.floating_ip = server.address
+            node.internal_ip = server.address
+
+    def get_server(self, node):
+        # type: (Node) -> StubSSHServer
+        """
+        Returns the server a node was assigned to
+        :param node: An assigned node
+        :return: The server listening on the floating ip of the node
+        """
+        for server in self.servers:
+            if server.address == node.floating_ip:
+                return server
+
+    @staticmethod
+    def create_client_key(path):
+        # type: (str) -> str
+        """
+        Writes a private key for clients to authenticate with, every key is accepted by the servers
+        :param path: Where to write the key
+        :return: The path of the key
+        """
+        paramiko.RSAKey.generate(2048).write_private_key_file(path)
+        return path
+
+
+class _StubServerInterface(paramiko.ServerInterface):
+    def __init__(self, server, transport):
+        # type: (StubSSHServer, paramiko.Transport) -> None
+        """
+        Constructor for _StubServerInterface
+        :param server: The stub server the connection belongs to
+        :param transport: The transport of the connection
+        """
+        self.server = server
+        self.transport = transport
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.server.execute, args=[self.transport, channel, command])
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class _StubSFTPInterface(paramiko.SFTPServerInterface):
+    def __init__(self, server_interface, *args, **kwargs):
+        # type: (_StubServerInterface, args) -> None
+        """
+        Constructor for _StubSFTPInterface, serving the root directory of the stub server
+        :param server_interface: The server interface of the connection
+        """
+        super(_StubSFTPInterface, self).__init__(server_interface, *args, **kwargs)
+        self.root_directory = server_interface.server.root_directory
+
+    def _local_path(self, path):
+        return os.path.join(self.root_directory, path.lstrip('/'))
+
+    def list_folder(self, path):
+        local_path = self._local_path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, name)), name)
+                    for name in os.listdir(local_path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        local_path = self._local_path(path)
+        directory = os.path.dirname(local_path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        try:
+            fd = os.open(local_path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY or flags & os.O_RDWR:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        else:
+            mode = 'rb'
+
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = local_path
+        handle.readfile = os.fdopen(fd, mode) if mode == 'rb' else None
+        handle.writefile = os.fdopen(fd, mode) if mode != 'rb' else None
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._local_path(oldpath), self._local_path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.makedirs(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
@@ -0,0 +1,62 @@
+""" Tests for running commands over the fan-out against in-process ssh servers. Run from the redstack directory, ex.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from domain.node import Node
+from fanout import FanOut
+from ssh import SSHPool
+from ssh_stub import StubResponse, StubSSHFarm
+
+
+class FanOutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.private_key = StubSSHFarm.create_client_key(os.path.join(self.directory, 'key'))
+
+        self.nodes = [Node(name='rs-data-{0}'.format(i), node_type='rs-data') for i in range(2)]
+        self.farm = StubSSHFarm(len(self.nodes), port=2223,
+                                responses=[StubResponse('tail -f', stdout='still running\n' * 10000, repeat_for=30),
+                                           StubResponse('false', exit_status=1, stderr='failed\n')])
+        self.farm.assign(self.nodes)
+        self.farm.start()
+        self.ssh_pool = SSHPool(port=self.farm.port)
+
+    def tearDown(self):
+        self.ssh_pool.close()
+        self.farm.stop()
+        shutil.rmtree(self.directory)
+
+    def create_fan_out(self, timeout):
+        # type: (int) -> FanOut
+        """
+        :return: A fan-out over the stub servers that does not log every line
+        """
+        return FanOut(self.ssh_pool, 'centos', self.private_key, timeout=timeout, stream_output=False)
+
+    def test_returns_exit_status_and_output(self):
+        results = self.create_fan_out(10).run(self.nodes, 'false')
+
+        self.assertEqual([result.exit_status for result in results], [1, 1])
+        self.assertEqual(results[0].stderr_tail, ['failed'])
+        self.assertFalse(results[0].ok)
+
+    def test_times_out_command_that_keeps_printing(self):
+        start = time.time()
+        results = self.create_fan_out(1).run(self.nodes, 'tail -f /var/log/messages')
+
+        self.assertLess(time.time() - start, 10)
+        for result in results:
+            self.assertEqual(result.error, 'timed out after 1s')
+            self.assertIn('still running', result.stdout_tail)
+
+
+if __name__ == '__main__':
+    unittest.main()
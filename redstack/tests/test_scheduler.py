@@ -0,0 +1,165 @@
+""" Tests for the converge scheduler and its milestone ordering. Run from the redstack directory, ex.
+
+    python -m unittest discover -s tests
+"""
+
+import threading
+import time
+import unittest
+
+from domain.node import Node
+from scheduler import ConvergeScheduler, MilestoneTracker
+
+from redstack.exceptions import ConfigException
+
+
+def create_node(name, node_type, provides=None, requires=None):
+    # type: (str, str, [str], [str]) -> Node
+    """
+    :return: A node of the given type with the given milestones
+    """
+    return Node(name=name, node_type=node_type, provides=provides, requires=requires)
+
+
+class FakeConverge:
+    def __init__(self, duration=0.05, failing=None, wait_for=None):
+        # type: (float, [str], threading.Event) -> None
+        """
+        Constructor for FakeConverge, a converge function that records what it was called with
+        :param duration: Seconds every converge takes
+        :param failing: Names of the nodes whose converge raises
+        :param wait_for: Set before any converge finishes, ex. once every node has been fed
+        """
+        self.duration = duration
+        self.failing = failing or []
+        self.wait_for = wait_for
+
+        self.started = []
+        self.finished = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, node):
+        # type: (Node) -> None
+        """
+        Converges a node by waiting, raising if it is one of the failing nodes
+        :param node: The node to converge
+        """
+        with self._lock:
+            self.started.append(node.name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        if self.wait_for:
+            self.wait_for.wait(5)
+        time.sleep(self.duration)
+
+        with self._lock:
+            self.running -= 1
+            self.finished.append(node.name)
+
+        if node.name in self.failing:
+            raise RuntimeError('{0} failed'.format(node.name))
+
+
+def feed(nodes, fed):
+    # type: ([Node], threading.Event) -> iter
+    """
+    :return: The nodes as they would come from a readiness scan, setting fed once the last one is taken
+    """
+    for node in nodes:
+        yield node
+    fed.set()
+
+
+class ConvergeSchedulerTest(unittest.TestCase):
+
+    def test_respects_concurrency_limit(self):
+        nodes = [Node(name='rs-data{0}'.format(i)) for i in range(8)]
+        converge = FakeConverge()
+
+        failed = ConvergeScheduler(3).run(iter(nodes), converge, len(nodes))
+
+        self.assertEqual(failed, [])
+        self.assertEqual(converge.max_running, 3)
+        self.assertEqual(sorted(converge.finished), sorted(node.name for node in nodes))
+
+    def test_starts_by_priority_primary_first(self):
+        # The first node holds the only slot until every other node is queued
+        nodes = [Node(name='rs-first', priority=0),
+                 Node(name='rs-data1', priority=2),
+                 Node(name='rs-control1', priority=1),
+                 Node(name='rs-master', priority=1, primary=True),
+                 Node(name='rs-control2', priority=1)]
+        fed = threading.Event()
+        converge = FakeConverge(duration=0, wait_for=fed)
+
+        ConvergeScheduler(1).run(feed(nodes, fed), converge, len(nodes))
+
+        self.assertEqual(converge.started, ['rs-first', 'rs-master', 'rs-control1', 'rs-control2', 'rs-data1'])
+
+    def test_drains_running_converges_after_failure(self):
+        nodes = [Node(name='rs-data{0}'.format(i), priority=i) for i in range(4)]
+        fed = threading.Event()
+        converge = FakeConverge(duration=0.2, failing=['rs-data0'], wait_for=fed)
+        scheduler = ConvergeScheduler(2)
+
+        failed = scheduler.run(feed(nodes, fed), converge, len(nodes))
+
+        self.assertEqual([node.name for node in failed], ['rs-data0'])
+        self.assertEqual(converge.started, ['rs-data0', 'rs-data1'])
+        self.assertEqual(sorted(converge.finished), ['rs-data0', 'rs-data1'])
+        self.assertEqual([node.name for node in scheduler.succeeded], ['rs-data1'])
+
+    def test_raises_feed_error(self):
+        def failing_scan():
+            yield Node(name='rs-data1')
+            raise IOError('scan failed')
+
+        self.assertRaises(IOError, ConvergeScheduler(2).run, failing_scan(), FakeConverge(), 2)
+
+
+class MilestoneTrackerTest(unittest.TestCase):
+
+    def test_accepts_ordered_node_types(self):
+        nodes = [create_node('rs-master-1', 'rs-master', provides=['kdc-ready']),
+                 create_node('rs-control-1', 'rs-control', provides=['ldap-ready'], requires=['kdc-ready']),
+                 create_node('rs-data-1', 'rs-data', requires=['kdc-ready', 'ldap-ready']),
+                 create_node('rs-data-2', 'rs-data', requires=['kdc-ready', 'ldap-ready'])]
+
+        tracker = MilestoneTracker(nodes)
+
+        self.assertTrue(tracker.is_satisfied(nodes[0]))
+        self.assertFalse(tracker.is_satisfied(nodes[1]))
+
+    def test_rejects_missing_provider(self):
+        nodes = [create_node('rs-data-1', 'rs-data', requires=['kdc-ready'])]
+
+        self.assertRaises(ConfigException, MilestoneTracker, nodes)
+
+    def test_rejects_own_milestone(self):
+        nodes = [create_node('rs-master-1', 'rs-master', provides=['kdc-ready'], requires=['kdc-ready'])]
+
+        self.assertRaises(ConfigException, MilestoneTracker, nodes)
+
+    def test_rejects_milestone_of_own_node_type(self):
+        nodes = [create_node('rs-master-1', 'rs-master', provides=['kdc-ready']),
+                 create_node('rs-master-2', 'rs-master', requires=['kdc-ready'])]
+
+        self.assertRaises(ConfigException, MilestoneTracker, nodes)
+
+    def test_rejects_cycle(self):
+        nodes = [create_node('rs-master-1', 'rs-master', provides=['x'], requires=['z']),
+                 create_node('rs-control-1', 'rs-control', provides=['y'], requires=['x']),
+                 create_node('rs-data-1', 'rs-data', provides=['z'], requires=['y']),
+                 create_node('rs-edge-1', 'rs-edge', requires=['x'])]
+
+        with self.assertRaises(ConfigException) as context:
+            MilestoneTracker(nodes)
+
+        self.assertIn('rs-master requires z from rs-data', str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
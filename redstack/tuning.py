@@ -0,0 +1,149 @@
+""" Module for tuning the operating system of each node to its role and flavor.
+
+The profile of a node is derived from whether it stores and processes data, from the RAM and vCPUs of its flavor and from
+its data volume. It is delivered to the node with its runtime attributes and applied by the redstack::tuning recipe:
+sysctls, open file and process limits, transparent hugepages, and the readahead and I/O scheduler of the data volume.
+The profiles of every node are also written to tuning-profile.json in the deployment directory.
+"""
+
+import json
+import logging
+import os
+
+from blueprints import BlueprintBuilder
+from domain.deploy import Deploy
+from domain.node import Node
+
+logger = logging.getLogger("root_logger")
+
+# Applies node['redstack']['tuning'], the transparent hugepage, readahead and scheduler settings do not survive a reboot
+# so they are applied by a service at boot as well
+TUNING_RECIPE = """tuning = node['redstack']['tuning']
+
+if tuning
+  file '/etc/sysctl.d/90-redstack.conf' do
+    content tuning['sysctl'].sort.map { |key, value| "#{key} = #{value}" }.join("\\n") + "\\n"
+    notifies :run, 'execute[redstack-sysctl]', :immediately
+  end
+
+  execute 'redstack-sysctl' do
+    command 'sysctl -p /etc/sysctl.d/90-redstack.conf'
+    action :nothing
+  end
+
+  file '/etc/security/limits.d/90-redstack.conf' do
+    content tuning['limits'].sort.map { |item, value| "* soft #{item} #{value}\\n* hard #{item} #{value}" }.join("\\n") + "\\n"
+  end
+
+  file '/usr/local/sbin/redstack-tuning' do
+    mode '0755'
+    content <<-EOS
+#!/bin/sh
+for setting in enabled defrag; do
+  [ -f /sys/kernel/mm/transparent_hugepage/$setting ] && echo #{tuning['transparent_hugepages']} > /sys/kernel/mm/transparent_hugepage/$setting
+done
+device=$(basename $(readlink -f #{tuning['device']}))
+parent=$(lsblk -no pkname /dev/$device 2> /dev/null | head -n 1)
+[ -n "$parent" ] && device=$parent
+[ -f /sys/block/$device/queue/read_ahead_kb ] && echo #{tuning['readahead_kb']} > /sys/block/$device/queue/read_ahead_kb
+grep -q #{tuning['io_scheduler']} /sys/block/$device/queue/scheduler 2> /dev/null && echo #{tuning['io_scheduler']} > /sys/block/$device/queue/scheduler
+exit 0
+EOS
+    notifies :run, 'execute[redstack-tuning]', :immediately
+  end
+
+  file '/etc/systemd/system/redstack-tuning.service' do
+    content "[Unit]\\nDescription=REDstack host tuning\\nAfter=local-fs.target\\n\\n[Service]\\nType=oneshot\\n" \\
+            "ExecStart=/usr/local/sbin/redstack-tuning\\n\\n[Install]\\nWantedBy=multi-user.target\\n"
+    notifies :run, 'execute[redstack-tuning-enable]', :immediately
+  end
+
+  execute 'redstack-tuning-enable' do
+    command 'systemctl daemon-reload && systemctl enable redstack-tuning'
+    action :nothing
+  end
+
+  execute 'redstack-tuning' do
+    command '/usr/local/sbin/redstack-tuning'
+    action :nothing
+  end
+end
+"""
+
+
+class HostTuning:
+    def __init__(self, deploy):
+        # type: (Deploy) -> None
+        """
+        Constructor for HostTuning
+        :param deploy: The current deploy, its blueprints tell which nodes hold data
+        """
+        self.deploy = deploy
+        self._worker_groups = None
+
+    def profile(self, node):
+        # type: (Node) -> {}
+        """
+        Computes the tuning of a node. Workers, the nodes with a DataNode or a NodeManager, read and write large blocks
+        sequentially and hold many connections to each other, the others mostly serve RPCs.
+        :param node: The node to tune, with the RAM and vCPUs of its flavor
+        :return: The tuning profile of the node
+        """
+        if self._worker_groups is None:
+            blueprint_builder = BlueprintBuilder(self.deploy)
+            self._worker_groups = set(blueprint_builder.get_groups_with_component('DATANODE') +
+                                      blueprint_builder.get_groups_with_component('NODEMANAGER'))
+
+        worker = node.ambari_group in self._worker_groups
+        ram_mb = node.ram or 1024
+        vcpus = node.vcpus or 1
+        mb = 1048576
+
+        # Ratio based dirty page limits let a large node pile up gigabytes of writes and then stall on flushing them
+        dirty_background = min(max(ram_mb * mb // 100, 64 * mb), 256 * mb)
+        socket_buffer = 16 * mb if ram_mb >= 16384 else 4 * mb
+        somaxconn = 1024 if worker else 4096
+
+        return {
+            'role': 'worker' if worker else 'master',
+            'transparent_hugepages': 'never',
+            'device': self.deploy.volume_device,
+            # HDFS blocks are read whole, a long readahead pays off on a data volume of some size
+            'readahead_kb': 4096 if worker and (node.volume_size or 0) >= 100 else 1024,
+            'io_scheduler': 'deadline',
+            'limits': {
+                'nofile': 131072 if worker else 65536,
+                'nproc': 65536 if worker else 32768
+            },
+            'sysctl': {
+                'vm.swappiness': 1,
+                'vm.dirty_background_bytes': dirty_background,
+                'vm.dirty_bytes': dirty_background * 4,
+                'vm.min_free_kbytes': min(max(ram_mb * 1024 // 100, 65536), 1048576),
+                'fs.file-max': max(ram_mb * 256, 1048576),
+                'net.core.somaxconn': somaxconn,
+                'net.ipv4.tcp_max_syn_backlog': somaxconn * 2,
+                'net.core.netdev_max_backlog': min(2500 * vcpus, 65536),
+                'net.core.rmem_max': socket_buffer,
+                'net.core.wmem_max': socket_buffer,
+                'net.ipv4.tcp_rmem': '4096 87380 {0}'.format(socket_buffer),
+                'net.ipv4.tcp_wmem': '4096 65536 {0}'.format(socket_buffer)
+                # The ephemeral port range is left at the kernel default, a wider one overlaps the ports HDP listens on
+            }
+        }
+
+    def write(self, nodes):
+        # type: ([Node]) -> {}
+        """
+        Writes the profile of each node to tuning-profile.json in the deployment directory
+        :param nodes: The nodes to write the profile of
+        :return: The profiles by node name
+        """
+        profiles = dict((node.name, self.profile(node)) for node in nodes)
+
+        path = os.path.join(self.deploy.directory, 'tuning-profile.json')
+        with open(path, 'w') as profile_file:
+            json.dump(profiles, profile_file, indent=2, sort_keys=True)
+
+        logger.info('Wrote the tuning profile of {0} nodes to {1}'.format(len(profiles), path))
+        return profiles